@@ -0,0 +1,201 @@
+__author__ = 'Viralogic Software'
+
+import gc
+import json
+import math
+import platform
+import sys
+import time
+import tracemalloc
+from py_linq import Enumerable
+
+# Every benchmark is a function taking a source factory and the key selector for its elements and returning the
+# result of the operation, so that the whole query is executed. Sources are created fresh for every run.
+
+SOURCES = {
+    'ints': (lambda n: list(range(n)), lambda x: x),
+    'dicts': (lambda n: [{'value': i} for i in range(n)], lambda x: x['value']),
+    'generator': (lambda n: (i for i in range(n)), lambda x: x),
+}
+
+
+def _binary(operator):
+    """
+    Builds a benchmark of a binary operator whose second operand is every other element of the first one, so that
+    both have the same shape (and the same replay buffer for generator sources)
+    :param operator: function(first Enumerable, second Enumerable, key selector)
+    """
+    def benchmark(source, key):
+        first = Enumerable(source)
+        return operator(first, first.where(lambda x: key(x) % 2 == 0), key)
+    return benchmark
+
+
+OPERATORS = {
+    'to_list': lambda source, key: Enumerable(source).to_list(),
+    'count': lambda source, key: Enumerable(source).count(),
+    'sum': lambda source, key: Enumerable(source).sum(key),
+    'min': lambda source, key: Enumerable(source).min(key),
+    'max': lambda source, key: Enumerable(source).max(key),
+    'avg': lambda source, key: Enumerable(source).avg(key),
+    'median': lambda source, key: Enumerable(source).median(key),
+    'first': lambda source, key: Enumerable(source).first(),
+    'first_or_default': lambda source, key: Enumerable(source).first_or_default(lambda x: key(x) < 0),
+    'last': lambda source, key: Enumerable(source).last(),
+    'last_or_default': lambda source, key: Enumerable(source).last_or_default(lambda x: key(x) % 2 == 0),
+    'element_at': lambda source, key: Enumerable(source).elementAtOrDefault(1000),
+    'single': lambda source, key: Enumerable(source).single(lambda x: key(x) == 0),
+    'single_or_default': lambda source, key: Enumerable(source).single_or_default(lambda x: key(x) < 0),
+    'default_if_empty': lambda source, key: Enumerable(source).where(lambda x: key(x) < 0).default_if_empty().to_list(),
+    'any': lambda source, key: Enumerable(source).any(lambda x: key(x) < 0),
+    'contains': lambda source, key: Enumerable(source).select(key).contains(-1),
+    'foreach': lambda source, key: Enumerable(source).foreach(key),
+    'select': lambda source, key: Enumerable(source).select(key).to_list(),
+    'where': lambda source, key: Enumerable(source).where(lambda x: key(x) % 3 == 0).to_list(),
+    'select_many': lambda source, key: Enumerable(source).select_many(lambda x: (x, x)).count(),
+    'skip_take': lambda source, key: Enumerable(source).skip(10).take(1000).to_list(),
+    'reverse': lambda source, key: Enumerable(source).reverse().to_list(),
+    'order_by': lambda source, key: Enumerable(source).order_by(lambda x: -key(x)).to_list(),
+    'order_by_descending': lambda source, key: Enumerable(source).order_by_descending(key).to_list(),
+    'top_k': lambda source, key: Enumerable(source).order_by(lambda x: -key(x)).take(10).to_list(),
+    'distinct': lambda source, key: Enumerable(source).distinct(lambda x: key(x) % 1000).to_list(),
+    'group_by': lambda source, key: Enumerable(source).group_by(['id'], lambda x: key(x) % 1000).count(),
+    'join': _binary(lambda first, second, key: first.join(second, key, key).count()),
+    'group_join': _binary(lambda first, second, key: first.group_join(second, key, key).count()),
+    'concat': _binary(lambda first, second, key: first.concat(second.take(100)).count()),
+    'add': lambda source, key: Enumerable(source).add(Enumerable(source).first()).count(),
+    'union': _binary(lambda first, second, key: first.union(second, key).count()),
+    'intersect': _binary(lambda first, second, key: first.intersect(second, key).count()),
+    'except': _binary(lambda first, second, key: first.except_(second, key).count()),
+}
+
+PIPELINES = {
+    'filter_project_sort': lambda source, key: Enumerable(source).where(lambda x: key(x) % 2 == 0)
+        .select(key).order_by(lambda x: -x).take(100).to_list(),
+    'group_rollup': lambda source, key: Enumerable(source).group_by(['bucket'], lambda x: key(x) % 100)
+        .select(lambda g: (g.key.bucket, g.count(), g.sum(key))).to_list(),
+    'join_project': _binary(lambda first, second, key: first.join(second, key, key, lambda x: key(x[1]) % 100)
+        .distinct().count()),
+    'dedupe_count': lambda source, key: Enumerable(source).select(lambda x: key(x) % 5000).distinct().count(),
+}
+
+BENCHMARKS = dict(OPERATORS, **PIPELINES)
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def measure(benchmark, source, size, repeat=3):
+    """
+    Runs a benchmark and measures it
+    :param benchmark: benchmark name
+    :param source: source name
+    :param size: number of elements of the source
+    :param repeat: number of timed runs, the fastest one is kept
+    :return: dict with seconds, throughput (elements per second) and peak_bytes (peak traced memory of one run)
+    """
+    func = BENCHMARKS[benchmark]
+    factory, key = SOURCES[source]
+    best = None
+    for i in range(repeat):
+        data = factory(size)
+        gc.collect()
+        start = time.perf_counter()
+        func(data, key)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    data = factory(size)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(data, key)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': best,
+        'throughput': size / best if best > 0 else float('inf'),
+        'peak_bytes': peak,
+    }
+
+
+def run(benchmarks=None, sources=None, sizes=None, repeat=3, max_seconds=10.0, out=sys.stdout):
+    """
+    Runs benchmarks over every source and size. Sizes are run in ascending order and once a benchmark takes more than
+    max_seconds for a source the larger sizes are skipped, so that an accidentally quadratic operator does not hang
+    the run.
+    :return: dict of results keyed by 'benchmark/source/size'
+    """
+    results = {}
+    for benchmark in benchmarks or sorted(BENCHMARKS):
+        for source in sources or sorted(SOURCES):
+            for size in sorted(sizes or DEFAULT_SIZES):
+                result = measure(benchmark, source, size, repeat)
+                results['{0}/{1}/{2}'.format(benchmark, source, size)] = result
+                if out is not None:
+                    out.write("{0:<24} {1:<10} {2:>10} {3:>12.6f}s {4:>14.0f}/s {5:>12} B\n".format(
+                        benchmark, source, size, result['seconds'], result['throughput'], result['peak_bytes']))
+                if result['seconds'] > max_seconds:
+                    if out is not None:
+                        out.write("{0:<24} {1:<10} skipping larger sizes\n".format(benchmark, source))
+                    break
+    return results
+
+
+def scaling(results):
+    """
+    Estimates how the running time of every benchmark grows with the size of its source, as the exponent of the
+    largest two sizes: about 1 for linear, 2 for quadratic
+    :param results: dict of results returned by run
+    :return: dict of exponents keyed by 'benchmark/source'
+    """
+    times = {}
+    for name, result in results.items():
+        benchmark, source, size = name.rsplit('/', 2)
+        times.setdefault('{0}/{1}'.format(benchmark, source), []).append((int(size), result['seconds']))
+    exponents = {}
+    for name, points in times.items():
+        if len(points) < 2:
+            continue
+        (small, small_time), (large, large_time) = sorted(points)[-2:]
+        if small_time > 0 and large_time > 0:
+            exponents[name] = math.log(large_time / small_time) / math.log(float(large) / small)
+    return exponents
+
+
+def compare(baseline, results, threshold=0.25, memory_slack=65536):
+    """
+    Compares results to a baseline
+    :param baseline: dict of results recorded with save
+    :param results: dict of results returned by run
+    :param threshold: allowed relative loss of throughput and growth of peak memory
+    :param memory_slack: peak memory growth in bytes that is always allowed, to absorb allocator noise
+    :return: list of regression messages, empty when nothing regressed
+    """
+    regressions = []
+    for name in sorted(set(baseline) & set(results)):
+        old, new = baseline[name], results[name]
+        if new['throughput'] < old['throughput'] * (1 - threshold):
+            regressions.append("{0}: throughput {1:.0f}/s -> {2:.0f}/s".format(name, old['throughput'], new['throughput']))
+        if new['peak_bytes'] > old['peak_bytes'] * (1 + threshold) + memory_slack:
+            regressions.append("{0}: peak memory {1} B -> {2} B".format(name, old['peak_bytes'], new['peak_bytes']))
+    return regressions
+
+
+def save(results, path):
+    """
+    Records results as a baseline. Baselines are only comparable on the machine and Python version they were
+    recorded with.
+    """
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, f,
+                  indent=1, sort_keys=True)
+
+
+def load(path):
+    """
+    Loads a baseline recorded with save
+    :return: dict of results
+    """
+    with open(path) as f:
+        return json.load(f)['results']
@@ -25,11 +25,59 @@ __author__ = 'ViraLogic Software'
 #   Enumerable wrapping
 #   + 'reverse' u.test
 #   + 'foreach' u.test
+import abc
+import collections
+import functools
+import heapq
+import importlib
+import io
 import itertools
+import keyword
+import math
+import operator
+import os
+import sys
+import threading
+import time
+from array import array
+from collections.abc import Collection, Sequence, Sized
+# optional dependencies (numpy) and modules only some operators need are imported where they are used, so that
+# importing py_linq does not pay for features that are not used
 #import exceptions
 
+# sentinel returned by single pass helpers when no element was found, since None is a legitimate element
+_MISSING = object()
+
+_CACHE_POLICIES = ('none', 'replay', 'materialize')
+
+# result of the file sinks, see Enumerable.to_file
+WriteResult = collections.namedtuple('WriteResult', ['rows', 'bytes'])
+
 class Enumerable(object):
-    
+    # key selectors, predicates and projections given to the operators are lambda expressions or field specs: a
+    # string or int picks an item, a dotted string an attribute path, a tuple of specs a tuple of values (see _selector)
+
+    # the data lives in a slot, the __dict__ is only allocated for the optional per-instance attributes
+    __slots__ = ('_data', '__dict__', '__weakref__')
+
+    # cache policy used when none is given to the constructor, see __init__
+    default_cache = 'replay'
+    # whether concat and add check the types of the added elements, see concat
+    type_checking = True
+    # declared type of the elements, see __init__, and the cached set of element types, see _element_types
+    element_type = None
+    _types = None
+    # callable receiving a QueryProfile after every query execution, see profile
+    profiler = None
+    # maximum number of elements order_by holds in memory, larger inputs are sorted in runs spilled to temporary
+    # files and merged lazily (elements must be picklable). None sorts everything in memory. Can be set on a subclass
+    # or an instance, or given per query, see order_by
+    sort_budget = None
+    # maximum number of distinct keys group_by and distinct hold in memory, past it the data is partitioned by key
+    # hash into temporary files processed one at a time (elements and keys must be picklable). None never spills. Can
+    # be set on a subclass or an instance, or given per query, see group_by and distinct
+    group_budget = None
+
     def _ensureEnumerable(enumerable, argName='enumerable'):
         if not isinstance(enumerable, Enumerable):
             if hasattr(enumerable, "__iter__"):
@@ -39,30 +87,243 @@ class Enumerable(object):
         else:
             return enumerable
 
-    def __init__(self, data=None):
+    def __init__(self, data=None, cache=None, element_type=None):
         """
         Constructor
         ** Note: no type checking of the data elements are performed during instantiation. **
+        A declared element_type is a contract: the data is trusted to hold instances of it and concat and add only check
+        the elements added.
+        Cache policies decide how data that is not an in-memory collection (generators, iterators, custom iterables)
+        is iterated more than once:
+            * 'none': the data is iterated directly every time, so a generator can only be enumerated once
+            * 'replay': elements are buffered the first time they are pulled and replayed to every later or concurrent
+              iterator, so partially consumed iterators never lose elements. Safe for concurrent readers.
+            * 'materialize': the data is copied into a list by the constructor
+        Collections (list, tuple, range, set, dict...) are always iterated directly and never copied.
         :param data: iterable object
+        :param cache: cache policy, defaults to Enumerable.default_cache
+        :param element_type: type of the elements, inferred from the data when None
         :return: None
         """
-        if data == None:
+        if data is None:
             data = []
+        if element_type is not None:
+            self.element_type = element_type
 
         if not hasattr(data, "__iter__"):
             raise TypeError("Enumerable must be instantiated with an iterable object")
+        if cache is None:
+            cache = Enumerable.default_cache
+        if cache not in _CACHE_POLICIES:
+            raise ValueError("unknown cache policy {0}, expected one of {1}".format(cache, _CACHE_POLICIES))
+        if not isinstance(data, (_Query, Collection)):
+            if cache == 'replay':
+                data = _ReplayBuffer(data)
+            elif cache == 'materialize':
+                data = list(data)
         self._data = data
 
+    def __new__(cls, data=None, *args, **kwargs):
+        # numeric arrays get the vectorized implementation when numpy is available
+        if cls is Enumerable and _is_numeric_array(data):
+            cls = ArrayEnumerable
+        return super(Enumerable, cls).__new__(cls)
+
+    @staticmethod
+    def from_array(data):
+        """
+        Returns an ArrayEnumerable over numeric data, whose aggregates run as numpy kernels and that can be filtered
+        and projected by whole-array functions (see ArrayEnumerable.select_vectorized). numpy arrays are wrapped
+        without copying, array.array objects are copied so that they can still be resized.
+        :param data: numpy array, array.array or iterable of numbers
+        :return: ArrayEnumerable object
+        """
+        return ArrayEnumerable(data)
+
+    @staticmethod
+    def from_lines(path, encoding='utf-8', start=0, end=None):
+        """
+        Returns an Enumerable over the lines of a text file, without line terminators. The file is read in bulk
+        through a large buffer and is reopened every time the enumerable is iterated, nothing is cached.
+        A byte range reads the lines starting within it, so that the ranges returned by split_file read every line of
+        the file exactly once between them.
+        :param path: path of the file
+        :param encoding: text encoding of the file
+        :param start: byte offset to start reading at
+        :param end: byte offset to stop reading at, None for the end of the file
+        :return: new Enumerable object
+        """
+        return Enumerable(_FileSource(path, start, end, _parse_lines, encoding), cache='none')
+
+    @staticmethod
+    def from_csv(path, fields=None, header=True, encoding='utf-8', start=0, end=None, **fmtparams):
+        """
+        Returns an Enumerable over the records of a CSV file, read like from_lines. With a header, records are dicts
+        keyed by column names (missing values are None), otherwise lists of values. Blank lines are skipped. Byte
+        ranges assume quoted values spanning several lines do not straddle a range boundary.
+        :param path: path of the file
+        :param fields: column names (with a header) or indexes (without) to keep, None for all of them
+        :param header: whether the first line of the file names the columns
+        :param encoding: text encoding of the file
+        :param start: byte offset to start reading at
+        :param end: byte offset to stop reading at, None for the end of the file
+        :param fmtparams: csv dialect options, e.g. delimiter
+        :return: new Enumerable object
+        """
+        return Enumerable(_FileSource(path, start, end, _parse_csv, encoding, header, fields, fmtparams), cache='none')
+
+    @staticmethod
+    def from_jsonl(path, fields=None, start=0, end=None):
+        """
+        Returns an Enumerable over the values of a JSON lines (UTF-8) file, read like from_lines. Blank lines are
+        skipped.
+        :param path: path of the file
+        :param fields: keys to keep from every JSON object (missing ones are None), None for the whole values
+        :param start: byte offset to start reading at
+        :param end: byte offset to stop reading at, None for the end of the file
+        :return: new Enumerable object
+        """
+        return Enumerable(_FileSource(path, start, end, _parse_jsonl, fields), cache='none')
+
+    @staticmethod
+    def split_file(path, parts):
+        """
+        Splits a file into byte ranges of about the same size, for several workers to read it with from_lines,
+        from_csv or from_jsonl.
+
+        Usage:
+            for start, end in Enumerable.split_file('events.jsonl', 4):
+                pool.submit(count_sessions, 'events.jsonl', start, end)
+
+        :param path: path of the file
+        :param parts: number of ranges
+        :return: list of (start, end) tuples
+        """
+        if parts < 1:
+            raise ValueError("parts must be a positive number")
+        size = os.path.getsize(path)
+        step = -(-size // parts)
+        return [(min(i * step, size), min((i + 1) * step, size)) for i in range(parts)]
+
     def __iter__(self):
-        cache = []
-        for element in self._data:
-            cache.append(element)
-            yield element
-        self._data = cache
+        data = self._data
+        if isinstance(data, _ReplayBuffer) and data.exhausted:
+            # everything is buffered: from now on behave like a list backed enumerable
+            self._data = data = data.buffer
+        return iter(data)
 
     def __repr__(self):
         return self._data.__repr__()
 
+    def _derive(self, op, *args):
+        """
+        Returns a new Enumerable whose data is a deferred plan node applying op to self. Nothing is executed until the
+        new Enumerable is iterated, at which point the whole chain of plan nodes is optimized and run as one pipeline.
+        :param op: operator name, key of _STAGES
+        :param args: operator arguments
+        :return: new Enumerable object
+        """
+        return Enumerable(_Query(self, op, *args))
+
+    def _project(self, func):
+        """
+        Returns the values of func over the elements, or self when func is None so no identity projection is run
+        :param func: lambda expression, field spec or None
+        :return: iterable object
+        """
+        func = _selector(func)
+        return self if func is None else self._derive('select', func)
+
+    def _plan(self):
+        """
+        Collects the chain of deferred operators behind this enumerable
+        :return: tuple of (root Enumerable holding the actual data, list of (op, args) steps in execution order)
+        """
+        steps = []
+        root = self
+        while isinstance(root._data, _Query):
+            steps.append((root._data.op, root._data.args))
+            root = root._data.source
+        steps.reverse()
+        return root, steps
+
+    def _setting(self, name):
+        """
+        Resolves a setting such as sort_budget for a query on this enumerable: a value set on this enumerable itself,
+        else the one the root of its plan sees (its own, its class's such as qlist, or Enumerable's)
+        :param name: attribute name
+        :return: value of the setting
+        """
+        if name in self.__dict__:
+            return self.__dict__[name]
+        return getattr(self._plan()[0], name)
+
+    def __len__(self):
+        """
+        Number of elements, when it is known without iterating (see count). Raises TypeError otherwise, so len()
+        never runs a query; use count() instead.
+        :return: integer object
+        """
+        length = _plan_length(*self._plan())
+        if length is None:
+            raise TypeError("length of the enumerable is not known without iterating it, use count()")
+        return length
+
+    def __bool__(self):
+        # an Enumerable is always true, whatever its length
+        return True
+
+    def _sequence(self):
+        """
+        Returns the elements of the query as a Sequence when they can be had without iterating, i.e. for sequence data
+        followed by skip, take and reverse only
+        :return: Sequence object or None
+        """
+        root, steps = self._plan()
+        data = _source(root)
+        if not isinstance(data, Sequence) or any(op not in ('skip', 'take', 'reverse') or args and not _is_count(args[0])
+                               for op, args in steps):
+            return None
+        for op, args in _optimize(steps):
+            data = _STAGES[op](data, *args)
+        return data
+
+    def explain(self, optimized=True, analyze=False):
+        """
+        Describes the query plan behind the enumerable, one operator per line starting from the data source.
+
+        Usage:
+            print(Enumerable(range(100)).order_by(lambda x: -x).where(lambda x: x % 2).take(5).explain())
+            --> source: range (length 100)
+                -> where(<lambda>)
+                -> top_k(5, <lambda>, False)
+
+        :param optimized: describe the plan after the optimizer rewrites, otherwise as written
+        :param analyze: execute the query and annotate every operator with its profile, see profile
+        :return: str object
+        """
+        if analyze:
+            return str(self.profile())
+        root, steps = self._plan()
+        if optimized:
+            steps = _optimize(steps)
+        return _describe_plan(root, steps)
+
+    def profile(self):
+        """
+        Executes the optimized query once with instrumentation and returns what every operator did: the number of
+        elements it took in and emitted, the time spent in it (excluding upstream operators) and the number of calls
+        of its key selectors, predicates and projections.
+        To profile every query executed, set Enumerable.profiler to a callable receiving a QueryProfile; while it is
+        None (the default) queries run without any instrumentation.
+        :return: QueryProfile object
+        """
+        root, steps = self._plan()
+        profiles = []
+        for element in _execute_profiled(root, _optimize(steps), profiles.append):
+            pass
+        return profiles[0]
+
     def to_list(self):
         """
         Converts the iterable into a list
@@ -70,19 +331,76 @@ class Enumerable(object):
         """
         return list(element for element in self)
 
+    def to_file(self, path, func=None, encoding='utf-8', compression='infer', atomic=True):
+        """
+        Writes every element as a line of a text file. Elements are streamed and written in large batches, so memory
+        use does not depend on the number of elements.
+        :param path: path of the file
+        :param func: lambda expression converting an element to the text of its line, str by default
+        :param encoding: text encoding of the file
+        :param compression: 'gzip', 'bz2', 'lzma' or None. 'infer' picks one from the extension of path (.gz, .bz2,
+        .xz, .lzma)
+        :param atomic: write to a temporary file next to path and rename it to path once complete, so readers never
+        see a partial file
+        :return: WriteResult named tuple of the number of rows and the number of bytes written
+        """
+        if func is None:
+            func = str
+        return _write_file(self, path, lambda batch: "".join(func(element) + "\n" for element in batch), encoding,
+                           compression, atomic)
+
+    def to_jsonl(self, path, fields=None, compression='infer', atomic=True):
+        """
+        Writes every element as a line of a JSON lines (UTF-8) file, streamed like to_file
+        :param path: path of the file
+        :param fields: keys to keep from every element (missing ones are null), None for the whole elements
+        :param compression: 'gzip', 'bz2', 'lzma', None or 'infer', see to_file
+        :param atomic: write to a temporary file and rename it once complete, see to_file
+        :return: WriteResult named tuple of the number of rows and the number of bytes written
+        """
+        import json
+        if fields is None:
+            encode = lambda batch: "".join(json.dumps(element) + "\n" for element in batch)
+        else:
+            encode = lambda batch: "".join(json.dumps({field: element.get(field) for field in fields}) + "\n"
+                                           for element in batch)
+        return _write_file(self, path, encode, 'utf-8', compression, atomic)
+
+    def to_csv(self, path, fields=None, header=True, encoding='utf-8', compression='infer', atomic=True, **fmtparams):
+        """
+        Writes every element as a record of a CSV file, streamed like to_file. Dict elements are written by column
+        name (missing values are empty), any other element as a sequence of values.
+        :param path: path of the file
+        :param fields: column names, by default the keys of the first element when it is a dict
+        :param header: whether to write the column names, when known, as the first line
+        :param encoding: text encoding of the file
+        :param compression: 'gzip', 'bz2', 'lzma', None or 'infer', see to_file
+        :param atomic: write to a temporary file and rename it once complete, see to_file
+        :param fmtparams: csv dialect options, e.g. delimiter
+        :return: WriteResult named tuple of the number of rows (header excluded) and the number of bytes written
+        """
+        return _write_file(self, path, _CsvEncoder(fields, header, fmtparams), encoding, compression, atomic)
+
     def count(self):
         """
-        Returns the number of elements in iterable
+        Returns the number of elements in iterable. Operators that cannot change the number of elements (select,
+        order_by, reverse) are not executed, and sized sources are counted with len.
         :return: integer object
         """
-        return sum(1 for element in self)
+        root, steps = self._plan()
+        while steps and steps[-1][0] in _LENGTH_PRESERVING:
+            steps.pop()
+        length = _plan_length(root, steps)
+        if length is not None:
+            return length
+        return sum(1 for element in _execute(root, _optimize(steps)))
    
     def reverse(self):
         """
         Reverses the elements in iterable
         :return: new Enumerable object containing transformed data
         """
-        return Enumerable(reversed(self._data))
+        return self._derive('reverse')
    
     def foreach(self, action):
         """
@@ -92,7 +410,7 @@ class Enumerable(object):
             items.foreach(print)
         :return: the original iterable object
         """
-        for x in self._data:
+        for x in self:
             action(x)
         return self
 
@@ -102,10 +420,51 @@ class Enumerable(object):
         :param func: lambda expression on how to perform transformation
         :return: new Enumerable object containing transformed data
         """
-        if func == None:
-            func = lambda x: x
-        return Enumerable(map(func, self))
+        func = _selector(func)
+        if func is None:
+            func = _identity
+        return self._derive('select', func)
+
+
+    def as_parallel(self, workers=None, chunk_size=1000, ordered=True, threshold=None):
+        """
+        Returns a ParallelEnumerable whose select, where, select_many and foreach operators run in a process pool.
+        The data is split into chunks of chunk_size elements, each chunk is sent to a worker process and at most two
+        chunks per worker are in flight at any time. Functions given to those operators must be picklable (module
+        level functions, not lambdas or closures). Sources with fewer than threshold elements are processed serially.
+
+        Usage:
+            Enumerable(documents).as_parallel(workers=8).select(parse).where(is_valid).to_list()
+
+        :param workers: number of worker processes, defaults to the number of CPUs
+        :param chunk_size: number of elements sent to a worker at a time
+        :param ordered: keep the order of the source, otherwise chunks are yielded as soon as they complete
+        :param threshold: minimum number of elements to go parallel, defaults to chunk_size
+        :return: ParallelEnumerable object
+        """
+        return ParallelEnumerable(self._data, _ParallelOptions(workers, chunk_size, ordered, threshold))
+
+    def select_concurrent(self, func, max_workers=8, ordered=True):
+        """
+        Transforms data into different form calling func from a thread pool, for I/O bound transformations (service
+        calls, file reads...). At most two calls per thread are in flight, so memory stays bounded on large or
+        infinite sources.
+        :param func: lambda expression on how to perform transformation
+        :param max_workers: number of threads
+        :param ordered: keep the order of the source, otherwise results are yielded as soon as they are ready
+        :return: new Enumerable object containing transformed data
+        """
+        if func is None:
+            raise NullArgumentError("No function given for select_concurrent")
+        return self._derive('select_concurrent', func, max_workers, ordered)
 
+    def as_async(self, max_concurrency=100):
+        """
+        Returns an AsyncEnumerable over the elements, to chain asynchronous operators with async for
+        :param max_concurrency: default number of concurrent calls of the asynchronous operators
+        :return: AsyncEnumerable object
+        """
+        return AsyncEnumerable(self, max_concurrency)
 
     def sum(self, func=None):
         """
@@ -113,9 +472,7 @@ class Enumerable(object):
         :param func: lambda expression to transform data
         :return: sum of selected elements
         """
-        if func == None:
-            func = lambda x: x
-        return sum(self.select(func))
+        return sum(self._project(func))
 
     def min(self, func=None):
         """
@@ -123,21 +480,21 @@ class Enumerable(object):
         :param func: lambda expression to transform data
         :return: minimum value
         """
-        if func == None:
-            func = lambda x: x
-        if self.count() == 0:
+        result = min(self._project(func), default=_MISSING)
+        if result is _MISSING:
             raise NoElementsError("Iterable contains no elements")
-        return min(self.select(func))
+        return result
 
-    def max(self, func=lambda x: x):
+    def max(self, func=None):
         """
         Returns the max value of data elements
         :param func: lambda expression to transform data
         :return: maximum value
         """
-        if self.count() == 0:
+        result = max(self._project(func), default=_MISSING)
+        if result is _MISSING:
             raise NoElementsError("Iterable contains no elements")
-        return max(self.select(func))
+        return result
 
     def avg(self, func=None):
         """
@@ -145,12 +502,14 @@ class Enumerable(object):
         :param func: lambda expression to transform data
         :return: average value as float object
         """
-        if func == None:
-            func = lambda x: x
-        count = self.count()
+        count = 0
+        total = 0
+        for value in self._project(func):
+            total += value
+            count += 1
         if count == 0:
             raise NoElementsError("Iterable contains no elements")
-        return float(self.sum(func)) / float(count)
+        return float(total) / float(count)
 
     def median(self, func=None):
         """
@@ -158,14 +517,96 @@ class Enumerable(object):
         :param func: lambda expression to project and sort data
         :return: median value
         """
-        if func == None:
-            func = lambda x: x
-        if self.count() == 0:
-            raise NoElementsError("Iterable contains no elements")
-        result = self.order_by(func).select(func).to_list()
+        result = list(self._project(func))
         length = len(result)
+        if length == 0:
+            raise NoElementsError("Iterable contains no elements")
         i = int(length / 2)
-        return result[i] if length % 2 == 1 else (float(result[i - 1]) + float(result[i])) / float(2)
+        if length % 2 == 1:
+            return _quickselect(result, i)
+        return (float(_quickselect(result, i - 1)) + float(_quickselect(result, i))) / float(2)
+
+    def percentile(self, p, func=None):
+        """
+        Returns the p-th percentile of data elements, interpolating linearly between the two closest ranks (the
+        default method of numpy.percentile). Runs in expected O(n) time using quickselect.
+        :param p: percentile between 0 and 100
+        :param func: lambda expression to transform data
+        :return: percentile value
+        """
+        if not 0 <= p <= 100:
+            raise ValueError("percentile must be between 0 and 100")
+        result = list(self._project(func))
+        if len(result) == 0:
+            raise NoElementsError("Iterable contains no elements")
+        rank = (len(result) - 1) * p / 100.0
+        lower = int(rank)
+        value = _quickselect(result, lower)
+        if rank == lower:
+            return value
+        upper = _quickselect(result, lower + 1)
+        return float(value) + (float(upper) - float(value)) * (rank - lower)
+
+    def nth_element(self, n, key=None):
+        """
+        Returns the element at index n of the enumerable sorted by key, without sorting it. Equal keys keep their
+        original order, as in order_by. Runs in expected O(n) time using quickselect.
+            * Raises NoElementsError if no element found at specified position
+        :param n: index as int object
+        :param key: key to sort by as lambda expression
+        :return: Element at given index of the sorted enumerable
+        """
+        key = _selector(key)
+        elements = self.to_list()
+        if not 0 <= n < len(elements):
+            raise NoElementsError("No element found at index {0}".format(n))
+        # (key, index) pairs are unique, so elements themselves are never compared and ties keep their order
+        keys = elements if key is None else map(key, elements)
+        return elements[_quickselect([(k, i) for i, k in enumerate(keys)], n)[1]]
+
+    def approx_count_distinct(self, key=None, error=0.01):
+        """
+        Estimates the number of distinct keys in a single pass and constant memory, using a HyperLogLog sketch. Use
+        HyperLogLog directly to merge the counts of several enumerables (e.g. partitions of a dataset).
+        :param key: key selector as lambda expression
+        :param error: relative standard error of the estimate
+        :return: estimated number of distinct keys as int
+        """
+        return HyperLogLog(error).update(self._sketched(key)).count()
+
+    def approx_quantiles(self, qs, key=None, compression=100):
+        """
+        Estimates quantiles in a single pass and bounded memory, using a t-digest sketch. Estimates are most accurate
+        towards the extreme quantiles and exact while fewer elements than the compression have been seen; they
+        interpolate linearly between ranks, as percentile does. Use TDigest directly to merge several enumerables.
+            * Raises NoElementsError if the enumerable is empty
+        :param qs: list of quantiles between 0 and 1
+        :param key: lambda expression to transform data
+        :param compression: size of the sketch: about compression centroids are kept, larger is more accurate
+        :return: list of estimated quantile values, one per quantile
+        """
+        return TDigest(compression).update(self._sketched(key)).quantiles(qs)
+
+    def approx_top_k(self, k, key=None, error=0.001):
+        """
+        Returns the k most frequent keys with their counts in a single pass and constant memory, using the
+        Space-Saving algorithm. Counts are overestimated by at most error times the number of elements, so keys more
+        frequent than that are never missed. Use SpaceSaving directly to merge several enumerables.
+        :param k: number of keys to return
+        :param key: key selector as lambda expression
+        :param error: maximum overestimation of the counts, as a fraction of the number of elements
+        :return: list of (key, count) tuples, most frequent first
+        """
+        return SpaceSaving(error, k).update(self._project(key)).top(k)
+
+    def _sketched(self, key):
+        """
+        Values fed to a sketch: the numpy array itself for array data without key, so that the sketch can vectorize
+        """
+        values = self._project(key)
+        if values is self and _is_ndarray(self._data):
+            return self._data
+        return values
 
     def elementAt(self, n):
         """
@@ -174,10 +615,16 @@ class Enumerable(object):
         :param n: index as int object
         :return: Element at given index
         """
-        result = list(itertools.islice(self.to_list(), max(0, n), n + 1, 1))
-        if len(result) == 0:
+        result = _MISSING
+        sequence = self._sequence()
+        if sequence is not None:
+            if 0 <= n < len(sequence):
+                result = sequence[n]
+        elif n >= 0:
+            result = next(itertools.islice(self, n, n + 1, 1), _MISSING)
+        if result is _MISSING:
             raise NoElementsError("No element found at index {0}".format(n))
-        return result[0]
+        return result
 
     def elementAtOrDefault(self, n):
         """
@@ -197,30 +644,33 @@ class Enumerable(object):
         :param func: lambda expression to test data
         :return: data element as object or NoElementsError if transformed data contains no elements
         """
-        count = self.count()
-        if count == 0:
+        result = self._first(key)
+        if result is _MISSING:
             raise NoElementsError("Iterable contains no elements")
-
-        if key:
-            for item in self._data:
-                if key(item):
-                    return item
-            raise NoElementsError("Iterable contains no elements")
-        else:
-            return self.elementAt(0)
+        return result
 
     def first_or_default(self, key=None):
         """
         Return the first element
         :return: data element as object or None if transformed data contains no elements
         """
-        if key :
-            for item in self._data:
-                if key(item):
-                    return item
-            return None
-        else:
-            return self.elementAtOrDefault(0)
+        result = self._first(key)
+        return None if result is _MISSING else result
+
+    def _first(self, key):
+        """
+        Stops at the first element that satisfies key, so at most one pass over a prefix of the data is made
+        :param key: optional predicate as lambda expression
+        :return: matching element or the _MISSING sentinel
+        """
+        key = _selector(key)
+        if key is None:
+            # let the optimizer see the limit, e.g. order_by(...).first() becomes a single min pass
+            return next(iter(self.take(1)), _MISSING)
+        for item in self:
+            if key is None or key(item):
+                return item
+        return _MISSING
 
     def last(self, key=None):
         """
@@ -232,16 +682,10 @@ class Enumerable(object):
         # arbitrary unsorted
         # collection would produce wrong result
         #return Enumerable(sorted(self, key=None, reverse=True)).first()
-        count = self.count()
-        if count == 0:
+        result = self._last(key)
+        if result is _MISSING:
             raise NoElementsError("Iterable contains no elements")
-        #result = self._data[-1]
-        #return result;
-        for item in reversed(self._data):
-            if key is None or key(item):
-                return item
-        raise NoElementsError("Iterable contains no elements")
-            
+        return result
 
     def last_or_default(self, key=None):
         """
@@ -249,30 +693,94 @@ class Enumerable(object):
         :param func: lambda expression to test data
         :return: data element as object or None if transformed data contains no elements
         """
-        for item in reversed(self._data):
+        result = self._last(key)
+        return None if result is _MISSING else result
+
+    def _last(self, key):
+        """
+        Walks sequences backwards and anything else forwards, remembering the latest match
+        :param key: optional predicate as lambda expression
+        :return: matching element or the _MISSING sentinel
+        """
+        key = _selector(key)
+        sequence = self._sequence()
+        if sequence is not None:
+            for item in reversed(sequence):
+                if key is None or key(item):
+                    return item
+            return _MISSING
+        result = _MISSING
+        for item in self:
             if key is None or key(item):
-                return item
-        return None
+                result = item
+        return result
 
-    def order_by(self, key):
+    def order_by(self, key, budget=None):
         """
-        Returns new Enumerable sorted in ascending order by given key
+        Returns new Enumerable sorted in ascending order by given key. Ties can be broken with then_by and
+        then_by_descending on the result.
         :param key: key to sort by as lambda expression
-        :return: new Enumerable object
+        :param budget: maximum number of elements held in memory, see sort_budget. Defaults to the sort_budget of
+        this enumerable
+        :return: new OrderedEnumerable object
+        """
+        return self._order(key, False, budget)
+
+    def order_by_descending(self, key, budget=None):
+        """
+        Returns new Enumerable sorted in descending order by given key. Ties can be broken with then_by and
+        then_by_descending on the result.
+        :param key: key to sort by as lambda expression
+        :param budget: maximum number of elements held in memory, see sort_budget. Defaults to the sort_budget of
+        this enumerable
+        :return: new OrderedEnumerable object
         """
+        return self._order(key, True, budget)
+
+    def _order(self, key, descending, budget):
         if key is None:
             raise NullArgumentError("No key for sorting given")
-        return Enumerable(sorted(self, key=key))
+        if budget is None:
+            budget = self._setting('sort_budget')
+        if budget is None:
+            return OrderedEnumerable(_Query(self, 'order_by', _selector(key), descending))
+        return OrderedEnumerable(_Query(self, 'external_sort', budget, _selector(key), descending))
 
-    def order_by_descending(self, key):
+    def top_k(self, k, key=None):
         """
-        Returns new Enumerable sorted in descending order by given key
+        Returns new Enumerable with the k largest elements by key, in descending order. Equivalent to
+        order_by_descending(key).take(k) but runs in O(n log k) time and keeps at most k elements in memory.
+        :param k: number of elements to take
         :param key: key to sort by as lambda expression
         :return: new Enumerable object
         """
-        if key is None:
-            raise NullArgumentError("No key for sorting given")
-        return Enumerable(sorted(self, key=key, reverse=True))
+        return self._derive('top_k', k, _selector(key), True)
+
+    def bottom_k(self, k, key=None):
+        """
+        Returns new Enumerable with the k smallest elements by key, in ascending order. Equivalent to
+        order_by(key).take(k) but runs in O(n log k) time and keeps at most k elements in memory.
+        :param k: number of elements to take
+        :param key: key to sort by as lambda expression
+        :return: new Enumerable object
+        """
+        return self._derive('top_k', k, _selector(key), False)
+
+    def assume_sorted(self, key=None, descending=False):
+        """
+        Declares that the elements are already sorted by key, without sorting them. The data is trusted, not checked.
+        group_by and distinct on the same key then stream over runs of equal keys, and join, group_join, intersect
+        and except_ with another enumerable sorted the same way merge both inputs, all in constant memory. The order
+        of order_by, then_by and merge_sorted results is known without declaring it.
+
+        Usage:
+            Enumerable.from_csv('events.csv').assume_sorted('day').group_by(['day'], 'day')
+
+        :param key: key the elements are sorted by as lambda expression, None for the elements themselves
+        :param descending: whether the elements are sorted in descending order
+        :return: new Enumerable object
+        """
+        return self._derive('assume_sorted', _selector(key) or _identity, descending)
 
     def skip(self, n):
         """
@@ -280,7 +788,7 @@ class Enumerable(object):
         :param n: Number of elements to skip as int
         :return: new Enumerable object
         """
-        return Enumerable(itertools.islice(self, n, None, 1))
+        return self._derive('skip', n)
 
     def take(self, n):
         """
@@ -288,7 +796,7 @@ class Enumerable(object):
         :param n: Number of elements to take
         :return: new Enumerable object
         """
-        return Enumerable(itertools.islice(self, 0, n, 1))
+        return self._derive('take', n)
 
     def where(self, predicate):
         """
@@ -298,7 +806,7 @@ class Enumerable(object):
         """
         if predicate is None:
             raise NullArgumentError("No predicate given for where clause")
-        return Enumerable(filter(predicate, self))
+        return self._derive('where', (_selector(predicate),))
 
     def single(self, predicate):
         """
@@ -309,7 +817,9 @@ class Enumerable(object):
         :param predicate: predicate as a lambda expression
         :return: Matching element as object
         """
-        result = self.where(predicate).to_list()
+        if predicate is None:
+            raise NullArgumentError("No predicate given for single")
+        result = list(itertools.islice(filter(_selector(predicate), self), 2))
         count = len(result)
         if count == 0:
             raise NoMatchingElement("No matching element found")
@@ -336,9 +846,61 @@ class Enumerable(object):
         :param func: selector as lambda expression
         :return: new Enumerable object
         """
-        if func == None:
-            func = lambda x: x
-        return Enumerable(itertools.chain.from_iterable(self.select(func)))
+        func = _selector(func)
+        if func is None:
+            func = _identity
+        return self._derive('select_many', func)
+
+    def chunk(self, size):
+        """
+        Splits the elements into consecutive chunks of size elements, the last one possibly shorter. Chunks of sequence
+        or array data are views that copy nothing (sliced numpy arrays), chunks of anything else are lists filled
+        lazily.
+        :param size: number of elements per chunk
+        :return: new Enumerable object of chunks
+        """
+        if size < 1:
+            raise ValueError("chunk size must be a positive number")
+        return self._derive('chunk', size)
+
+    def window(self, size, step=1):
+        """
+        Returns the sliding windows of size consecutive elements, starting every step elements. Only full windows are
+        returned. Windows of sequence or array data are views that copy nothing, windows of anything else are lists
+        built lazily with at most one window of elements buffered.
+
+        Usage:
+            Enumerable([1, 2, 3, 4, 5]).window(3, 2).select(list).to_list() --> [[1, 2, 3], [3, 4, 5]]
+
+        :param size: number of elements per window
+        :param step: number of elements between the starts of two windows
+        :return: new Enumerable object of windows
+        """
+        if size < 1 or step < 1:
+            raise ValueError("window size and step must be positive numbers")
+        return self._derive('window', size, step)
+
+    def pairwise(self):
+        """
+        Returns the tuples of every two consecutive elements
+        :return: new Enumerable object of (previous, next) tuples
+        """
+        return self._derive('pairwise')
+
+    def select_batch(self, func, size=1000):
+        """
+        Transforms data a whole batch at a time, for functions that are cheaper on many elements at once (database
+        lookups, model scoring, numpy kernels). Batches are the chunks of chunk(size).
+        :param func: function of a batch of elements returning the transformed elements, one per element. A batch
+        with another number of results raises a ValueError; like select, count() does not call the function
+        :param size: number of elements per batch
+        :return: new Enumerable object
+        """
+        if func is None:
+            raise NullArgumentError("No function given for select_batch")
+        if size < 1:
+            raise ValueError("batch size must be a positive number")
+        return self._derive('select_batch', func, size)
 
     def add(self, element):
         """
@@ -354,24 +916,66 @@ class Enumerable(object):
         """
         Adds enumerable to an enumerable
         ** NOTE **
-        This operation can be expensive depending on the size of the enumerable to be concatenated. This is because
-        the concatenation algorithm performs type checking to ensure that the same object types are being added. If
-        the self enumerable has n elements and the enumerable to be added has m elements then the type checking
-        takes O(mn) time.
+        The concatenation performs type checking to ensure that the same object types are being added. With a declared
+        element_type the elements of the given enumerable must be instances of it; otherwise both enumerables must
+        hold elements of one and the same type. The types held by an enumerable are collected once and cached, the
+        result of concat inheriting them, so concatenating m elements takes O(m) time and chained add calls take
+        O(1) each. Enumerables built on a qlist, which can still be appended to, are read again on every check.
+        Enumerables that can only be read once (streams that are not cached, file sources) are never read
+        to collect their types: their elements are not checked. Set type_checking to False (on Enumerable, a subclass
+        or an instance) to skip the check.
         :param enumerable: An iterable object
         :return: new Enumerable object
         """
         enumerable = Enumerable._ensureEnumerable(enumerable)
-        
-        for element in enumerable._data:
-            element_type = type(element)
-            if self.any(lambda x: type(x) != element_type):
-                raise TypeError("type mismatch between concatenated enumerables")
-        return Enumerable(itertools.chain(self._data, enumerable._data))
+        types = None
+        if self.type_checking:
+            incoming = _element_types(enumerable)
+            if self.element_type is not None:
+                for element_type in incoming or ():
+                    if not issubclass(element_type, self.element_type):
+                        raise TypeError("cannot concatenate {0} elements to an enumerable of {1}".format(
+                            element_type.__name__, self.element_type.__name__))
+            else:
+                current = _element_types(self) if incoming is not _UNKNOWN_TYPES else _UNKNOWN_TYPES
+                if current is _UNKNOWN_TYPES or incoming is _UNKNOWN_TYPES:
+                    types = _UNKNOWN_TYPES
+                else:
+                    types = current | incoming
+                    if len(types) > 1 and incoming and current:
+                        raise TypeError("type mismatch between concatenated enumerables")
+        if isinstance(self._data, _Query) and self._data.op == 'concat':
+            # extend the concat node self is built on, so chained add calls keep a single flat chain
+            result = Enumerable(_Query(self._data.source, 'concat', self._data.args[0].append(enumerable)))
+        else:
+            result = self._derive('concat', _Chain([enumerable], 1))
+        result.element_type = self.element_type
+        if types is not None and not _volatile(self) and not _volatile(enumerable):
+            result._types = types
+        return result
+
+    def merge_sorted(self, *enumerables, key=None, descending=False):
+        """
+        Lazily merges enumerables sorted by the same key into one sorted enumerable, pulling one element at a time from
+        each of them (k-way merge). Equal elements keep the order of the enumerables given. Without a key, the order
+        self is known to be in is used (see assume_sorted), otherwise the elements themselves.
+        :param enumerables: iterable objects sorted like self
+        :param key: key the enumerables are sorted by as lambda expression
+        :param descending: whether the enumerables are sorted in descending order
+        :return: new Enumerable object
+        """
+        order = _sort_order(self) if key is None else None
+        if order is None:
+            order = (_selector(key) or _identity, descending)
+        enumerables = tuple(Enumerable._ensureEnumerable(enumerable) for enumerable in enumerables)
+        return self._derive('merge_sorted', enumerables, *order)
 
-    def group_by(self, key_names=[], key=None, result_func=None):
+    def group_by(self, key_names=[], key=None, result_func=None, budget=None):
         """
         Groups an enumerable on given key selector. Index of key name corresponds to index of key lambda function.
+        Grouping is hash based: keys only need to be hashable (see _KeyTable for unhashable keys), groups are built on
+        first iteration in a single pass and are yielded in first-seen key order. Data known to be sorted by key (see
+        assume_sorted) is grouped in a stream instead, holding one group at a time.
 
         Usage:
             Enumerable([1,2,3]).group_by(key_names=['id'], key=lambda x: x).to_list() --> Enumerable object [
@@ -394,95 +998,129 @@ class Enumerable(object):
 
         :param key_names: list of key names
         :param key: key selector as lambda expression
+        :param budget: maximum number of distinct keys held in memory, see group_budget. Defaults to the group_budget
+        of this enumerable
         :return: Enumerable of grouping objects
         """
-        if key == None:
-            key = lambda x: x
+        key = _selector(key)
+        if key is None:
+            key = _identity
+        if _sorted_by(self, key) is not None:
+            result = self._derive('sorted_group_by', key, key_names)
+        else:
+            if budget is None:
+                budget = self._setting('group_budget')
+            result = self._derive('group_by', key, key_names, budget)
+        return result if result_func is None else result.select(result_func)
 
-        if result_func == None:
-            result_func = lambda x: x
+    def to_lookup(self, key=None, value_func=None, key_names=None):
+        """
+        Groups the enumerable into a Lookup that can be indexed by key. Uses the same grouping engine as group_by.
 
-        result = []
-        ordered = self
-        try:
-            ordered = sorted(self, key=key)
-        except TypeError:
-            pass # in Python 3 dictionaries are no longer sortable so just continue unsorted
+        Usage:
+            lookup = Enumerable(orders).to_lookup(lambda o: o['customer'])
+            lookup['bob'].sum(lambda o: o['total'])
+
+        :param key: key selector as lambda expression
+        :param value_func: lambda expression to transform the elements stored for every key
+        :param key_names: list of key names of the Grouping objects yielded when iterating the lookup, ['key'] by default
+        :return: Lookup object
+        """
+        key = _selector(key)
+        if key is None:
+            key = _identity
+        return Lookup(_group(self, key, _selector(value_func)), key_names)
 
-        grouped = itertools.groupby(ordered, key)
-        for k, g in grouped:
-            can_enumerate = isinstance(k, list) or isinstance(k, tuple) and len(k) > 0
-            key_prop = {}
-            for i, prop in enumerate(key_names):
-                key_prop.setdefault(prop, k[i] if can_enumerate else k)
-            key_object = Key(key_prop)
-            result.append(Grouping(key_object, list(g)))
-        return Enumerable(result).select(result_func)
+    def to_dictionary(self, key=None, value_func=None):
+        """
+        Converts the iterable into a dict. Uses the same grouping engine as group_by.
+            * Raises MoreThanOneMatchingElement if two elements have the same key
+        :param key: key selector as lambda expression, must return hashable keys
+        :param value_func: lambda expression to transform the values of the dict
+        :return: dict object
+        """
+        key = _selector(key)
+        if key is None:
+            key = _identity
+        result = {}
+        for k, values in _group(self, key, _selector(value_func)):
+            if len(values) > 1:
+                raise MoreThanOneMatchingElement("More than one element found for key {0}".format(k))
+            result[k] = values[0]
+        return result
 
-    def distinct(self, key=None):
+    def distinct(self, key=None, budget=None):
         """
-        Returns enumerable containing elements that are distinct based on given key selector
+        Returns enumerable containing elements that are distinct based on given key selector. The first element seen
+        for every key is kept and elements are yielded lazily in their original order. Data known to be sorted by key
+        (see assume_sorted) only needs to remember the last key.
         :param key: key selector as lambda expression
+        :param budget: maximum number of distinct keys held in memory, see group_budget. Defaults to the group_budget
+        of this enumerable
         :return: new Enumerable object
         """
-        if key == None:
-            key = lambda x: x
-        return self.group_by(key=key).select(lambda g: g.first())
+        key = _selector(key)
+        if key is None:
+            key = _identity
+        if _sorted_by(self, key) is not None:
+            return self._derive('sorted_distinct', key)
+        if budget is None:
+            budget = self._setting('group_budget')
+        return self._derive('distinct', key, budget)
 
     def join(self, inner_enumerable, outer_key=None, inner_key=None, result_func=None):
         """
         Return enumerable of inner equi-join between two enumerables
+        ** NOTE **
+        The join is hash based: a dictionary is built over the keys of the smaller enumerable (the inner one when the
+        sizes are unknown) and the other enumerable is streamed against it, so the join takes O(n + m) time. Results
+        are ordered by outer element, then by inner element, as in LINQ. Enumerables both known to be sorted the same
+        way by their keys (see assume_sorted) are merge joined, holding only one run of equal inner keys in memory.
         :param inner_enumerable: inner enumerable to join to self
         :param outer_key: key selector of outer enumerable as lambda expression
         :param inner_key: key selector of inner enumerable as lambda expression
         :param result_func: lambda expression to transform result of join
         :return: new Enumerable object
         """
-        if outer_key == None:
-            outer_key = lambda x: x
-        if inner_key == None:
-            inner_key = lambda x: x
-        if  result_func == None:
-            result_func = lambda x: x
+        outer_key = _selector(outer_key) or _identity
+        inner_key = _selector(inner_key) or _identity
+        result_func = _selector(result_func) or _identity
 
         inner_enumerable = Enumerable._ensureEnumerable(inner_enumerable, 'inner_enumerable')
-        return Enumerable(itertools.product(filter(lambda x: outer_key(x) in map(inner_key, inner_enumerable), self),
-                          filter(lambda y: inner_key(y) in map(outer_key, self), inner_enumerable)))\
-                         .where(lambda x: outer_key(x[0]) == inner_key(x[1]))\
-                         .select(result_func)
+        descending = _merge_order(self, outer_key, inner_enumerable, inner_key)
+        if descending is not None:
+            return self._derive('merge_join', inner_enumerable, outer_key, inner_key, result_func, descending)
+        return self._derive('join', inner_enumerable, outer_key, inner_key, result_func)
 
     def default_if_empty(self, value=None):
         """
         Returns an enumerable containing a single None element if enumerable is empty, otherwise the enumerable itself
         :return: an Enumerable object
         """
-        if self.count() == 0:
+        if self._first(None) is _MISSING:
             return Enumerable([value])
         return self
 
     def group_join(self, inner_enumerable, outer_key=None, inner_key=None, result_func=None):
         """
         Return enumerable of group join between two enumerables
+        Every outer element is paired with an Enumerable of its matching inner elements, which is empty when nothing
+        matches (left outer semantics). The join is hash based, or a merge join of sorted inputs, see join.
         :param inner_enumerable: inner enumerable to join to self
         :param outer_key: key selector of outer enumerable as lambda expression
         :param inner_key: key selector of inner enumerable as lambda expression
         :param result_func: lambda expression to transform the result of group join
         :return: new Enumerable object
         """
-        if outer_key == None:
-            outer_key = lambda x: x
-        if inner_key == None:
-            inner_key = lambda x: x
-        if  result_func == None:
-            result_func = lambda x: x
+        outer_key = _selector(outer_key) or _identity
+        inner_key = _selector(inner_key) or _identity
+        result_func = _selector(result_func) or _identity
 
         inner_enumerable = Enumerable._ensureEnumerable(inner_enumerable, "inner enumerable")
-        return Enumerable(itertools.product(self, inner_enumerable.default_if_empty()))\
-                      .group_by(key_names=['id'], \
-                                key=lambda x: outer_key(x[0]), \
-                                result_func=lambda g: (g.first()[0], g.where(lambda x: inner_key(x[1]) == g.key.id)\
-                                                                      .select(lambda x: x[1])))\
-                      .select(result_func)
+        descending = _merge_order(self, outer_key, inner_enumerable, inner_key)
+        if descending is not None:
+            return self._derive('merge_group_join', inner_enumerable, outer_key, inner_key, result_func, descending)
+        return self._derive('group_join', inner_enumerable, outer_key, inner_key, result_func)
 
 
     def any(self, predicate=None):
@@ -491,21 +1129,26 @@ class Enumerable(object):
         :param predicate: condition to satisfy as lambda expression
         :return: boolean True or False
         """
+        predicate = _selector(predicate)
         if predicate is None:
-            predicate=lambda x: x
-        return self.where(predicate).count() > 0
+            return any(self)
+        return any(predicate(element) for element in self)
 
     def intersect(self, enumerable, key=None):
         """
-        Returns enumerable that is the intersection between given enumerable and self
+        Returns enumerable that is the intersection between given enumerable and self. Elements of self whose key is
+        found in the given enumerable are yielded once per key, in their original order. Enumerables both known to be
+        sorted the same way by key (see assume_sorted) are merged in constant memory.
         :param enumerable: enumerable object
         :param key: key selector as lambda expression
         :return: new Enumerable object
         """
-        if key == None:
-            key=lambda x: x
+        key = _selector(key) or _identity
         enumerable = Enumerable._ensureEnumerable(enumerable)
-        return self.join(enumerable, key, key, result_func=lambda x: x).distinct().select(lambda x: x[0])
+        descending = _merge_order(self, key, enumerable, key)
+        if descending is not None:
+            return self._derive('merge_intersect', enumerable, key, descending)
+        return self._derive('intersect', enumerable, key)
 
 
     def union(self, enumerable, key=None):
@@ -515,23 +1158,25 @@ class Enumerable(object):
         :param key: key selector used to determine uniqueness
         :return: new Enumerable object
         """
-        if key == None:
-            key=lambda x: x
+        key = _selector(key) or _identity
         enumerable = Enumerable._ensureEnumerable(enumerable)
         return self.concat(enumerable).distinct(key)
 
     def except_(self, enumerable, key=None):
         """
-        Returns enumerable that subtracts given enumerable elements from self
+        Returns enumerable that subtracts given enumerable elements from self. Elements of self whose key is not found
+        in the given enumerable are yielded in their original order, duplicates included. Enumerables both known to
+        be sorted the same way by key (see assume_sorted) are merged in constant memory.
         :param enumerable: enumerable object
         :param key: key selector as lambda expression
         :return: new Enumerable object
         """
-        if key == None:
-            key=lambda x: x
+        key = _selector(key) or _identity
         enumerable = Enumerable._ensureEnumerable(enumerable)
-        membership = (0 if key(element) in enumerable.intersect(self).select(key) else 1 for element in self)
-        return Enumerable(itertools.compress(self, membership))
+        descending = _merge_order(self, key, enumerable, key)
+        if descending is not None:
+            return self._derive('merge_except', enumerable, key, descending)
+        return self._derive('except', enumerable, key)
 
     def contains(self, element, key=None):
         """
@@ -540,53 +1185,2862 @@ class Enumerable(object):
         :param key: key selector to use for membership comparison
         :return: boolean True or False
         """
-        if key == None:
-            key=lambda x: x
-        return self.select(key).any(lambda x: x == key(element))
+        key = _selector(key)
+        if key is None:
+            return any(x == element for x in self)
+        value = key(element)
+        return any(key(x) == value for x in self)
 
-class Key(object):
-    def __init__(self, key, **kwargs):
-        """
-        Constructor for Key class. Autogenerates key properties in object given dict or kwargs
-        :param key: dict of name-values
-        :param kwargs: optional keyword arguments
-        :return: void
-        """
-        key = key if key is not None else kwargs
-        self.__dict__.update(key)
+class _ReplayBuffer(object):
+    """
+    Data of an Enumerable with the 'replay' cache policy. Elements are pulled from the source iterator on demand,
+    appended to a buffer shared by all iterators and replayed from there, so the source is only iterated once however
+    many (possibly concurrent, possibly abandoned) iterators there are. Only pulling from the source takes the lock
+    of the buffer; replaying buffered elements is lock free.
+    """
+    __slots__ = ('buffer', 'exhausted', '_source', '_iterator', '_lock')
+
+    def __init__(self, source):
+        self.buffer = []
+        self.exhausted = False
+        self._source = source
+        self._iterator = None
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        buffer = self.buffer
+        i = 0
+        while True:
+            if i < len(buffer):
+                yield buffer[i]
+                i += 1
+                continue
+            with self._lock:
+                if i < len(buffer):
+                    continue
+                if self.exhausted:
+                    return
+                if self._iterator is None:
+                    self._iterator = iter(self._source)
+                try:
+                    buffer.append(next(self._iterator))
+                except StopIteration:
+                    self.exhausted = True
+                    self._source = self._iterator = None
+                    return
 
     def __repr__(self):
-        return self.__dict__.__repr__()
+        # only what is buffered: the source may be endless or larger than memory
+        if self.exhausted:
+            return self.buffer.__repr__()
+        return "{0!r} ({1} elements buffered)".format(self._source, len(self.buffer))
 
-class Grouping(Enumerable):
-    def __init__(self, key, data):
+
+class _FrozenKey(tuple):
+    """
+    Hashable stand-in for an unhashable key. Never equal to a plain tuple, so a frozen list cannot collide with a
+    genuine tuple key.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return isinstance(other, _FrozenKey) and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = tuple.__hash__
+
+
+def _freeze(value):
+    """
+    Returns a hashable value that compares equal exactly when the given values compare equal.
+        * hashable values are returned as is
+        * dicts become frozensets of their (frozen) items, sets become frozensets
+        * lists and tuples become tuples of their (frozen) elements
+    Raises TypeError if the value cannot be frozen (e.g. an object defining __eq__ without __hash__)
+    :param value: key as returned by a key selector
+    :return: hashable object
+    """
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if isinstance(value, dict):
+        return _FrozenKey(('dict', frozenset((k, _freeze(v)) for k, v in value.items())))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    if isinstance(value, list):
+        return _FrozenKey(('list', tuple(_freeze(v) for v in value)))
+    if isinstance(value, tuple):
+        return _FrozenKey(('tuple', tuple(_freeze(v) for v in value)))
+    raise TypeError("unhashable key of type {0}".format(type(value).__name__))
+
+
+class _KeyTable(object):
+    """
+    Dictionary keyed by the results of a key selector, used by the hash based operators.
+    Strategy for unhashable keys:
+        * keys that can be frozen (dicts, lists, sets and tuples of those) are looked up through _freeze in O(1)
+        * any other unhashable key is kept in a list and found by equality, which is linear in the number of such keys
+    """
+    __slots__ = ('_hashed', '_unhashable')
+
+    def __init__(self):
+        self._hashed = {}
+        self._unhashable = []
+
+    def get(self, key, default=None):
+        try:
+            return self._hashed.get(_freeze(key), default)
+        except TypeError:
+            for k, v in self._unhashable:
+                if k == key:
+                    return v
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self._hashed.setdefault(_freeze(key), default)
+        except TypeError:
+            for k, v in self._unhashable:
+                if k == key:
+                    return v
+            self._unhashable.append((key, default))
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def add(self, key):
         """
-        Constructor of Grouping class used for group by operations of Enumerable class
-        :param key: Key instance
-        :param data: iterable object
-        :return: void
+        Set style insertion
+        :param key: key to add
+        :return: True if the key was not in the table yet
         """
-        if not isinstance(key, Key):
-            raise Exception("key argument should be a Key instance")
-        self.key = key
-        super(Grouping, self).__init__(data)
+        length = len(self)
+        self.setdefault(key, True)
+        return len(self) > length
 
-    def __repr__(self):
-        return {
-            'key': self.key.__repr__(),
-            'enumerable': self._data.__repr__()
-        }.__repr__()
+    def discard(self, key):
+        """
+        Set style removal
+        :param key: key to remove
+        :return: True if the key was in the table
+        """
+        try:
+            return self._hashed.pop(_freeze(key), _MISSING) is not _MISSING
+        except TypeError:
+            for i, (k, v) in enumerate(self._unhashable):
+                if k == key:
+                    del self._unhashable[i]
+                    return True
+            return False
 
-class NoElementsError(Exception): pass
-class NullArgumentError(Exception): pass
-class NoMatchingElement(Exception): pass
-class MoreThanOneMatchingElement(Exception): pass
+    def __len__(self):
+        return len(self._hashed) + len(self._unhashable)
 
 
-class qlist(Enumerable): 
+# types of an enumerable that cannot be read to collect them, see _element_types
+_UNKNOWN_TYPES = frozenset([None])
+
+
+def _element_types(enumerable):
     """
-        Short named version of py_linq.Enumerable. It stands for 'queryable list'.
+    Returns the set of the types of the elements of an enumerable, collected on first use and cached on it. Enumerables
+    that can only be read once are not read: their types are _UNKNOWN_TYPES. The types of enumerables built on a
+    qlist are collected again every time, as the qlist can be appended to after they are built.
+    :param enumerable: Enumerable object
+    :return: frozenset of types
+    """
+    if enumerable._types is not None:
+        return enumerable._types
+    types = frozenset(map(type, enumerable)) if _reiterable(enumerable) else _UNKNOWN_TYPES
+    if isinstance(enumerable, qlist) or not _volatile(enumerable):
+        # a qlist keeps the types of its own elements up to date, see qlist.append
+        enumerable._types = types
+    return types
+
+
+def _volatile(enumerable):
+    """
+    Returns True if the elements of an enumerable can change after it is built: it is a qlist or reads one
+    :param enumerable: Enumerable object
+    :return: boolean
+    """
+    if isinstance(enumerable, qlist):
+        return True
+    if enumerable._types is not None:
+        # types are only cached on enumerables that are not volatile
+        return False
+    root, steps = enumerable._plan()
+    if isinstance(root, qlist) or isinstance(root._data, Enumerable) and _volatile(root._data):
+        return True
+    return any(_volatile(other) for other in _read_enumerables(steps))
+
+
+def _read_enumerables(steps):
+    """
+    Returns the enumerables the operators of a plan read besides their input, such as the ones given to concat or join
+    :param steps: list of (op, args) tuples
+    :return: generator of Enumerable objects
+    """
+    for op, args in steps:
+        for arg in args:
+            if isinstance(arg, _Chain):
+                arg = tuple(arg)
+            for other in (arg if isinstance(arg, tuple) else (arg,)):
+                if isinstance(other, Enumerable):
+                    yield other
+
+
+def _reiterable(enumerable):
     """
-    def __init__(self, data=[]): 
-        super().__init__(data)
-        pass
\ No newline at end of file
+    Returns True if an enumerable can be iterated without losing elements for later iterations, and without reading a
+    file: its data and the enumerables its operators read are collections or replay buffers
+    :param enumerable: Enumerable object
+    :return: boolean
+    """
+    root, steps = enumerable._plan()
+    data = root._data
+    if isinstance(data, Enumerable):
+        if not _reiterable(data):
+            return False
+    elif isinstance(data, _FileSource) or not isinstance(data, (Collection, _ReplayBuffer)):
+        return False
+    return all(other._types is not None or _reiterable(other) for other in _read_enumerables(steps))
+
+
+class _Chain(object):
+    """
+    Enumerables appended by concat. Chained concat and add calls share one list, each concat node seeing the prefix
+    of it that was appended when the node was built, so appending does not copy the enumerables before it.
+    """
+    __slots__ = ('_parts', '_count')
+
+    _lock = threading.Lock()
+
+    def __init__(self, parts, count):
+        self._parts = parts
+        self._count = count
+
+    def append(self, enumerable):
+        """
+        :param enumerable: Enumerable object
+        :return: new _Chain object ending with enumerable
+        """
+        with _Chain._lock:
+            parts = self._parts
+            if len(parts) != self._count:
+                # another node was already built on this one: branch off with a copy
+                parts = parts[:self._count]
+            parts.append(enumerable)
+            return _Chain(parts, len(parts))
+
+    def __iter__(self):
+        return itertools.islice(self._parts, self._count)
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return "{0} enumerable{1}".format(self._count, "" if self._count == 1 else "s")
+
+
+def _identity(element):
+    return element
+
+
+def _selector(spec):
+    """
+    Compiles a field spec into a key selector, so that common keys run as C level getters instead of lambdas:
+        * None and callables are returned as they are
+        * a string or int picks an item: 'id' is x['id'], 0 is x[0]
+        * a dotted string picks an attribute path: 'user.id' is x.user.id; a leading dot picks a plain attribute:
+          '.id' is x.id
+        * a tuple of specs picks a tuple of values: ('id', 'name') is (x['id'], x['name'])
+    :param spec: field spec
+    :return: function or None
+    """
+    if spec is None or callable(spec):
+        return spec
+    if isinstance(spec, str):
+        return operator.attrgetter(spec.lstrip('.')) if '.' in spec else operator.itemgetter(spec)
+    if isinstance(spec, int):
+        return operator.itemgetter(spec)
+    if isinstance(spec, tuple):
+        if len(spec) > 1 and all(isinstance(field, int) or isinstance(field, str) and '.' not in field
+                                 for field in spec):
+            return operator.itemgetter(*spec)
+        getters = [_selector(field) for field in spec]
+        if None in getters:
+            raise TypeError("invalid field spec {0!r}".format(spec))
+        return lambda element: tuple(getter(element) for getter in getters)
+    raise TypeError("invalid field spec {0!r}".format(spec))
+
+
+def _known_length(iterable):
+    """
+    Returns the number of elements of an iterable if it can be known without iterating, otherwise None
+    :param iterable: Enumerable or iterable object
+    :return: int or None
+    """
+    if isinstance(iterable, Enumerable):
+        return _plan_length(*iterable._plan())
+    return len(iterable) if isinstance(iterable, Sized) else None
+
+
+def _group(iterable, key, value_func=None):
+    """
+    Hash grouping engine behind group_by, to_lookup and to_dictionary. Only needs hashable (or freezable) keys and
+    makes a single pass over the data.
+    :param iterable: iterable object
+    :param key: key selector
+    :param value_func: optional lambda expression to transform the grouped elements
+    :return: list of (key, list of elements) tuples in first-seen key order
+    """
+    table = _KeyTable()
+    groups = []
+    for element in iterable:
+        k = key(element)
+        values = table.get(k)
+        if values is None:
+            values = table.setdefault(k, [])
+            groups.append((k, values))
+        values.append(element if value_func is None else value_func(element))
+    return groups
+
+
+def _key_factory(key_names):
+    """
+    Returns a function building the Key object of a group, naming the parts of the grouping key after key_names.
+    Keys are compact namedtuples (see _key_class) unless the names cannot be namedtuple fields.
+    :param key_names: list of key names
+    :return: function of a grouping key returning a Key object
+    """
+    cls = _key_class(tuple(key_names))
+    count = len(key_names)
+
+    def make_key(k):
+        can_enumerate = isinstance(k, list) or isinstance(k, tuple) and len(k) > 0
+        if cls is not None:
+            return cls._make(k[i] for i in range(count)) if can_enumerate else cls._make((k,) * count)
+        key_prop = {}
+        for i, prop in enumerate(key_names):
+            key_prop.setdefault(prop, k[i] if can_enumerate else k)
+        return Key(key_prop)
+    return make_key
+
+
+@functools.lru_cache(maxsize=None)
+def _key_class(names):
+    """
+    Returns a namedtuple type with given field names, registered as a virtual subclass of Key. Its instances have no
+    __dict__, compare by value, print like a Key and pickle through _rebuild_key.
+    :param names: tuple of key names
+    :return: type or None if the names are not unique identifiers usable as namedtuple fields
+    """
+    if len(set(names)) != len(names) or not all(isinstance(name, str) and name.isidentifier() and
+                                                not keyword.iskeyword(name) and not name.startswith('_')
+                                                for name in names):
+        return None
+    cls = type('Key', (collections.namedtuple('Key', names),), {
+        '__slots__': (),
+        '__repr__': lambda self: dict(zip(self._fields, self)).__repr__(),
+        '__reduce__': lambda self: (_rebuild_key, (self._fields, tuple(self)))
+    })
+    Key.register(cls)
+    return cls
+
+
+def _rebuild_key(names, values):
+    """
+    Unpickles a key built by _key_class, whose generated type cannot be pickled by reference
+    :param names: tuple of key names
+    :param values: tuple of key values
+    :return: key object
+    """
+    return _key_class(names)._make(values)
+
+
+def _groupings(iterable, key, key_names, budget):
+    """
+    Deferred group_by: groups are only built once the result is iterated
+    :param iterable: iterable object
+    :param key: key selector
+    :param key_names: list of key names
+    :param budget: maximum number of distinct keys in memory, see _bounded_group. None never spills
+    :return: generator of Grouping objects
+    """
+    make_key = _key_factory(key_names)
+    if budget is not None:
+        for k, values in _bounded_group(iterable, key, budget, False):
+            yield Grouping(make_key(k), tuple(values))
+        return
+    groups = _group(iterable, key)
+    groups.reverse()
+    while groups:
+        # exact size tuples replace the growing lists one group at a time
+        k, values = groups.pop()
+        yield Grouping(make_key(k), tuple(values))
+
+
+def _sorted_groupings(iterable, key, key_names):
+    """
+    Streaming group_by of data sorted by key: every run of equal keys is a group, so one group is held at a time
+    :param iterable: iterable object sorted by key
+    :param key: key selector
+    :param key_names: list of key names
+    :return: generator of Grouping objects
+    """
+    make_key = _key_factory(key_names)
+    for k, values in itertools.groupby(iterable, key):
+        yield Grouping(make_key(k), tuple(values))
+
+
+def _sorted_distinct(iterable, key):
+    """
+    Streaming distinct of data sorted by key: yields the first element of every run of equal keys
+    :param iterable: iterable object sorted by key
+    :param key: key selector
+    :return: generator
+    """
+    for k, values in itertools.groupby(iterable, key):
+        yield next(values)
+
+
+def _distinct(iterable, key, budget):
+    """
+    Streaming distinct: yields the first element seen for every key
+    :param iterable: iterable object
+    :param key: key selector
+    :param budget: maximum number of distinct keys in memory, see _bounded_group. None never spills
+    :return: generator
+    """
+    if budget is not None:
+        for k, element in _bounded_group(iterable, key, budget, True):
+            yield element
+        return
+    seen = _KeyTable()
+    for element in iterable:
+        if seen.add(key(element)):
+            yield element
+
+
+# buffer size of the file sources, see Enumerable.from_lines
+_READ_BUFFER = 1 << 20
+
+
+class _FileSource(object):
+    """
+    Data of the file sources: every iteration reopens the file and parses the lines of its byte range again
+    """
+    __slots__ = ('path', 'start', 'end', 'parse', 'options')
+
+    def __init__(self, path, start, end, parse, *options):
+        if start < 0 or end is not None and end < start:
+            raise ValueError("invalid byte range {0}-{1}".format(start, end))
+        self.path = path
+        self.start = start
+        self.end = end
+        self.parse = parse
+        self.options = options
+
+    def __iter__(self):
+        with open(self.path, 'rb', buffering=_READ_BUFFER) as f:
+            yield from self.parse(self, _LineReader(f, self.start), *self.options)
+
+    def __repr__(self):
+        return "{0}({1!r}, {2}, {3})".format(self.parse.__name__[len('_parse_'):], self.path, self.start, self.end)
+
+
+class _LineReader(object):
+    """
+    Iterator over the raw lines of a binary file, from the first line starting at or after a byte offset, keeping
+    track of the offset of the next line
+    """
+    __slots__ = ('lines', 'position')
+
+    def __init__(self, f, start):
+        if start > 0:
+            # the line holding the byte before start belongs to the previous range
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        self.lines = iter(f)
+        self.position = start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.lines)
+        self.position += len(line)
+        return line
+
+
+def _in_range(source, lines):
+    """
+    Yields the lines of a _LineReader starting before the end of the byte range of a _FileSource
+    """
+    end = source.end
+    while end is None or lines.position < end:
+        line = next(lines, None)
+        if line is None:
+            return
+        yield line
+
+
+def _parse_lines(source, lines, encoding):
+    for line in _in_range(source, lines):
+        yield line.decode(encoding).rstrip('\r\n')
+
+
+def _parse_jsonl(source, lines, fields):
+    import json
+    for line in _in_range(source, lines):
+        if line.strip():
+            value = json.loads(line)
+            yield value if fields is None else {field: value.get(field) for field in fields}
+
+
+def _parse_csv(source, lines, encoding, header, fields, fmtparams):
+    import csv
+    reader = csv.reader((line.decode(encoding) for line in lines), **fmtparams)
+    names = None
+    if header:
+        if source.start > 0:
+            with open(source.path, newline='', encoding=encoding) as f:
+                names = next(csv.reader(f, **fmtparams), None)
+        else:
+            names = next(reader, None)
+        if names is None:
+            return
+    if fields is not None:
+        columns = [names.index(field) for field in fields] if header else list(fields)
+        names = fields if header else None
+    else:
+        columns = range(len(names)) if header else None
+    while source.end is None or lines.position < source.end:
+        row = next(reader, None)
+        if row is None:
+            return
+        if not row:
+            continue
+        if columns is not None:
+            row = [row[i] if i < len(row) else None for i in columns]
+        yield row if names is None else dict(zip(names, row))
+
+
+# buffer size and number of elements encoded at once by the file sinks, see Enumerable.to_file
+_WRITE_BUFFER = 1 << 20
+_WRITE_BATCH = 1000
+
+_COMPRESSIONS = {
+    None: lambda path: open(path, 'wb', buffering=_WRITE_BUFFER),
+    'gzip': lambda path: importlib.import_module('gzip').open(path, 'wb'),
+    'bz2': lambda path: importlib.import_module('bz2').open(path, 'wb'),
+    'lzma': lambda path: importlib.import_module('lzma').open(path, 'wb'),
+}
+_COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma', '.lzma': 'lzma'}
+
+
+def _write_file(iterable, path, encode, encoding, compression, atomic):
+    """
+    Streams an iterable into a file in batches of _WRITE_BATCH elements
+    :param iterable: iterable object
+    :param path: path of the file
+    :param encode: function turning a list of elements into text
+    :param encoding: text encoding
+    :param compression: key of _COMPRESSIONS or 'infer'
+    :param atomic: write to a temporary file renamed to path once complete, removed on failure
+    :return: WriteResult object
+    """
+    import random
+    if compression == 'infer':
+        compression = _COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if compression not in _COMPRESSIONS:
+        raise ValueError("unknown compression {0!r}".format(compression))
+    target = "{0}.{1:016x}.tmp".format(path, random.getrandbits(64)) if atomic else path
+    rows = 0
+    try:
+        with _COMPRESSIONS[compression](target) as f:
+            iterator = iter(iterable)
+            batch = list(itertools.islice(iterator, _WRITE_BATCH))
+            while batch:
+                f.write(encode(batch).encode(encoding))
+                rows += len(batch)
+                batch = list(itertools.islice(iterator, _WRITE_BATCH))
+        size = os.path.getsize(target)
+        if atomic:
+            os.replace(target, path)
+    except BaseException:
+        if atomic and os.path.exists(target):
+            os.remove(target)
+        raise
+    return WriteResult(rows, size)
+
+
+class _CsvEncoder(object):
+    """
+    Batch encoder of Enumerable.to_csv, writing the header with the first batch
+    """
+    def __init__(self, fields, header, fmtparams):
+        import csv
+        self.fields = fields
+        self.header = header
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, **fmtparams)
+        self.dicts = None
+
+    def __call__(self, batch):
+        if self.dicts is None:
+            self.dicts = isinstance(batch[0], dict)
+            if self.fields is None and self.dicts:
+                self.fields = list(batch[0].keys())
+            if self.header and self.fields is not None:
+                self.writer.writerow(self.fields)
+        if self.dicts:
+            self.writer.writerows([element.get(field, '') for field in self.fields] for element in batch)
+        else:
+            self.writer.writerows(batch)
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+
+# number of temporary files the data is partitioned into when group_by or distinct spill, and how many times a
+# partition still holding too many keys is partitioned again before it is grouped in memory regardless
+_SPILL_PARTITIONS = 64
+_SPILL_MAX_DEPTH = 3
+
+
+def _bounded_group(iterable, key, budget, first_only):
+    """
+    Grouping engine holding at most budget keys in memory. Groups are built in memory until a new key would cross the
+    budget; from then on the groups built so far and the rest of the data are written to partitions by key hash, see
+    _spill_groups. Yields the same groups, in the same first-seen key order, as _group.
+    :param iterable: iterable object of picklable elements
+    :param key: key selector returning picklable keys
+    :param budget: maximum number of keys in memory
+    :param first_only: keep only the first element of every group (distinct) instead of a list of all of them. Those
+    are yielded as soon as they are seen while the keys fit in memory
+    :return: generator of (key, list of elements or first element) tuples
+    """
+    if budget < 1:
+        raise ValueError("group_budget must be a positive number")
+    table = _KeyTable()
+    groups = []
+    iterator = iter(iterable)
+    for index, element in enumerate(iterator):
+        k = key(element)
+        values = table.get(k, _MISSING)
+        if values is _MISSING:
+            if len(table) == budget:
+                break
+            if first_only:
+                table.add(k)
+                yield k, element
+                continue
+            values = table.setdefault(k, [])
+            groups.append((index, k, values))
+        if not first_only:
+            values.append(element)
+    else:
+        for index, k, values in groups:
+            yield k, values
+        return
+
+    def records():
+        # (sequence number, key, element) records: the first record of every key carries its first-seen position
+        for first, group_key, values in groups:
+            for value in values:
+                yield first, group_key, value
+        del groups[:]
+        yield index, k, element
+        for position, item in enumerate(iterator, index + 1):
+            item_key = key(item)
+            if not first_only or item_key not in table:
+                yield position, item_key, item
+
+    if not first_only:
+        table = None
+    for group in _spill_groups(records(), budget, first_only, 0):
+        yield group[1:]
+
+
+def _spill_groups(records, budget, first_only, depth):
+    """
+    Writes (sequence number, key, element) records to temporary partitions by key hash, groups every partition in
+    memory in turn (partitioning it again if it still holds more than budget keys) into a run sorted by sequence
+    number, and lazily merges the runs back into first-seen order
+    :param records: iterable of (sequence number, key, element) tuples
+    :param budget: maximum number of keys in memory
+    :param first_only: keep only the first element of every group
+    :param depth: number of times the records were partitioned already
+    :return: generator of (sequence number, key, values) tuples
+    """
+    import pickle
+    import tempfile
+    partitions = [tempfile.TemporaryFile() for i in range(_SPILL_PARTITIONS)]
+    runs = []
+    try:
+        batches = [[] for partition in partitions]
+        for record in records:
+            i = _partition(record[1], depth)
+            batches[i].append(record)
+            if len(batches[i]) == _SPILL_BATCH:
+                pickle.dump(batches[i], partitions[i], pickle.HIGHEST_PROTOCOL)
+                batches[i] = []
+        for batch, partition in zip(batches, partitions):
+            pickle.dump(batch, partition, pickle.HIGHEST_PROTOCOL)
+        for partition in partitions:
+            groups = _group_records(_read_run(partition), None if depth == _SPILL_MAX_DEPTH else budget, first_only)
+            if groups is None:
+                groups = _spill_groups(_read_run(partition), budget, first_only, depth + 1)
+            runs.append(_write_run(groups))
+            partition.close()
+        for group in heapq.merge(*map(_read_run, runs), key=_first_item):
+            yield group
+    finally:
+        for f in partitions + runs:
+            f.close()
+
+
+def _partition(key, depth):
+    """
+    Partition of a key at given depth of _spill_groups. Keys that cannot be frozen all share the first partition.
+    """
+    try:
+        return hash((depth, _freeze(key))) % _SPILL_PARTITIONS
+    except TypeError:
+        return 0
+
+
+def _group_records(records, budget, first_only):
+    """
+    Groups (sequence number, key, element) records in memory
+    :param records: iterable of (sequence number, key, element) tuples
+    :param budget: maximum number of keys, None for no limit
+    :param first_only: keep only the first element of every group
+    :return: list of (sequence number, key, values) tuples in first-seen order, None if there are more keys than budget
+    """
+    table = _KeyTable()
+    groups = []
+    for first, k, element in records:
+        values = table.get(k, _MISSING)
+        if values is _MISSING:
+            if len(table) == budget:
+                return None
+            if first_only:
+                table.add(k)
+                groups.append((first, k, element))
+                continue
+            values = table.setdefault(k, [])
+            groups.append((first, k, values))
+        if not first_only:
+            values.append(element)
+    return groups
+
+
+def _intersect(first, second, key, descending=None):
+    """
+    Streaming intersection: hashes the keys of second, then yields elements of first whose key is found, once per key.
+    Inputs both sorted by key are merged instead, see _merge_keys
+    :param first: iterable object to stream
+    :param second: iterable object to hash
+    :param key: key selector
+    :param descending: sort order of both inputs, None if they are not sorted
+    :return: generator
+    """
+    if descending is not None:
+        for k, values, found in _merge_keys(first, second, key, descending):
+            if found:
+                yield next(values)
+        return
+    keys = _KeyTable()
+    for element in second:
+        keys.add(key(element))
+    for element in first:
+        if keys.discard(key(element)):
+            yield element
+
+
+def _except(first, second, key, descending=None):
+    """
+    Streaming difference: hashes the keys of second, then yields elements of first whose key is not found. Inputs both
+    sorted by key are merged instead, see _merge_keys
+    :param first: iterable object to stream
+    :param second: iterable object to hash
+    :param key: key selector
+    :param descending: sort order of both inputs, None if they are not sorted
+    :return: generator
+    """
+    if descending is not None:
+        for k, values, found in _merge_keys(first, second, key, descending):
+            if not found:
+                yield from values
+        return
+    keys = _KeyTable()
+    for element in second:
+        keys.add(key(element))
+    for element in first:
+        if key(element) not in keys:
+            yield element
+
+
+def _merge_keys(first, second, key, descending):
+    """
+    Merge engine behind intersect and except_ of inputs sorted by key: walks the runs of equal keys of first and the
+    keys of second once, side by side, holding a single key of second
+    :param first: iterable object sorted by key
+    :param second: iterable object sorted by key
+    :param key: key selector
+    :param descending: sort order of both inputs
+    :return: generator of (key, iterator over the run of elements of first, whether second holds the key) tuples
+    """
+    before = operator.gt if descending else operator.lt
+    keys = map(key, second)
+    other = next(keys, _MISSING)
+    for k, values in itertools.groupby(first, key):
+        while other is not _MISSING and before(other, k):
+            other = next(keys, _MISSING)
+        yield k, values, other is not _MISSING and other == k
+
+
+def _join(outer, inner, outer_key, inner_key, result_func, descending=None):
+    """
+    Join stage: flattens the buckets of the hash join engine, or of the merge join engine for sorted inputs
+    :return: generator
+    """
+    for element, matches in _join_buckets(outer, inner, outer_key, inner_key, descending):
+        for match in matches:
+            yield result_func((element, match))
+
+
+def _group_join(outer, inner, outer_key, inner_key, result_func, descending=None):
+    """
+    Group join stage: pairs every outer element with an Enumerable of its matches
+    :return: generator
+    """
+    for element, matches in _join_buckets(outer, inner, outer_key, inner_key, descending):
+        yield result_func((element, Enumerable(matches)))
+
+
+def _join_buckets(outer, inner, outer_key, inner_key, descending=None):
+    """
+    Hash join engine behind join and group_join. Yields every outer element, in order, with the list of inner
+    elements whose key matches, in inner order. The dictionary is built over the smaller side when both lengths are
+    known, otherwise over the inner side while the outer side is streamed. Inputs both sorted by their keys are merge
+    joined instead, see _merge_buckets.
+    :param outer: outer Enumerable
+    :param inner: inner Enumerable
+    :param outer_key: key selector of outer enumerable
+    :param inner_key: key selector of inner enumerable
+    :param descending: sort order of both inputs, None if they are not sorted
+    :return: generator of (outer element, list of inner elements) tuples
+    """
+    if descending is not None:
+        yield from _merge_buckets(outer, inner, outer_key, inner_key, descending)
+        return
+    outer_length = _known_length(outer)
+    inner_length = _known_length(inner)
+    if outer_length is not None and inner_length is not None and outer_length < inner_length:
+        outer = list(outer)
+        positions = _KeyTable()
+        for i, element in enumerate(outer):
+            positions.setdefault(outer_key(element), []).append(i)
+        matches = {}
+        for element in inner:
+            for i in positions.get(inner_key(element), ()):
+                matches.setdefault(i, []).append(element)
+        for i, element in enumerate(outer):
+            yield element, matches.get(i, ())
+    else:
+        table = _KeyTable()
+        for element in inner:
+            table.setdefault(inner_key(element), []).append(element)
+        for element in outer:
+            yield element, table.get(outer_key(element), ())
+
+
+def _merge_buckets(outer, inner, outer_key, inner_key, descending):
+    """
+    Merge join engine: walks both inputs once, side by side, holding a single run of inner elements with equal keys
+    :return: generator of (outer element, list of inner elements) tuples, as _join_buckets
+    """
+    before = operator.gt if descending else operator.lt
+    pairs = ((inner_key(element), element) for element in inner)
+    pending = next(pairs, None)
+    for k, elements in itertools.groupby(outer, outer_key):
+        while pending is not None and before(pending[0], k):
+            pending = next(pairs, None)
+        run = []
+        while pending is not None and pending[0] == k:
+            run.append(pending[1])
+            pending = next(pairs, None)
+        for element in elements:
+            yield element, run
+
+
+def _where(iterable, predicates):
+    """
+    Where stage. Adjacent where clauses are merged by the optimizer into a single filter over all their predicates.
+    :param iterable: iterable object
+    :param predicates: tuple of predicates
+    :return: iterator
+    """
+    if len(predicates) == 1:
+        return filter(predicates[0], iterable)
+
+    def predicate(element):
+        for p in predicates:
+            if not p(element):
+                return False
+        return True
+    return filter(predicate, iterable)
+
+
+class _SequenceView(Sequence):
+    """
+    Lazy view of the elements of a sequence at a range of indexes. skip, take and reverse over sequences return views,
+    so nothing is copied and the result can still be indexed and measured in O(1). Views compare equal to lists,
+    tuples and views holding equal elements, as the lists chunk and window build from streams do.
+    """
+    __slots__ = ('base', 'indices')
+
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return _SequenceView(self.base, self.indices[i])
+        return self.base[self.indices[i]]
+
+    def __iter__(self):
+        return map(self.base.__getitem__, self.indices)
+
+    def __reversed__(self):
+        return map(self.base.__getitem__, reversed(self.indices))
+
+    def __eq__(self, other):
+        if not isinstance(other, (_SequenceView, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return list(self).__repr__()
+
+
+def _slice(sequence, s):
+    """
+    Slices a sequence without copying it
+    :param sequence: Sequence object
+    :param s: slice object
+    :return: Sequence object
+    """
+    if isinstance(sequence, (_SequenceView, range)):
+        return sequence[s]
+    return _SequenceView(sequence, range(len(sequence))[s])
+
+
+def _skip(iterable, n):
+    """
+    Skip stage: sequences are sliced, anything else is advanced lazily
+    :return: Sequence object or iterator
+    """
+    if isinstance(iterable, Sequence) and _is_count(n):
+        return _slice(iterable, slice(n, None))
+    return itertools.islice(iterable, n, None, 1)
+
+
+def _take(iterable, n):
+    """
+    Take stage: sequences are sliced, anything else is cut lazily
+    :return: Sequence object or iterator
+    """
+    if isinstance(iterable, Sequence) and _is_count(n):
+        return _slice(iterable, slice(None, n))
+    return itertools.islice(iterable, 0, n, 1)
+
+
+def _reverse(iterable):
+    """
+    Reverse stage: sequences are walked backwards, anything else is buffered first
+    :param iterable: iterable object
+    :return: Sequence object or iterator
+    """
+    if isinstance(iterable, Sequence):
+        return _slice(iterable, slice(None, None, -1))
+    return reversed(list(iterable))
+
+
+def _quickselect(values, n):
+    """
+    Returns sorted(values)[n] in expected O(len(values)) time. Each round partitions around a random pivot and keeps
+    only the part holding index n.
+    :param values: list of comparable values, not modified
+    :param n: index into the sorted values
+    :return: value
+    """
+    import random
+    while True:
+        pivot = values[random.randrange(len(values))]
+        lows = [v for v in values if v < pivot]
+        if n < len(lows):
+            values = lows
+            continue
+        highs = [v for v in values if pivot < v]
+        if n < len(values) - len(highs):
+            return pivot
+        n -= len(values) - len(highs)
+        values = highs
+
+
+class _Reversed(object):
+    """
+    Sort key wrapper inverting the order of the wrapped key, so descending keys can be sorted along with ascending ones
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _sort_key(keys):
+    """
+    Combines the sort keys of an order_by step into a single key computing every key once per element
+    :param keys: flat tuple of key, descending, key, descending... as given to order_by and then_by
+    :return: tuple of (key function, reverse flag) for sorted
+    """
+    if len(keys) == 2:
+        return keys
+    pairs = [(keys[i], keys[i + 1]) for i in range(0, len(keys), 2)]
+    descending = keys[1]
+    if all(d == descending for key, d in pairs):
+        funcs = [key for key, d in pairs]
+        return lambda element: tuple(func(element) for func in funcs), descending
+    return lambda element: tuple(_Reversed(key(element)) if d else key(element) for key, d in pairs), False
+
+
+def _order_by(iterable, *keys):
+    """
+    Order by stage: a single stable sort in memory over all keys of an order_by / then_by chain
+    :param iterable: iterable object
+    :param keys: flat tuple of key, descending, key, descending...
+    :return: list object
+    """
+    key, descending = _sort_key(keys)
+    return sorted(iterable, key=key, reverse=descending)
+
+
+def _external_order_by(iterable, budget, *keys):
+    """
+    Order by stage of a query with a sort budget, see _external_sort
+    :param iterable: iterable object
+    :param budget: maximum number of elements in memory
+    :param keys: flat tuple of key, descending, key, descending...
+    :return: generator
+    """
+    key, descending = _sort_key(keys)
+    return _external_sort(iterable, key, descending, budget)
+
+
+def _order_keys(op, args):
+    """
+    Returns the flat tuple of key, descending, key, descending... of an order_by or external_sort step
+    """
+    return args[1:] if op == 'external_sort' else args
+
+
+# maximum number of sorted runs merged at once, more runs are merged in several passes
+_MERGE_FAN_IN = 64
+
+
+def _external_sort(iterable, key, descending, budget):
+    """
+    Stable sort keeping at most budget elements in memory. The input is cut into runs of budget elements, each run is
+    sorted and written with its keys to a temporary file, and the runs are merged lazily with heapq.merge, which
+    prefers earlier runs on ties. Inputs fitting the budget are sorted in memory. Temporary files are removed when the
+    generator is exhausted or closed.
+    :param iterable: iterable object of picklable elements
+    :param key: sort key
+    :param descending: True to sort in descending order
+    :param budget: maximum number of elements in memory
+    :return: generator
+    """
+    if budget < 1:
+        raise ValueError("sort_budget must be a positive number")
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, budget))
+    if len(chunk) < budget:
+        yield from sorted(chunk, key=key, reverse=descending)
+        return
+    runs = []
+    try:
+        while chunk:
+            decorated = [(key(element), element) for element in chunk]
+            del chunk
+            decorated.sort(key=_first_item, reverse=descending)
+            runs.append(_write_run(decorated))
+            del decorated
+            chunk = list(itertools.islice(iterator, budget))
+        while len(runs) > _MERGE_FAN_IN:
+            merged = _write_run(heapq.merge(*map(_read_run, runs[:_MERGE_FAN_IN]), key=_first_item,
+                                            reverse=descending))
+            for run in runs[:_MERGE_FAN_IN]:
+                run.close()
+            runs[:_MERGE_FAN_IN] = [merged]
+        for item in heapq.merge(*map(_read_run, runs), key=_first_item, reverse=descending):
+            yield item[1]
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _first_item(pair):
+    return pair[0]
+
+
+# number of records pickled together in temporary files
+_SPILL_BATCH = 256
+
+
+def _write_run(pairs):
+    """
+    Writes records, e.g. (key, element) pairs, to an anonymous temporary file, deleted once closed
+    :param pairs: iterable of tuples
+    :return: file object
+    """
+    import pickle
+    import tempfile
+    run = tempfile.TemporaryFile()
+    iterator = iter(pairs)
+    batch = list(itertools.islice(iterator, _SPILL_BATCH))
+    while batch:
+        pickle.dump(batch, run, pickle.HIGHEST_PROTOCOL)
+        batch = list(itertools.islice(iterator, _SPILL_BATCH))
+    return run
+
+
+def _read_run(run):
+    """
+    Reads back the records written by _write_run
+    :param run: file object
+    :return: generator
+    """
+    import pickle
+    run.seek(0)
+    while True:
+        try:
+            batch = pickle.load(run)
+        except EOFError:
+            return
+        yield from batch
+
+
+def _merge_sorted(iterable, enumerables, *keys):
+    """
+    Merge sorted stage: k-way merge of sorted inputs keeping one element of each in memory
+    :param iterable: iterable object
+    :param enumerables: tuple of the other iterable objects
+    :param keys: flat tuple of key, descending, key, descending... the inputs are sorted by
+    :return: iterator
+    """
+    key, descending = _sort_key(keys)
+    return heapq.merge(iterable, *enumerables, key=None if key is _identity else key, reverse=descending)
+
+
+def _sort_order(enumerable):
+    """
+    Returns the order the elements of an enumerable are known to be in: the keys of the order_by, external_sort,
+    assume_sorted, merge_sorted or top_k step its plan ends with, looking through steps that keep the order
+    :param enumerable: Enumerable object
+    :return: flat tuple of key, descending, key, descending... or None if the order is not known
+    """
+    root, steps = enumerable._plan()
+    for op, args in reversed(steps):
+        if op in ('order_by', 'assume_sorted'):
+            return args
+        if op in ('external_sort', 'top_k', 'merge_sorted'):
+            return args[1:]
+        if op not in _ORDER_PRESERVING:
+            return None
+    return None
+
+
+def _sorted_by(enumerable, key):
+    """
+    Returns whether the elements of an enumerable are known to be sorted by key in descending order, so that equal keys
+    are adjacent
+    :param enumerable: Enumerable object
+    :param key: key selector
+    :return: True or False, or None if the elements are not known to be sorted by key
+    """
+    order = _sort_order(enumerable)
+    if order is None or not _same_key(order[0], key):
+        return None
+    return order[1]
+
+
+def _merge_order(first, first_key, second, second_key):
+    """
+    Returns the common sort order of two enumerables to be merged by their keys
+    :return: descending flag, or None if they are not both known to be sorted the same way
+    """
+    descending = _sorted_by(first, first_key)
+    if descending is None or _sorted_by(second, second_key) != descending:
+        return None
+    return descending
+
+
+def _same_key(first, second):
+    """
+    Returns True for the same key selector, or for two getters compiled from the same field spec (see _selector)
+    """
+    if first is second:
+        return True
+    return type(first) is type(second) and type(first) in (operator.itemgetter, operator.attrgetter) and \
+        first.__reduce__() == second.__reduce__()
+
+
+def _same_order(first, second):
+    """
+    Returns True if two flat tuples of key, descending, key, descending... describe the same order
+    """
+    return len(first) == len(second) and all(
+        _same_key(first[i], second[i]) and first[i + 1] == second[i + 1] for i in range(0, len(first), 2))
+
+
+def _top_k(iterable, k, *keys):
+    """
+    Top-k stage that order_by(...).take(k) is rewritten to. Takes O(n log k) time and keeps k elements in memory,
+    with the same (stable) result as sorting and taking the first k elements.
+    :param iterable: iterable object
+    :param k: number of elements to keep
+    :param keys: flat tuple of key, descending, key, descending... as in the order_by step
+    :return: list object
+    """
+    key, descending = _sort_key(keys)
+    if descending:
+        return heapq.nlargest(k, iterable, key=key)
+    return heapq.nsmallest(k, iterable, key=key)
+
+
+class _ParallelOptions(object):
+    """
+    Execution options of a ParallelEnumerable, see Enumerable.as_parallel
+    """
+    __slots__ = ('workers', 'chunk_size', 'ordered', 'threshold')
+
+    def __init__(self, workers=None, chunk_size=1000, ordered=True, threshold=None):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive number")
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.threshold = chunk_size if threshold is None else threshold
+
+    def __repr__(self):
+        return "workers={0}, chunk_size={1}, ordered={2}".format(self.workers, self.chunk_size, self.ordered)
+
+
+def _apply(kind, func, iterable):
+    """
+    Runs a parallel operator lazily over an iterable
+    :param kind: 'select', 'where', 'select_many' or 'foreach'
+    :param func: function given to the operator
+    :param iterable: iterable object
+    :return: iterator
+    """
+    if kind == 'select':
+        return map(func, iterable)
+    if kind == 'where':
+        return filter(func, iterable)
+    if kind == 'select_many':
+        return itertools.chain.from_iterable(map(func, iterable))
+    for element in iterable:
+        func(element)
+    return iter(())
+
+
+def _run_chunk(kind, func, chunk):
+    """
+    Runs a parallel operator over one chunk of elements. Executed in the worker processes.
+    :param kind: 'select', 'where', 'select_many' or 'foreach'
+    :param func: picklable function given to the operator
+    :param chunk: list of elements pickled by _pickled_chunks
+    :return: list of resulting elements
+    """
+    import pickle
+    return list(_apply(kind, func, pickle.loads(chunk)))
+
+
+def _pickled_chunks(kind, chunks):
+    """
+    Pickles every chunk in the calling process, so an element that cannot be sent to the workers raises a TypeError
+    there instead of breaking the process pool
+    :param kind: operator run by _run_chunk
+    :param chunks: iterable of lists of elements
+    :return: generator of bytes objects
+    """
+    import pickle
+    for chunk in chunks:
+        try:
+            yield pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise TypeError("elements of a parallel {0} cannot be sent to worker processes, use as_sequential() ({1})"
+                            .format(kind, e))
+
+
+def _parallel(iterable, kind, func, options):
+    """
+    Parallel stage of a ParallelEnumerable. Falls back to running the operator serially when fewer than
+    options.threshold elements are available.
+    :param iterable: iterable object
+    :param kind: operator run by _run_chunk
+    :param func: function given to the operator
+    :param options: _ParallelOptions object
+    :return: generator
+    """
+    import pickle
+    iterator = iter(iterable)
+    head = list(itertools.islice(iterator, options.threshold))
+    if len(head) < options.threshold or options.workers == 1:
+        for element in _apply(kind, func, itertools.chain(head, iterator)):
+            yield element
+        return
+    try:
+        pickle.dumps(func)
+    except Exception as e:
+        raise TypeError("{0} function {1} cannot be sent to worker processes, use a module level function instead "
+                        "of a lambda or closure, or as_sequential() ({2})"
+                        .format(kind, getattr(func, '__name__', func), e))
+
+    from concurrent.futures import ProcessPoolExecutor
+    chunks = _pickled_chunks(kind, _chunks(itertools.chain(head, iterator), options.chunk_size))
+    pool = ProcessPoolExecutor(max_workers=options.workers)
+    results = _submit_windowed(pool, functools.partial(_run_chunk, kind, func), chunks, 2 * options.workers,
+                               options.ordered)
+    for chunk in results:
+        for element in chunk:
+            yield element
+
+
+def _submit_windowed(pool, func, items, window, ordered):
+    """
+    Calls func on every item in an executor keeping at most window calls in flight, so memory stays bounded however
+    long (or infinite) items is. The executor is shut down when the results are exhausted or abandoned, without
+    waiting for the calls in flight when an error is raised.
+    :param pool: concurrent.futures executor
+    :param func: function to call
+    :param items: iterable of arguments
+    :param window: maximum number of submitted calls whose result has not been yielded yet
+    :param ordered: yield results in the order of items, otherwise as soon as they complete
+    :return: generator of results
+    """
+    from concurrent import futures
+    items = iter(items)
+    wait = True
+    try:
+        pending = collections.deque(pool.submit(func, item) for item in itertools.islice(items, window))
+        while pending:
+            if ordered:
+                done = pending.popleft()
+            else:
+                done = next(futures.as_completed(pending))
+                pending.remove(done)
+            item = next(items, _MISSING)
+            if item is not _MISSING:
+                pending.append(pool.submit(func, item))
+            yield done.result()
+    except Exception:
+        # waiting on a broken process pool can block forever, let the error through instead
+        wait = False
+        raise
+    finally:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _select_concurrent(iterable, func, max_workers, ordered):
+    """
+    Concurrent select stage: runs func in a thread pool with at most two calls per thread in flight
+    :param iterable: iterable object
+    :param func: function given to select_concurrent
+    :param max_workers: number of threads
+    :param ordered: keep the order of the source
+    :return: generator
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    return _submit_windowed(ThreadPoolExecutor(max_workers=max_workers), func, iterable, 2 * max_workers, ordered)
+
+
+def _chunks(iterable, size):
+    """
+    Splits an iterable into lists of size elements, the last one possibly shorter
+    :param iterable: iterable object
+    :param size: number of elements per list
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _view(data, start, stop):
+    """
+    Slices a sequence or numpy array without copying it. Ranges are viewed too, so that chunks and windows of any
+    sequence are views
+    """
+    if isinstance(data, range):
+        return _SequenceView(data, range(len(data))[start:stop])
+    if isinstance(data, Sequence):
+        return _slice(data, slice(start, stop))
+    return data[start:stop]
+
+
+def _chunk(iterable, size):
+    """
+    Chunk stage: views of sliceable data, lazily filled lists otherwise
+    :return: generator
+    """
+    if _is_sliceable(iterable):
+        return (_view(iterable, i, i + size) for i in range(0, len(iterable), size))
+    return _chunks(iterable, size)
+
+
+def _window(iterable, size, step):
+    """
+    Window stage: views of sliceable data, otherwise lists copied from a buffer of the last size elements
+    :return: generator
+    """
+    if _is_sliceable(iterable):
+        return (_view(iterable, i, i + size) for i in range(0, len(iterable) - size + 1, step))
+    return _stream_windows(iterable, size, step)
+
+
+def _stream_windows(iterable, size, step):
+    iterator = iter(iterable)
+    window = collections.deque(itertools.islice(iterator, size), maxlen=size)
+    while len(window) == size:
+        yield list(window)
+        if step < size:
+            added = list(itertools.islice(iterator, step))
+            if len(added) < step:
+                return
+            window.extend(added)
+        else:
+            # drop the elements between two windows
+            collections.deque(itertools.islice(iterator, step - size), maxlen=0)
+            window.clear()
+            window.extend(itertools.islice(iterator, size))
+
+
+def _pairwise(iterable):
+    """
+    Pairwise stage
+    :return: generator of (previous, next) tuples
+    """
+    iterator = iter(iterable)
+    previous = next(iterator, _MISSING)
+    if previous is _MISSING:
+        return
+    for element in iterator:
+        yield previous, element
+        previous = element
+
+
+def _select_batch(iterable, func, size):
+    """
+    Batch select stage: calls func on every chunk and flattens the results. Results that are not sized (e.g.
+    generators) are collected into a list, so that every batch is checked to give one result per element, as count
+    relies on (see _LENGTH_PRESERVING)
+    :return: generator
+    """
+    for batch in _chunk(iterable, size):
+        results = func(batch)
+        if not isinstance(results, Sized):
+            results = list(results)
+        if len(results) != len(batch):
+            raise ValueError("select_batch function returned {0} results for {1} elements".format(
+                len(results), len(batch)))
+        yield from results
+
+
+# operator name -> function(input iterable, *args) returning the output iterable
+_STAGES = {
+    'select': lambda iterable, func: map(func, iterable),
+    'where': _where,
+    'skip': _skip,
+    'take': _take,
+    'order_by': _order_by,
+    'external_sort': _external_order_by,
+    'top_k': _top_k,
+    'reverse': _reverse,
+    'chunk': _chunk,
+    'window': _window,
+    'pairwise': _pairwise,
+    'select_batch': _select_batch,
+    'select_many': lambda iterable, func: itertools.chain.from_iterable(map(func, iterable)),
+    'concat': lambda iterable, chain: itertools.chain(iterable, itertools.chain.from_iterable(chain)),
+    'group_by': _groupings,
+    'distinct': _distinct,
+    'intersect': _intersect,
+    'except': _except,
+    'join': _join,
+    'group_join': _group_join,
+    'assume_sorted': lambda iterable, key, descending: iterable,
+    'merge_sorted': _merge_sorted,
+    'sorted_group_by': _sorted_groupings,
+    'sorted_distinct': _sorted_distinct,
+    'merge_intersect': _intersect,
+    'merge_except': _except,
+    'merge_join': _join,
+    'merge_group_join': _group_join,
+    'parallel': _parallel,
+    'select_concurrent': _select_concurrent,
+}
+
+# operators that never change the number of elements
+_LENGTH_PRESERVING = ('select', 'order_by', 'external_sort', 'reverse', 'select_concurrent', 'select_batch', 'assume_sorted')
+
+# steps sorting the data, in memory or within a sort budget
+_SORTS = ('order_by', 'external_sort')
+# operators that keep the elements they yield in the order of their input, see _sort_order
+_ORDER_PRESERVING = ('where', 'skip', 'take', 'distinct', 'sorted_distinct', 'intersect', 'merge_intersect', 'except',
+                     'merge_except')
+
+
+def _is_count(n):
+    return isinstance(n, int) and n >= 0
+
+
+def _optimize(steps):
+    """
+    Rewrites a list of (op, args) plan steps into an equivalent but cheaper one. Identity selects are dropped, then
+    rules are applied until none matches:
+        * where after order_by or reverse is pushed below it, so fewer elements are sorted or buffered
+        * order_by of data already sorted the same way (order_by or assume_sorted) is dropped
+        * adjacent order_by clauses become one sort, the earlier keys breaking ties of the later ones
+        * adjacent where clauses are merged into one filter
+        * adjacent skip clauses are added up, adjacent take clauses keep the smaller count
+        * order_by followed by take(k) becomes a top_k(k), followed by skip(s).take(k) a top_k(s + k) and a skip(s)
+    order_by rules also apply to external_sort, the order_by of a query with a sort budget
+    :param steps: list of (op, args) tuples
+    :return: new list of (op, args) tuples
+    """
+    # identity projections (select() without a function) do nothing
+    steps = [(op, args) for op, args in steps if op != 'select' or args[0] is not _identity]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(steps) - 1):
+            op, args = steps[i]
+            next_op, next_args = steps[i + 1]
+            if op == 'where' and next_op == 'where':
+                steps[i:i + 2] = [('where', (args[0] + next_args[0],))]
+            elif op in _SORTS + ('assume_sorted',) and next_op in _SORTS and \
+                    _same_order(_order_keys(op, args), _order_keys(next_op, next_args)):
+                del steps[i + 1]
+            elif op in _SORTS and next_op in _SORTS:
+                # the later sort decides where it runs, in memory or within its budget
+                steps[i:i + 2] = [(next_op, next_args + _order_keys(op, args))]
+            elif op in _SORTS + ('reverse',) and next_op == 'where':
+                steps[i:i + 2] = [steps[i + 1], steps[i]]
+            elif op == next_op == 'skip' and _is_count(args[0]) and _is_count(next_args[0]):
+                steps[i:i + 2] = [('skip', (args[0] + next_args[0],))]
+            elif op == next_op == 'take' and _is_count(args[0]) and _is_count(next_args[0]):
+                steps[i:i + 2] = [('take', (min(args[0], next_args[0]),))]
+            elif op in _SORTS and next_op == 'take' and _is_count(next_args[0]):
+                steps[i:i + 2] = [('top_k', (next_args[0],) + _order_keys(op, args))]
+            elif op in _SORTS and next_op == 'skip' and _is_count(next_args[0]) and i + 2 < len(steps) \
+                    and steps[i + 2][0] == 'take' and _is_count(steps[i + 2][1][0]):
+                skipped = next_args[0]
+                steps[i:i + 3] = [('top_k', (skipped + steps[i + 2][1][0],) + _order_keys(op, args)), ('skip', (skipped,))]
+            else:
+                continue
+            changed = True
+            break
+    return steps
+
+
+def _plan_length(root, steps):
+    """
+    Infers the number of elements a plan yields without executing it
+    :param root: Enumerable holding the actual data
+    :param steps: list of (op, args) tuples
+    :return: int or None if the length cannot be known without iterating
+    """
+    data = root._data
+    if isinstance(data, _ReplayBuffer) and data.exhausted:
+        data = data.buffer
+    length = _known_length(data)
+    for op, args in steps:
+        if length is None:
+            break
+        if op in _LENGTH_PRESERVING:
+            continue
+        if op == 'skip' and _is_count(args[0]):
+            length = max(0, length - args[0])
+        elif op in ('take', 'top_k') and _is_count(args[0]):
+            length = min(length, args[0])
+        elif op == 'chunk':
+            length = -(-length // args[0])
+        elif op == 'window':
+            length = 0 if length < args[0] else (length - args[0]) // args[1] + 1
+        elif op == 'pairwise':
+            length = max(0, length - 1)
+        elif op in ('concat', 'merge_sorted'):
+            for enumerable in args[0]:
+                other = _known_length(enumerable)
+                length = None if length is None or other is None else length + other
+        else:
+            length = None
+    return length
+
+
+def _source(root):
+    """
+    Data a plan starts from: sequences and arrays are read directly, so that skip, take, reverse, chunk and window
+    can slice them, anything else is iterated through root
+    :param root: Enumerable holding the actual data
+    :return: Sequence object, numpy array or root
+    """
+    data = root._data
+    if isinstance(data, _ReplayBuffer) and data.exhausted:
+        data = data.buffer
+    return data if _is_sliceable(data) else root
+
+
+def _is_sliceable(data):
+    return isinstance(data, Sequence) or _is_ndarray(data)
+
+
+def _execute(root, steps):
+    """
+    Runs plan steps over the data of root
+    :param root: Enumerable holding the actual data
+    :param steps: list of (op, args) tuples
+    :return: iterator
+    """
+    if Enumerable.profiler is not None:
+        return _execute_profiled(root, steps, Enumerable.profiler)
+    stream = _source(root)
+    for op, args in steps:
+        stream = _STAGES[op](stream, *args)
+    return iter(stream)
+
+
+class StageProfile(object):
+    """
+    What a single operator of a query did during one execution, see Enumerable.profile
+        * elements_in: number of elements pulled from the upstream operator (None for the source)
+        * elements_out: number of elements emitted
+        * seconds: time spent in the operator itself, upstream operators excluded
+        * calls: number of calls of the functions given to the operator
+    """
+    __slots__ = ('op', 'description', 'elements_in', 'elements_out', 'calls', 'setup_seconds', 'pull_seconds',
+                 'seconds')
+
+    def __init__(self, op, description):
+        self.op = op
+        self.description = description
+        self.elements_in = None
+        self.elements_out = 0
+        self.calls = 0
+        # time spent building the operator (eager ones do all their work here) and producing its elements,
+        # upstream operators included
+        self.setup_seconds = 0.0
+        self.pull_seconds = 0.0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return "{0}  [in {1}, out {2}, calls {3}, {4:.3f} ms]".format(
+            self.description, '-' if self.elements_in is None else self.elements_in, self.elements_out, self.calls,
+            self.seconds * 1000)
+
+
+class QueryProfile(object):
+    """
+    Profile of one query execution: a StageProfile per operator, starting from the data source
+    """
+    __slots__ = ('stages',)
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    @property
+    def seconds(self):
+        return sum(stage.seconds for stage in self.stages)
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def __repr__(self):
+        return "\n".join(repr(stage) for stage in self.stages)
+
+
+class _CountingCall(object):
+    """
+    Function wrapper counting calls into a StageProfile
+    """
+    __slots__ = ('func', 'stage')
+
+    def __init__(self, func, stage):
+        self.func = func
+        self.stage = stage
+
+    def __call__(self, *args):
+        self.stage.calls += 1
+        return self.func(*args)
+
+
+class _TimedIterator(object):
+    """
+    Iterator wrapper counting the elements an operator emits and the time spent producing them, upstream included.
+    The last one of a query finalizes the profile and hands it to the callback when exhausted or abandoned.
+    """
+    __slots__ = ('iterator', 'stage', 'profile', 'callback')
+
+    def __init__(self, iterator, stage, profile=None, callback=None):
+        self.iterator = iterator
+        self.stage = stage
+        self.profile = profile
+        self.callback = callback
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            element = next(self.iterator)
+        except StopIteration:
+            self.stage.pull_seconds += time.perf_counter() - start
+            self._report()
+            raise
+        self.stage.pull_seconds += time.perf_counter() - start
+        self.stage.elements_out += 1
+        return element
+
+    def _report(self):
+        if self.callback is None:
+            return
+        callback, self.callback = self.callback, None
+        previous = None
+        for stage in self.profile.stages:
+            stage.seconds = stage.setup_seconds + stage.pull_seconds
+            if previous is not None:
+                stage.seconds -= previous.pull_seconds
+                stage.elements_in = previous.elements_out
+            previous = stage
+        callback(self.profile)
+
+    def __del__(self):
+        self._report()
+
+
+def _counted(arg, stage):
+    if isinstance(arg, tuple):
+        return tuple(_counted(a, stage) for a in arg)
+    if callable(arg) and not isinstance(arg, Enumerable):
+        return _CountingCall(arg, stage)
+    return arg
+
+
+def _execute_profiled(root, steps, callback):
+    """
+    Runs plan steps like _execute, wrapping every operator in a _TimedIterator and every function argument in a
+    _CountingCall. Functions run in worker processes (parallel stages) are not counted.
+    :param root: Enumerable holding the actual data
+    :param steps: list of (op, args) tuples
+    :param callback: callable receiving the QueryProfile once the query is exhausted or abandoned
+    :return: iterator
+    """
+    source = StageProfile('source', "source: " + _describe_source(root))
+    stream = _TimedIterator(iter(_source(root)), source)
+    profile = QueryProfile([source])
+    for op, args in steps:
+        stage = StageProfile(op, "-> {0}({1})".format(op, _describe(args)))
+        if op != 'parallel':
+            args = _counted(args, stage)
+        start = time.perf_counter()
+        # eager operators (order_by...) do their work right here
+        iterator = iter(_STAGES[op](stream, *args))
+        stage.setup_seconds += time.perf_counter() - start
+        stream = _TimedIterator(iterator, stage)
+        profile.stages.append(stage)
+    stream.profile = profile
+    stream.callback = callback
+    return stream
+
+
+def _describe_plan(root, steps):
+    """
+    Describes a plan one operator per line, for Enumerable.explain and the repr of queries
+    """
+    lines = ["source: " + _describe_source(root)]
+    for op, args in steps:
+        lines.append("-> {0}({1})".format(op, _describe(args)))
+    return "\n".join(lines)
+
+
+def _describe_source(root):
+    """
+    Short description of the data of a root Enumerable for Enumerable.explain
+    """
+    length = _plan_length(root, [])
+    if isinstance(root._data, _ReplayBuffer):
+        source = 'replay buffer'
+    elif isinstance(root._data, _FileSource):
+        source = repr(root._data)
+    else:
+        source = type(root._data).__name__
+    return source + ("" if length is None else " (length {0})".format(length))
+
+
+def _describe(arg):
+    """
+    Short description of an operator argument for Enumerable.explain
+    """
+    if isinstance(arg, tuple):
+        return ", ".join(_describe(a) for a in arg)
+    if isinstance(arg, Enumerable):
+        return type(arg).__name__
+    if callable(arg):
+        return getattr(arg, '__name__', type(arg).__name__)
+    return repr(arg)
+
+
+class _Query(object):
+    """
+    Deferred plan node used as the data of an Enumerable produced by an operator. Holds the operator and the
+    Enumerable it reads from. Iterating a node optimizes the whole chain of nodes behind it and runs it as a single
+    pipeline; nothing is cached, so a query is executed again every time it is iterated.
+    """
+    __slots__ = ('source', 'op', 'args')
+
+    def __init__(self, source, op, *args):
+        self.source = source
+        self.op = op
+        self.args = args
+
+    def __iter__(self):
+        root, steps = self.source._plan()
+        steps.append((self.op, self.args))
+        return _execute(root, _optimize(steps))
+
+    def __repr__(self):
+        # describes the plan as written rather than running the query, which could be slow, large or endless
+        root, steps = self.source._plan()
+        steps.append((self.op, self.args))
+        return _describe_plan(root, steps)
+
+
+class Key(object, metaclass=abc.ABCMeta):
+    """
+    Key of a Grouping, exposing the parts of the grouping key as attributes named after the key names given to
+    group_by. The keys built by group_by are compact namedtuples registered as virtual subclasses of Key.
+    """
+    def __init__(self, key=None, **kwargs):
+        """
+        Constructor for Key class. Autogenerates key properties in object given dict or kwargs
+        :param key: dict of name-values
+        :param kwargs: optional keyword arguments
+        :return: void
+        """
+        key = key if key is not None else kwargs
+        self.__dict__.update(key)
+
+    def __repr__(self):
+        return self.__dict__.__repr__()
+
+class Grouping(Enumerable):
+    __slots__ = ('key',)
+
+    def __init__(self, key, data):
+        """
+        Constructor of Grouping class used for group by operations of Enumerable class
+        :param key: Key instance
+        :param data: iterable object
+        :return: void
+        """
+        if not isinstance(key, Key):
+            raise Exception("key argument should be a Key instance")
+        self.key = key
+        if isinstance(data, (list, tuple)):
+            # the groups built by group_by skip the generic constructor
+            self._data = data
+        else:
+            super(Grouping, self).__init__(data)
+
+    def __repr__(self):
+        return {
+            'key': self.key.__repr__(),
+            'enumerable': self._data.__repr__()
+        }.__repr__()
+
+class Lookup(Enumerable):
+    def __init__(self, groups, key_names=None):
+        """
+        Constructor of Lookup class returned by Enumerable.to_lookup. Iterating a lookup yields Grouping objects in
+        first-seen key order, indexing it by key yields the elements of that key.
+        :param groups: list of (key, list of elements) tuples
+        :param key_names: list of key names of the yielded Grouping objects, ['key'] by default
+        :return: void
+        """
+        if key_names is None:
+            key_names = ['key']
+        self._table = _KeyTable()
+        for k, values in groups:
+            self._table.setdefault(k, values)
+        make_key = _key_factory(key_names)
+        super(Lookup, self).__init__([Grouping(make_key(k), values) for k, values in groups])
+
+    def __getitem__(self, key):
+        """
+        Returns the elements stored for given key
+        :param key: grouping key
+        :return: Enumerable object, empty if the key is not found
+        """
+        return Enumerable(self._table.get(key, ()))
+
+    def __contains__(self, key):
+        return key in self._table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __bool__(self):
+        return len(self._table) > 0
+
+
+class OrderedEnumerable(Enumerable):
+    """
+    Enumerable returned by order_by and order_by_descending. Keys added with then_by and then_by_descending join the
+    same ordering, so however many keys are chained the query sorts once.
+    """
+    def then_by(self, key):
+        """
+        Returns new Enumerable sorted by the keys so far, then in ascending order by given key
+        :param key: key to sort by as lambda expression
+        :return: new OrderedEnumerable object
+        """
+        return self._then_by(key, False)
+
+    def then_by_descending(self, key):
+        """
+        Returns new Enumerable sorted by the keys so far, then in descending order by given key
+        :param key: key to sort by as lambda expression
+        :return: new OrderedEnumerable object
+        """
+        return self._then_by(key, True)
+
+    def _then_by(self, key, descending):
+        if key is None:
+            raise NullArgumentError("No key for sorting given")
+        key = _selector(key)
+        return OrderedEnumerable(_Query(self._data.source, self._data.op, *(self._data.args + (key, descending))))
+
+
+class ParallelEnumerable(Enumerable):
+    def __init__(self, data, options):
+        """
+        Constructor of ParallelEnumerable class returned by Enumerable.as_parallel. select, where, select_many and
+        foreach run in a process pool; every other operator returns a sequential Enumerable.
+        :param data: data or plan node of the enumerable made parallel
+        :param options: _ParallelOptions object
+        :return: void
+        """
+        super(ParallelEnumerable, self).__init__(data, cache='none')
+        self._options = options
+
+    def _derive_parallel(self, kind, func):
+        return ParallelEnumerable(_Query(self, 'parallel', kind, func, self._options), self._options)
+
+    def select(self, func=None):
+        """
+        Transforms data into different form in parallel
+        :param func: picklable function on how to perform transformation
+        :return: new ParallelEnumerable object
+        """
+        func = _selector(func)
+        if func is None:
+            return self
+        return self._derive_parallel('select', func)
+
+    def where(self, predicate):
+        """
+        Returns new ParallelEnumerable where elements matching predicate are selected in parallel
+        :param predicate: picklable predicate
+        :return: new ParallelEnumerable object
+        """
+        if predicate is None:
+            raise NullArgumentError("No predicate given for where clause")
+        return self._derive_parallel('where', _selector(predicate))
+
+    def select_many(self, func=None):
+        """
+        Flattens an iterable of iterables in parallel
+        :param func: picklable selector
+        :return: new ParallelEnumerable object
+        """
+        func = _selector(func)
+        if func is None:
+            return super(ParallelEnumerable, self).select_many()
+        return self._derive_parallel('select_many', func)
+
+    def foreach(self, action):
+        """
+        Invokes the action for every element in the worker processes. Side effects happen in the workers, not in the
+        calling process.
+        :param action: picklable function
+        :return: the original ParallelEnumerable object
+        """
+        for element in self._derive_parallel('foreach', action):
+            pass
+        return self
+
+    def as_sequential(self):
+        """
+        Returns a sequential Enumerable over the results of the parallel operators
+        :return: Enumerable object
+        """
+        return Enumerable(self, cache='none')
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    """
+    Returns the numpy module, imported on first use, or None if numpy is not installed
+    """
+    try:
+        import numpy
+    except ImportError:  # optional: only needed by the vectorized ArrayEnumerable
+        return None
+    return numpy
+
+
+def _is_ndarray(data):
+    """
+    Returns True if data is a numpy array. Never imports numpy: there are no numpy arrays before it is imported
+    """
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(data, numpy.ndarray)
+
+
+def _is_numeric_array(data):
+    """
+    Returns True if data is a one dimensional numeric numpy array or array.array and numpy is available
+    """
+    if isinstance(data, array):
+        return data.typecode != 'u' and _numpy() is not None
+    return _is_ndarray(data) and data.ndim == 1 and data.dtype.kind in 'biuf'
+
+
+class ArrayEnumerable(Enumerable):
+    def __init__(self, data=None, cache=None, element_type=None):
+        """
+        Constructor of ArrayEnumerable class: an Enumerable backed by a one dimensional numpy array. Returned by
+        Enumerable.from_array, and by Enumerable itself when given a numeric numpy array or array.array.
+        count, sum, min, max, avg, median and percentile without a function run as numpy kernels. Functions given to
+        any operator are called per element, as on any Enumerable; whole-array functions are given explicitly to
+        select_vectorized and where_vectorized.
+        ** Note: sums of integer arrays use the fixed width integer type of the array. **
+        :param data: numpy array, array.array or iterable of numbers
+        :param cache: ignored, arrays are always iterated directly
+        :param element_type: type of the elements, see Enumerable.__init__
+        :return: void
+        """
+        numpy = _numpy()
+        if numpy is None:
+            raise ImportError("ArrayEnumerable requires numpy")
+        if data is None:
+            data = numpy.array([])
+        elif isinstance(data, array):
+            # a copy: a view would lock the buffer of the array.array, which could then not grow
+            data = numpy.array(data)
+        elif not isinstance(data, numpy.ndarray):
+            data = numpy.asarray(data if isinstance(data, Sequence) else list(data))
+        super(ArrayEnumerable, self).__init__(data, cache='none', element_type=element_type)
+
+    def _aggregate(self, func, kernel, generic):
+        if func is not None:
+            return generic(func)
+        if len(self._data) == 0:
+            raise NoElementsError("Iterable contains no elements")
+        return kernel(self._data)
+
+    def _kernel(self, func, name):
+        """
+        Calls a whole-array function given to select_vectorized or where_vectorized
+        :return: numpy array of the same shape as the data
+        """
+        if func is None:
+            raise NullArgumentError("No function given for {0}".format(name))
+        result = func(self._data)
+        if not _is_ndarray(result) or result.shape != self._data.shape:
+            raise ValueError("{0} function must return an array of the shape of the data".format(name))
+        return result
+
+    def select_vectorized(self, func):
+        """
+        Transforms the data with a function of the whole array, e.g. lambda x: x * 2 or numpy.sqrt
+        :param func: function of a numpy array returning an array of the same shape
+        :return: new ArrayEnumerable object
+        """
+        return ArrayEnumerable(self._kernel(func, 'select_vectorized'))
+
+    def where_vectorized(self, predicate):
+        """
+        Filters the data with a function of the whole array returning a boolean mask, e.g. lambda x: x > 10
+        :param predicate: function of a numpy array returning a boolean array of the same shape
+        :return: new ArrayEnumerable object
+        """
+        mask = self._kernel(predicate, 'where_vectorized')
+        if mask.dtype != bool:
+            raise ValueError("where_vectorized predicate must return a boolean array")
+        return ArrayEnumerable(self._data[mask])
+
+    def to_list(self):
+        return self._data.tolist()
+
+    def count(self):
+        return len(self._data)
+
+    def sum(self, func=None):
+        if func is not None:
+            return super(ArrayEnumerable, self).sum(func)
+        return self._data.sum().item()
+
+    def min(self, func=None):
+        return self._aggregate(func, lambda values: values.min().item(), super(ArrayEnumerable, self).min)
+
+    def max(self, func=None):
+        return self._aggregate(func, lambda values: values.max().item(), super(ArrayEnumerable, self).max)
+
+    def avg(self, func=None):
+        return self._aggregate(func, lambda values: float(values.mean()), super(ArrayEnumerable, self).avg)
+
+    def median(self, func=None):
+        def kernel(values):
+            numpy = _numpy()
+            i = int(len(values) / 2)
+            if len(values) % 2 == 1:
+                return numpy.partition(values, i)[i].item()
+            lower, upper = numpy.partition(values, [i - 1, i])[i - 1:i + 1]
+            return (float(lower) + float(upper)) / float(2)
+        return self._aggregate(func, kernel, super(ArrayEnumerable, self).median)
+
+    def percentile(self, p, func=None):
+        if not 0 <= p <= 100:
+            raise ValueError("percentile must be between 0 and 100")
+        return self._aggregate(func, lambda values: _numpy().percentile(values, p).item(),
+                               lambda func: super(ArrayEnumerable, self).percentile(p, func))
+
+
+async def _async_window(source, func, limit, ordered):
+    """
+    Calls func on every element of an async iterable with at most limit calls in flight. func may be a plain
+    function or return an awaitable (e.g. an async def function).
+    :param source: async iterable
+    :param func: function to call
+    :param limit: maximum number of concurrent calls
+    :param ordered: yield in source order, otherwise as soon as calls complete
+    :return: async generator of (element, result) tuples
+    """
+    import asyncio
+    import inspect
+
+    async def call(element):
+        result = func(element)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    iterator = source.__aiter__()
+    pending = collections.deque()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < limit:
+                try:
+                    element = await iterator.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                else:
+                    pending.append((element, asyncio.ensure_future(call(element))))
+            if not pending:
+                return
+            if ordered:
+                element, task = pending.popleft()
+                yield element, await task
+            else:
+                done, _ = await asyncio.wait([task for element, task in pending], return_when=asyncio.FIRST_COMPLETED)
+                for item in [item for item in pending if item[1] in done]:
+                    pending.remove(item)
+                    yield item[0], item[1].result()
+    finally:
+        for element, task in pending:
+            task.cancel()
+
+
+class _AsyncQuery(object):
+    """
+    Deferred operator node used as the data of an AsyncEnumerable produced by select or where
+    """
+    __slots__ = ('source', 'op', 'func', 'limit', 'ordered')
+
+    def __init__(self, source, op, func, limit, ordered):
+        self.source = source
+        self.op = op
+        self.func = func
+        self.limit = limit
+        self.ordered = ordered
+
+    async def __aiter__(self):
+        async for element, result in _async_window(self.source, self.func, self.limit, self.ordered):
+            if self.op == 'select':
+                yield result
+            elif result:
+                yield element
+
+
+class AsyncEnumerable(object):
+    def __init__(self, data=None, max_concurrency=100):
+        """
+        Constructor of AsyncEnumerable class, the asynchronous counterpart of Enumerable. select and where accept
+        plain or async functions and run up to max_concurrency of them concurrently, so a pipeline can overlap many
+        waits while keeping at most max_concurrency elements in flight per operator.
+
+        Usage:
+            async def fetch(url): ...
+            pages = await Enumerable(urls).as_async(max_concurrency=50).select(fetch).where(is_ok).to_list()
+
+        :param data: iterable or async iterable object
+        :param max_concurrency: default number of concurrent calls of select and where
+        :return: void
+        """
+        if data is None:
+            data = []
+        if not hasattr(data, '__iter__') and not hasattr(data, '__aiter__'):
+            raise TypeError("AsyncEnumerable must be instantiated with an iterable or async iterable object")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be a positive number")
+        self._data = data
+        self._max_concurrency = max_concurrency
+
+    def __aiter__(self):
+        if hasattr(self._data, '__aiter__'):
+            return self._data.__aiter__()
+        return self._iterate_sync()
+
+    async def _iterate_sync(self):
+        for element in self._data:
+            yield element
+
+    def select(self, func, max_concurrency=None, ordered=True):
+        """
+        Transforms data into different form
+        :param func: function or async function on how to perform transformation
+        :param max_concurrency: number of concurrent calls, defaults to the one of the enumerable
+        :param ordered: keep the order of the source, otherwise results are yielded as soon as they are ready
+        :return: new AsyncEnumerable object
+        """
+        if func is None:
+            raise NullArgumentError("No function given for select")
+        return self._derive('select', func, max_concurrency, ordered)
+
+    def where(self, predicate, max_concurrency=None, ordered=True):
+        """
+        Returns new AsyncEnumerable where elements matching predicate are selected
+        :param predicate: function or async function
+        :param max_concurrency: number of concurrent calls, defaults to the one of the enumerable
+        :param ordered: keep the order of the source, otherwise elements are yielded as soon as they are tested
+        :return: new AsyncEnumerable object
+        """
+        if predicate is None:
+            raise NullArgumentError("No predicate given for where clause")
+        return self._derive('where', predicate, max_concurrency, ordered)
+
+    def _derive(self, op, func, max_concurrency, ordered):
+        limit = self._max_concurrency if max_concurrency is None else max_concurrency
+        return AsyncEnumerable(_AsyncQuery(self, op, func, limit, ordered), self._max_concurrency)
+
+    async def to_list(self):
+        """
+        Converts the async iterable into a list
+        :return: list object
+        """
+        return [element async for element in self]
+
+
+class NoElementsError(Exception): pass
+class NullArgumentError(Exception): pass
+class NoMatchingElement(Exception): pass
+class MoreThanOneMatchingElement(Exception): pass
+
+
+class qlist(Enumerable): 
+    """
+        Short named version of py_linq.Enumerable. It stands for 'queryable list'.
+    """
+    def __init__(self, data=None, cache=None, element_type=None): 
+        """
+        Constructor. On top of the Enumerable API a qlist is appendable: append and extend add elements in place
+        and notify the observers and materialized views registered on it. The data given to the constructor is
+        never modified, it is copied into a list of the qlist's own on the first append.
+        """
+        super().__init__(data, cache, element_type)
+        self._owns_data = data is None
+        self._observers = []
+
+    def append(self, element):
+        """
+        Adds an element in place and passes it to every observer
+        :param element: An element
+        :return: void
+        """
+        if self.type_checking and self.element_type is not None and not isinstance(element, self.element_type):
+            raise TypeError("cannot append {0} element to a qlist of {1}".format(
+                type(element).__name__, self.element_type.__name__))
+        if not self._owns_data:
+            self._data = list(self)
+            self._owns_data = True
+        self._data.append(element)
+        if self._types is not None and self._types is not _UNKNOWN_TYPES and type(element) not in self._types:
+            self._types = self._types | {type(element)}
+        for observer in self._observers:
+            observer(element)
+
+    def extend(self, elements):
+        """
+        Adds elements in place, see append
+        :param elements: iterable object
+        :return: void
+        """
+        for element in elements:
+            self.append(element)
+
+    def observe(self, observer):
+        """
+        Registers a function called with every element appended from now on
+        :param observer: function of an element
+        :return: the observer, for unobserve
+        """
+        self._observers.append(observer)
+        return observer
+
+    def unobserve(self, observer):
+        """
+        Unregisters an observer or materialized view
+        :param observer: function given to observe, or view returned by aggregate_view or group_by_view
+        :return: void
+        """
+        self._observers.remove(getattr(observer, '_add', observer))
+
+    def aggregate_view(self, func=None):
+        """
+        Returns a view of count, sum, avg, min and max over the elements, computed once and then updated in O(1) on
+        every append instead of iterating the whole list again.
+
+        Usage:
+            totals = orders.aggregate_view(lambda x: x['amount'])
+            orders.append({'amount': 10})
+            totals.sum(), totals.avg()
+
+        :param func: lambda expression to transform data
+        :return: AggregateView object
+        """
+        view = AggregateView(_selector(func))
+        for element in self:
+            view._add(element)
+        self._observers.append(view._add)
+        return view
+
+    def group_by_view(self, key, func=None):
+        """
+        Returns a view of count, sum, avg, min and max per key, computed once and then updated in O(1) on every
+        append. Keys are kept in first-seen order and only need to be hashable or freezable, as in group_by.
+        :param key: key selector as lambda expression
+        :param func: lambda expression to transform data
+        :return: GroupedView object
+        """
+        if key is None:
+            raise NullArgumentError("No key given for group_by_view")
+        view = GroupedView(_selector(key), _selector(func))
+        for element in self:
+            view._add(element)
+        self._observers.append(view._add)
+        return view
+
+
+class AggregateView(object):
+    """
+    Materialized count, sum, avg, min and max of the elements of a qlist, see qlist.aggregate_view
+    """
+    __slots__ = ('_func', '_count', '_sum', '_min', '_max')
+
+    def __init__(self, func=None):
+        self._func = func
+        self._count = 0
+        self._sum = 0
+        self._min = _MISSING
+        self._max = _MISSING
+
+    def _add(self, element):
+        value = element if self._func is None else self._func(element)
+        self._count += 1
+        self._sum += value
+        if self._min is _MISSING or value < self._min:
+            self._min = value
+        if self._max is _MISSING or self._max < value:
+            self._max = value
+
+    def count(self):
+        return self._count
+
+    def sum(self):
+        return self._sum
+
+    def avg(self):
+        if self._count == 0:
+            raise NoElementsError("Iterable contains no elements")
+        return float(self._sum) / float(self._count)
+
+    def min(self):
+        if self._min is _MISSING:
+            raise NoElementsError("Iterable contains no elements")
+        return self._min
+
+    def max(self):
+        if self._max is _MISSING:
+            raise NoElementsError("Iterable contains no elements")
+        return self._max
+
+    def __repr__(self):
+        return {'count': self._count, 'sum': self._sum}.__repr__()
+
+
+class GroupedView(object):
+    """
+    Materialized AggregateView per key of the elements of a qlist, see qlist.group_by_view. Indexing by key yields
+    the view of a group, iterating yields the keys in first-seen order.
+    """
+    __slots__ = ('_key', '_func', '_table', '_keys')
+
+    def __init__(self, key, func=None):
+        self._key = key
+        self._func = func
+        self._table = _KeyTable()
+        self._keys = []
+
+    def _add(self, element):
+        k = self._key(element)
+        view = self._table.get(k)
+        if view is None:
+            view = self._table.setdefault(k, AggregateView(self._func))
+            self._keys.append(k)
+        view._add(element)
+
+    def __getitem__(self, key):
+        """
+        Returns the AggregateView of given key
+        :param key: grouping key
+        :return: AggregateView object, empty if the key is not found
+        """
+        return self._table.get(key) or AggregateView(self._func)
+
+    def __contains__(self, key):
+        return key in self._table
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def items(self):
+        """
+        Returns the (key, AggregateView) pairs in first-seen key order
+        :return: list of tuples
+        """
+        return [(k, self._table.get(k)) for k in self._keys]
+
+    def __repr__(self):
+        return self.items().__repr__()
+
+
+# 2 ** -rank of the HyperLogLog register values
+_INVERSE_POWERS = [2.0 ** -rank for rank in range(66)]
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(h):
+    """
+    splitmix64 finalizer: spreads the bits of a 64 bit integer
+    """
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return h ^ (h >> 31)
+
+
+def _hash64(value):
+    """
+    64 bit hash of a key for the sketches. Strings, bytes and numbers hash the same in every process, so sketches
+    built in different processes can be merged; other keys rely on hash(), randomized per process for strings they
+    contain (see PYTHONHASHSEED)
+    """
+    if isinstance(value, str):
+        value = value.encode('utf-8', 'surrogatepass')
+    if isinstance(value, (bytes, bytearray)):
+        import hashlib
+        return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+    return _mix64((value if isinstance(value, int) else hash(_freeze(value))) & _MASK64)
+
+
+class HyperLogLog(object):
+    """
+    Mergeable sketch estimating the number of distinct values added to it, in 2 ** precision bytes whatever their
+    number, with a relative standard error of 1.04 / sqrt(2 ** precision). See Enumerable.approx_count_distinct.
+
+    Usage:
+        sketches = [HyperLogLog().update(Enumerable.from_csv(part).select('user')) for part in parts]
+        functools.reduce(HyperLogLog.merge, sketches).count()
+    """
+    __slots__ = ('precision', '_registers')
+
+    def __init__(self, error=0.01):
+        """
+        :param error: relative standard error of the estimate, between 0.0026 (256KB) and 0.26 (16 bytes)
+        """
+        self.precision = min(18, max(4, int(math.ceil(math.log2((1.04 / error) ** 2)))))
+        self._registers = bytearray(1 << self.precision)
+
+    def add(self, value):
+        h = _hash64(value)
+        bits = 64 - self.precision
+        i = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self._registers[i]:
+            self._registers[i] = rank
+
+    def update(self, values):
+        """
+        Adds every value of an iterable. Integer numpy arrays are hashed and added as whole-array kernels.
+        :param values: iterable object
+        :return: self
+        """
+        if _is_ndarray(values) and values.dtype.kind in 'iub':
+            self._add_array(values)
+            return self
+        add = self.add
+        for value in values:
+            add(value)
+        return self
+
+    def _add_array(self, values):
+        # same hashes as _hash64 of the elements: the 64 bit two's complement of the integer, then splitmix64
+        numpy = _numpy()
+        h = values.astype(numpy.int64).view(numpy.uint64)
+        for shift, factor in ((30, 0xBF58476D1CE4E5B9), (27, 0x94D049BB133111EB)):
+            h = (h ^ (h >> numpy.uint64(shift))) * numpy.uint64(factor)
+        h = h ^ (h >> numpy.uint64(31))
+        bits = 64 - self.precision
+        indices = (h >> numpy.uint64(bits)).astype(numpy.intp)
+        rest = h & numpy.uint64((1 << bits) - 1)
+        # bit lengths of the rest from the exponents of its two 32 bit halves, which floats hold exactly
+        high = numpy.frexp((rest >> numpy.uint64(32)).astype(numpy.float64))[1]
+        low = numpy.frexp((rest & numpy.uint64(0xFFFFFFFF)).astype(numpy.float64))[1]
+        ranks = bits + 1 - numpy.where(high > 0, high + 32, low)
+        registers = numpy.frombuffer(self._registers, dtype=numpy.uint8)
+        numpy.maximum.at(registers, indices, ranks.astype(numpy.uint8))
+
+    def merge(self, other):
+        """
+        Adds the values of another sketch of the same precision
+        :param other: HyperLogLog object
+        :return: self
+        """
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLog sketches of different precisions")
+        self._registers = bytearray(map(max, self._registers, other._registers))
+        return self
+
+    def count(self):
+        """
+        :return: estimated number of distinct values as int
+        """
+        m = len(self._registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum(map(_INVERSE_POWERS.__getitem__, self._registers))
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def __repr__(self):
+        return "HyperLogLog(count={0})".format(self.count())
+
+
+class TDigest(object):
+    """
+    Mergeable sketch estimating quantiles of the numbers added to it, keeping about compression centroids (weighted
+    means) whatever their number. Centroids are smaller towards both ends of the distribution, so that extreme
+    quantiles are the most accurate. See Enumerable.approx_quantiles.
+    """
+    __slots__ = ('compression', '_centroids', '_buffer', '_count', '_min', '_max')
+
+    def __init__(self, compression=100):
+        """
+        :param compression: size of the sketch, larger is more accurate
+        """
+        self.compression = compression
+        self._centroids = []
+        self._buffer = []
+        self._count = 0
+        self._min = self._max = None
+
+    def add(self, value):
+        self._buffer.append(value)
+        self._count += 1
+        if len(self._buffer) >= 5 * self.compression:
+            self._flush()
+
+    def update(self, values):
+        """
+        Adds every number of an iterable. Numeric numpy arrays are sorted as a whole and merged in one pass.
+        :param values: iterable object
+        :return: self
+        """
+        if _is_ndarray(values) and values.dtype.kind in 'iuf':
+            if len(values):
+                values = _numpy().sort(values).tolist()
+                self._count += len(values)
+                self._flush([(value, 1) for value in values])
+            return self
+        add = self.add
+        for value in values:
+            add(value)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the numbers of another sketch
+        :param other: TDigest object
+        :return: self
+        """
+        other._flush()
+        if other._count == 0:
+            return self
+        self._count += other._count
+        self._min = other._min if self._min is None else min(self._min, other._min)
+        self._max = other._max if self._max is None else max(self._max, other._max)
+        self._flush(other._centroids)
+        return self
+
+    def _flush(self, points=()):
+        """
+        Merges the buffered numbers and given (mean, weight) points, sorted by mean, into the centroids
+        """
+        buffer = self._buffer
+        buffer.sort()
+        points = list(heapq.merge(self._centroids, [(value, 1) for value in buffer], points))
+        self._buffer = []
+        if not points:
+            return
+        self._min = points[0][0] if self._min is None else min(self._min, points[0][0])
+        self._max = points[-1][0] if self._max is None else max(self._max, points[-1][0])
+        # greedy merge of neighbours while a centroid spans less than one unit of the k1 scale function
+        # k(q) = compression / (2 pi) * asin(2q - 1)
+        total = float(self._count)
+        step = 2 * math.pi / self.compression
+        centroids = []
+        done = 0
+        mean, weight = points[0]
+        limit = total * _next_quantile(0.0, step)
+        for value, w in itertools.islice(points, 1, None):
+            if done + weight + w <= limit:
+                weight += w
+                mean += (value - mean) * w / weight
+            else:
+                centroids.append((mean, weight))
+                done += weight
+                limit = total * _next_quantile(done / total, step)
+                mean, weight = value, w
+        centroids.append((mean, weight))
+        self._centroids = centroids
+
+    def count(self):
+        """
+        :return: number of numbers added
+        """
+        return self._count
+
+    def quantile(self, q):
+        """
+        Estimates a quantile, interpolating linearly between the centers of the centroids
+            * Raises NoElementsError if no number was added
+        :param q: quantile between 0 and 1
+        :return: estimated value
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("quantile must be between 0 and 1")
+        self._flush()
+        if self._count == 0:
+            raise NoElementsError("Iterable contains no elements")
+        rank = q * (self._count - 1)
+        previous_center, previous_mean = 0.0, self._min
+        cumulative = 0
+        for mean, weight in self._centroids:
+            # a centroid of weight w stands for ranks cumulative to cumulative + w - 1
+            center = cumulative + (weight - 1) / 2.0
+            if rank <= center:
+                if center == previous_center:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (rank - previous_center) / (center - previous_center)
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        last = self._count - 1
+        return previous_mean + (self._max - previous_mean) * (rank - previous_center) / (last - previous_center)
+
+    def quantiles(self, qs):
+        """
+        :param qs: list of quantiles between 0 and 1
+        :return: list of estimated values
+        """
+        return [self.quantile(q) for q in qs]
+
+    def __repr__(self):
+        return "TDigest(count={0}, centroids={1})".format(self._count, len(self._centroids) + len(self._buffer))
+
+
+def _next_quantile(q, step):
+    """
+    Quantile one unit of the t-digest scale function above q
+    """
+    x = math.asin(2 * q - 1) + step
+    return 1.0 if x >= math.pi / 2 else (math.sin(x) + 1) / 2
+
+
+class SpaceSaving(object):
+    """
+    Mergeable sketch of the most frequent keys added to it (Space-Saving algorithm). Keeps capacity counters: a key
+    without one replaces the key with the smallest count and inherits that count, so counts are overestimated by at
+    most count() / capacity. Counters are bucketed by count, so that adding a key takes O(1) time.
+    See Enumerable.approx_top_k.
+    """
+    __slots__ = ('capacity', '_counters', '_buckets', '_min', '_count')
+
+    def __init__(self, error=0.001, k=1):
+        """
+        :param error: maximum overestimation of the counts, as a fraction of the number of keys added
+        :param k: number of keys to be reported, the capacity is never smaller
+        """
+        self.capacity = max(k, int(math.ceil(1.0 / error)))
+        # frozen key -> [key, count, error]; count -> dict of the frozen keys of that count, in insertion order
+        self._counters = {}
+        self._buckets = {}
+        self._min = 0
+        self._count = 0
+
+    def add(self, key):
+        self._count += 1
+        k = _freeze(key)
+        counter = self._counters.get(k)
+        if counter is None:
+            if len(self._counters) < self.capacity:
+                self._counters[k] = [key, 1, 0]
+                self._buckets.setdefault(1, {})[k] = None
+                self._min = 1
+                return
+            # the oldest key of the smallest count makes room
+            smallest = self._buckets[self._min]
+            evicted = next(iter(smallest))
+            del smallest[evicted]
+            del self._counters[evicted]
+            counter = self._counters[k] = [key, self._min, self._min]
+            smallest[k] = None
+        count = counter[1]
+        bucket = self._buckets[count]
+        del bucket[k]
+        if not bucket:
+            del self._buckets[count]
+            if self._min == count:
+                self._min = count + 1
+        counter[1] = count + 1
+        self._buckets.setdefault(count + 1, {})[k] = None
+
+    def update(self, keys):
+        """
+        Adds every key of an iterable
+        :param keys: iterable object
+        :return: self
+        """
+        add = self.add
+        for key in keys:
+            add(key)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the keys of another sketch: counts are summed, a key missing from a full sketch counting as its smallest
+        count, and the capacity largest counts are kept
+        :param other: SpaceSaving object
+        :return: self
+        """
+        missing = self._min if len(self._counters) >= self.capacity else 0
+        other_missing = other._min if len(other._counters) >= other.capacity else 0
+        counters = {}
+        for k, (key, count, error) in self._counters.items():
+            counters[k] = [key, count + other_missing, error + other_missing]
+        for k, (key, count, error) in other._counters.items():
+            counter = counters.get(k)
+            if counter is None:
+                counters[k] = [key, count + missing, error + missing]
+            else:
+                counter[1] += count - other_missing
+                counter[2] += error - other_missing
+        kept = heapq.nlargest(self.capacity, counters.items(), key=lambda item: item[1][1])
+        self._counters = dict(kept)
+        self._buckets = {}
+        for k, counter in kept:
+            self._buckets.setdefault(counter[1], {})[k] = None
+        self._min = min(self._buckets) if self._buckets else 0
+        self._count += other._count
+        return self
+
+    def count(self):
+        """
+        :return: number of keys added
+        """
+        return self._count
+
+    def top(self, k):
+        """
+        Returns the k keys with the largest counts
+        :param k: number of keys
+        :return: list of (key, count) tuples, most frequent first
+        """
+        return [(key, count) for key, count, error in heapq.nlargest(k, self._counters.values(),
+                                                                     key=operator.itemgetter(1))]
+
+    def __repr__(self):
+        return self.top(10).__repr__()
@@ -0,0 +1,47 @@
+__author__ = 'Viralogic Software'
+
+# Usage:
+#   python run_benchmarks.py                                  run every benchmark at the default sizes
+#   python run_benchmarks.py --sizes 1000 10000000 --benchmarks join concat
+#   python run_benchmarks.py --save baseline.json             record a baseline
+#   python run_benchmarks.py --compare baseline.json          fail when throughput or peak memory regress
+#   python run_benchmarks.py --max-exponent 1.5               fail when a benchmark grows faster than n^1.5
+#
+# Baselines are only comparable on the machine and Python version they were recorded with, so none is kept in the
+# repository. To check a change, record one from the target branch and compare on the same machine:
+#   git checkout master && python run_benchmarks.py --save baseline.json
+#   git checkout <branch> && python run_benchmarks.py --compare baseline.json --max-exponent 1.5
+# In CI, run both steps on the same runner and keep baseline.json of the latest master run as a build artifact for
+# later changes to compare against.
+
+import argparse
+import sys
+sys.path.append('./py_linq')
+from benchmarks import suite
+
+parser = argparse.ArgumentParser(description='py-linq benchmarks')
+parser.add_argument('--benchmarks', nargs='*', choices=sorted(suite.BENCHMARKS), help='benchmarks to run, all by default')
+parser.add_argument('--sources', nargs='*', choices=sorted(suite.SOURCES), help='sources to run, all by default')
+parser.add_argument('--sizes', nargs='*', type=lambda s: int(float(s)), default=suite.DEFAULT_SIZES, help='source sizes, e.g. 1e3 1e7')
+parser.add_argument('--repeat', type=int, default=3, help='timed runs per measurement, the fastest is kept')
+parser.add_argument('--max-seconds', type=float, default=10.0, help='skip larger sizes once a run takes longer')
+parser.add_argument('--save', metavar='PATH', help='record the results as a baseline')
+parser.add_argument('--compare', metavar='PATH', help='compare the results to a recorded baseline')
+parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative regression when comparing')
+parser.add_argument('--max-exponent', type=float, help='fail when running time grows faster than size to this power')
+args = parser.parse_args()
+
+results = suite.run(args.benchmarks, args.sources, args.sizes, args.repeat, args.max_seconds)
+failures = []
+if args.save:
+    suite.save(results, args.save)
+if args.compare:
+    failures.extend(suite.compare(suite.load(args.compare), results, args.threshold))
+if args.max_exponent is not None:
+    for name, exponent in sorted(suite.scaling(results).items()):
+        if exponent > args.max_exponent:
+            failures.append("{0}: running time grows as n^{1:.2f}".format(name, exponent))
+
+for failure in failures:
+    print("REGRESSION " + failure)
+sys.exit(1 if failures else 0)
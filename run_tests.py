@@ -6,7 +6,11 @@ import unittest
 
 testclasses = [
     'tests.Constructor',
-    'tests.Functions'
+    'tests.Functions',
+    'tests.Iteration',
+    'tests.Parallel',
+    'tests.Files',
+    'tests.Benchmarks'
 ]
 
 suite = unittest.TestLoader().loadTestsFromNames(testclasses)
@@ -21,7 +21,10 @@ setup(
     license='MIT',
     author='ViraLogic Software',
     author_email='bwfenske@ualberta.ca',
-    packages=find_packages(exclude=['tests*']),
+    packages=find_packages(exclude=['tests*', 'benchmarks*']),
+    extras_require={
+        'numpy': ['numpy']
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
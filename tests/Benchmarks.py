@@ -0,0 +1,42 @@
+__author__ = 'Viralogic Software'
+
+from unittest import TestCase
+from benchmarks import suite
+
+
+class TestBenchmarks(TestCase):
+    def test_every_benchmark_runs(self):
+        results = suite.run(sizes=[200], repeat=1, out=None)
+        self.assertEqual(len(results), len(suite.BENCHMARKS) * len(suite.SOURCES), "One result per benchmark and source")
+        for name, result in results.items():
+            self.assertGreater(result['throughput'], 0, name)
+
+    def test_every_operator_has_a_benchmark(self):
+        operators = ['to_list', 'count', 'reverse', 'foreach', 'select', 'sum', 'min', 'max', 'avg', 'median', 'elementAt',
+                     'elementAtOrDefault', 'first', 'first_or_default', 'last', 'last_or_default', 'order_by',
+                     'order_by_descending', 'skip', 'take', 'where', 'single', 'single_or_default', 'select_many', 'add',
+                     'concat', 'group_by', 'distinct', 'join', 'default_if_empty', 'group_join', 'any', 'intersect', 'union',
+                     'except_', 'contains']
+        aliases = {'elementAt': 'element_at', 'elementAtOrDefault': 'element_at', 'skip': 'skip_take', 'take': 'skip_take',
+                   'except_': 'except'}
+        missing = [name for name in operators if aliases.get(name, name) not in suite.OPERATORS]
+        self.assertListEqual(missing, [], "Every operator is benchmarked")
+
+    def test_compare(self):
+        baseline = {'join/ints/1000': {'seconds': 1.0, 'throughput': 1000.0, 'peak_bytes': 100000}}
+        self.assertListEqual(suite.compare(baseline, baseline), [], "Identical results do not regress")
+        slower = {'join/ints/1000': {'seconds': 2.0, 'throughput': 500.0, 'peak_bytes': 100000}}
+        self.assertEqual(len(suite.compare(baseline, slower)), 1, "Throughput regression is reported")
+        bigger = {'join/ints/1000': {'seconds': 1.0, 'throughput': 1000.0, 'peak_bytes': 1000000}}
+        self.assertEqual(len(suite.compare(baseline, bigger)), 1, "Peak memory regression is reported")
+
+    def test_scaling(self):
+        results = {
+            'concat/ints/1000': {'seconds': 0.01},
+            'concat/ints/10000': {'seconds': 1.0},
+            'join/ints/1000': {'seconds': 0.01},
+            'join/ints/10000': {'seconds': 0.1},
+        }
+        exponents = suite.scaling(results)
+        self.assertAlmostEqual(exponents['concat/ints'], 2.0)
+        self.assertAlmostEqual(exponents['join/ints'], 1.0)
@@ -1,6 +1,10 @@
 __author__ = 'ViraLogic Software'
 
+import os
+import subprocess
+import sys
 from unittest import TestCase
+import py_linq
 from py_linq import Enumerable
 from tests import _empty, _simple, _complex
 
@@ -16,3 +20,10 @@ class TestConstructor(TestCase):
         self.assertIsInstance(self.complex, Enumerable, "TypeError: complex py_linq is not Enumerable type")
 
         self.assertRaises(TypeError, Enumerable, 1)
+
+    def test_import_is_light(self):
+        modules = ['numpy', 'random', 'concurrent.futures', 'asyncio', 'pickle', 'tempfile', 'csv', 'json', 'gzip', 'bz2', 'lzma',
+                   'hashlib']
+        script = "import sys; sys.path.insert(0, {0!r}); import py_linq; print(' '.join(m for m in {1!r} if m in sys.modules))"
+        loaded = subprocess.check_output([sys.executable, '-c', script.format(os.path.dirname(py_linq.__file__), modules)])
+        self.assertEqual(loaded.decode().strip(), '', "Optional and feature specific modules are imported on first use")
@@ -0,0 +1,123 @@
+__author__ = 'Viralogic Software'
+
+import bz2
+import gzip
+import json
+import lzma
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from py_linq import *
+from tests import _locations
+
+
+class TestFileSources(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.jsonl = os.path.join(self.directory, 'locations.jsonl')
+        with open(self.jsonl, 'w') as f:
+            for country, city, branch, turnover in _locations:
+                f.write(json.dumps({'country': country, 'city': city, 'branch': branch, 'turnover': turnover}) + '\n')
+            f.write('\n')
+        self.csv = os.path.join(self.directory, 'locations.csv')
+        with open(self.csv, 'w', newline='') as f:
+            f.write('country,city,branch,turnover\r\n')
+            for location in _locations:
+                f.write('{0},"{1}",{2},{3}\r\n'.format(*location))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_from_lines(self):
+        lines = Enumerable.from_lines(self.csv)
+        self.assertEqual(lines.first(), 'country,city,branch,turnover', "Lines have no terminator")
+        self.assertEqual(lines.count(), len(_locations) + 1)
+        self.assertEqual(lines.count(), len(_locations) + 1, "File sources are read again on every iteration")
+        self.assertNotIsInstance(lines._data, list, "File sources are not cached")
+        self.assertIs(lines.concat(['end'])._types, lines._types, "Concat does not read files to check types")
+
+    def test_from_jsonl(self):
+        records = Enumerable.from_jsonl(self.jsonl)
+        self.assertEqual(records.count(), len(_locations), "Blank lines are skipped")
+        self.assertDictEqual(records.first(), {'country': 'Scotland', 'city': 'Edinburgh', 'branch': 'Branch1', 'turnover': 20000})
+        projected = Enumerable.from_jsonl(self.jsonl, fields=['city', 'missing'])
+        self.assertDictEqual(projected.last(), {'city': 'Liverpool', 'missing': None}, "Fields are projected")
+
+    def test_from_csv(self):
+        records = Enumerable.from_csv(self.csv)
+        self.assertDictEqual(records.first(), {'country': 'Scotland', 'city': 'Edinburgh', 'branch': 'Branch1', 'turnover': '20000'})
+        self.assertListEqual(Enumerable.from_csv(self.csv, fields=['turnover', 'country']).select(lambda x: (x['country'], int(x['turnover']))).to_list(),
+                             [(x[0], x[3]) for x in _locations], "Fields are projected")
+        rows = Enumerable.from_csv(self.csv, header=False, fields=[1])
+        self.assertListEqual(rows.take(2).to_list(), [['city'], ['Edinburgh']], "Without header rows are lists")
+
+    def test_split_file(self):
+        self.assertRaises(ValueError, Enumerable.split_file, self.jsonl, 0)
+        for parts in [1, 2, 5, 40, os.path.getsize(self.jsonl) + 10]:
+            ranges = Enumerable.split_file(self.jsonl, parts)
+            self.assertEqual(len(ranges), parts)
+            records = []
+            for start, end in ranges:
+                records.extend(Enumerable.from_jsonl(self.jsonl, fields=['branch'], start=start, end=end).to_list())
+            self.assertEqual(len(records), len(_locations), "Ranges read every line exactly once ({0} parts)".format(parts))
+            rows = []
+            for start, end in Enumerable.split_file(self.csv, parts):
+                rows.extend(Enumerable.from_csv(self.csv, start=start, end=end).select(lambda x: x['city']).to_list())
+            self.assertListEqual(rows, [x[1] for x in _locations], "CSV ranges read the header once ({0} parts)".format(parts))
+
+
+class TestFileSinks(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.locations = Enumerable(_locations).select(lambda x: {'country': x[0], 'city': x[1], 'branch': x[2], 'turnover': x[3]})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_to_file(self):
+        result = Enumerable(range(2500)).to_file(self.path('numbers.txt'))
+        self.assertEqual(result.rows, 2500, "Rows span several batches")
+        self.assertEqual(result.bytes, os.path.getsize(self.path('numbers.txt')))
+        self.assertListEqual(Enumerable.from_lines(self.path('numbers.txt')).select(int).to_list(), list(range(2500)))
+
+        result = Enumerable(_locations).to_file(self.path('branches.txt'), func=lambda x: x[2])
+        self.assertEqual(result, (len(_locations), len(_locations) * len('Branch1\n')))
+        self.assertListEqual(sorted(os.listdir(self.directory)), ['branches.txt', 'numbers.txt'], "No temporary file is left behind")
+
+    def test_to_jsonl(self):
+        result = self.locations.to_jsonl(self.path('locations.jsonl'))
+        self.assertEqual(result.rows, len(_locations))
+        self.assertListEqual(Enumerable.from_jsonl(self.path('locations.jsonl')).to_list(), self.locations.to_list(), "Round trip")
+        self.locations.to_jsonl(self.path('cities.jsonl'), fields=['city'])
+        self.assertDictEqual(Enumerable.from_jsonl(self.path('cities.jsonl')).first(), {'city': 'Edinburgh'}, "Fields are projected")
+
+    def test_to_csv(self):
+        result = self.locations.to_csv(self.path('locations.csv'))
+        self.assertEqual(result.rows, len(_locations), "Header is not counted")
+        self.assertListEqual(Enumerable.from_csv(self.path('locations.csv')).select(lambda x: x['city']).to_list(), [x[1] for x in _locations])
+        Enumerable(_locations).to_csv(self.path('tuples.csv'), fields=['country', 'city', 'branch', 'turnover'])
+        self.assertDictEqual(Enumerable.from_csv(self.path('tuples.csv')).last(), {'country': 'England', 'city': 'Liverpool', 'branch': 'Branch2', 'turnover': '25000'})
+        Enumerable(_locations).to_csv(self.path('noheader.csv'))
+        self.assertEqual(Enumerable.from_lines(self.path('noheader.csv')).first(), 'Scotland,Edinburgh,Branch1,20000', "No header without names")
+
+    def test_compression(self):
+        for name, module in [('numbers.txt.gz', gzip), ('numbers.txt.bz2', bz2), ('numbers.xz', lzma)]:
+            result = Enumerable(range(1000)).to_file(self.path(name))
+            self.assertEqual(result.bytes, os.path.getsize(self.path(name)), "Bytes written are compressed bytes")
+            with module.open(self.path(name), 'rt') as f:
+                self.assertListEqual([int(line) for line in f], list(range(1000)), "{0} is inferred from the extension".format(module.__name__))
+        self.assertRaises(ValueError, Enumerable(range(3)).to_file, self.path('numbers.zip'), compression='zip')
+
+    def test_atomic(self):
+        path = self.path('numbers.txt')
+        Enumerable(range(3)).to_file(path)
+        def failing():
+            yield 4
+            raise IOError("source failed")
+        self.assertRaises(IOError, Enumerable(failing()).to_file, path)
+        self.assertListEqual(os.listdir(self.directory), ['numbers.txt'], "Failed writes leave no temporary file")
+        self.assertListEqual(Enumerable.from_lines(path).to_list(), ['0', '1', '2'], "Failed writes leave the previous file untouched")
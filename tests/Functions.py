@@ -1,8 +1,14 @@
 __author__ = 'Viralogic Software'
 
-from unittest import TestCase
+import pickle
+from array import array
+from unittest import TestCase, skipIf
 from py_linq import *
 from tests import _empty, _simple, _complex, _locations
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class TestTest():
 #class TestTest(TestCase):
@@ -107,6 +113,86 @@ class TestFunctions(TestCase):
 
         self.assertListEqual(self.simple.order_by(lambda x: x).to_list(), self.complex.select(lambda x: x['value']).order_by(lambda x: x).to_list(), "Projection and sort ascending of complex should yield simple")
 
+    def test_then_by(self):
+        locations = Enumerable(_locations)
+        self.assertRaises(NullArgumentError, locations.order_by(lambda x: x[0]).then_by, None)
+
+        expected = sorted(_locations, key=lambda x: (x[0], -x[3]))
+        ordered = locations.order_by(lambda x: x[0]).then_by_descending(lambda x: x[3])
+        self.assertListEqual(ordered.to_list(), expected, "Ascending country, descending turnover")
+        self.assertListEqual(ordered.take(4).to_list(), expected[:4], "Top-k with mixed key directions")
+
+        expected = sorted(_locations, key=lambda x: (x[0], x[1], x[3]), reverse=True)
+        ordered = locations.order_by_descending(lambda x: x[0]).then_by_descending(lambda x: x[1]).then_by_descending(lambda x: x[3])
+        self.assertListEqual(ordered.to_list(), expected, "Three descending keys")
+
+        calls = []
+        def country(x):
+            calls.append(x)
+            return x[0]
+        expected = sorted(_locations, key=lambda x: (x[0], x[2]))
+        self.assertListEqual(locations.order_by(country).then_by(lambda x: x[2]).to_list(), expected)
+        self.assertEqual(len(calls), len(_locations), "Every key is computed once per element")
+        self.assertEqual(locations.order_by(lambda x: x[2]).order_by(lambda x: x[0]).explain().splitlines()[1:],
+                         ['-> order_by(<lambda>, False, <lambda>, False)'], "Chained orderings sort once")
+        self.assertListEqual(locations.order_by(lambda x: x[2]).order_by(lambda x: x[0]).to_list(), expected,
+                             "Earlier orderings break ties of later ones")
+
+    def test_external_sort(self):
+        expected = sorted(_locations, key=lambda x: x[0])
+        self.assertListEqual(Enumerable(_locations).order_by(lambda x: x[0], budget=3).to_list(), expected, "Spilled sort is stable")
+        expected = sorted(_locations, key=lambda x: x[3], reverse=True)
+        self.assertListEqual(Enumerable(_locations).order_by_descending(lambda x: x[3], budget=3).to_list(), expected)
+        expected = sorted(_locations, key=lambda x: (x[0], -x[3]))
+        self.assertListEqual(Enumerable(_locations).order_by(lambda x: x[0], budget=3).then_by_descending(lambda x: x[3]).to_list(), expected,
+                             "Mixed key directions spill their keys")
+        self.assertListEqual(self.simple.order_by_descending(lambda x: x, budget=3).to_list(), [3, 2, 1], "Input within budget")
+        self.assertListEqual(Enumerable(_locations).order_by(lambda x: x[0], budget=3).take(2).to_list(), expected[:2])
+
+        data = [(i % 7, i) for i in range(300)]
+        self.assertListEqual(Enumerable(x for x in data).order_by(lambda x: x[0], budget=2).to_list(), sorted(data, key=lambda x: x[0]),
+                             "Runs above the merge fan-in are merged in several passes")
+        self.assertRaises(ValueError, Enumerable(_locations).order_by(lambda x: x[0], budget=0).to_list)
+
+        class Budgeted(Enumerable):
+            sort_budget = 0
+        locations = Enumerable(_locations)
+        locations.sort_budget = 0
+        for source in [locations, Budgeted(_locations), qlist(_locations)]:
+            if isinstance(source, qlist):
+                qlist.sort_budget = 0
+            try:
+                self.assertRaises(ValueError, source.order_by(lambda x: x[0]).to_list)
+                # the budget of the source enumerable is used by queries on it
+                self.assertRaises(ValueError, source.where(lambda x: True).order_by(lambda x: x[0]).to_list)
+                self.assertListEqual(source.order_by(lambda x: x[0], budget=3).to_list(), sorted(_locations, key=lambda x: x[0]))
+            finally:
+                qlist.sort_budget = None
+        self.assertIsNone(Enumerable.sort_budget, "Budgets are not process wide")
+        self.assertListEqual(Enumerable(_locations).order_by(lambda x: x[0]).to_list(), sorted(_locations, key=lambda x: x[0]))
+
+    def test_spilled_grouping(self):
+        data = [({'id': i % 23}, i) for i in range(400)] + [(None, -1)]
+        grouped = lambda budget: [(g.key.id, g.to_list()) for g in Enumerable(data).group_by(['id'], lambda x: x[0], budget=budget)]
+        distinct = lambda budget: Enumerable(data).distinct(lambda x: x[0], budget=budget).to_list()
+        expected_groups, expected_distinct = grouped(None), distinct(None)
+        for budget in [1, 5, 30]:
+            self.assertListEqual(grouped(budget), expected_groups, "Spilled group_by matches in-memory group_by ({0})".format(budget))
+            self.assertListEqual(distinct(budget), expected_distinct, "Spilled distinct matches in-memory distinct ({0})".format(budget))
+        self.assertEqual(Enumerable(x for x in data).distinct(lambda x: x[0], budget=5).first(), data[0], "Distinct still streams")
+        self.assertRaises(ValueError, Enumerable(data).distinct(budget=0).to_list)
+
+        class Budgeted(Enumerable):
+            group_budget = 0
+        source = Enumerable(data)
+        source.group_budget = 0
+        for source in [source, Budgeted(data)]:
+            self.assertRaises(ValueError, source.distinct().to_list)
+            self.assertRaises(ValueError, source.where(lambda x: True).group_by(['id'], lambda x: x[0]).to_list)
+            self.assertRaises(ValueError, source.union([]).to_list)
+            self.assertListEqual(source.distinct(lambda x: x[0], budget=5).to_list(), expected_distinct)
+        self.assertIsNone(Enumerable.group_budget, "Budgets are not process wide")
+
     def test_median(self):
         self.assertRaises(NoElementsError, self.empty.median)
 
@@ -114,6 +200,68 @@ class TestFunctions(TestCase):
         self.assertEqual(self.simple.median(), median, "Median of simple enumerable should be {0:.5f}".format(median))
         self.assertEqual(self.complex.median(lambda x: x['value']), median, "Median of complex enumerable should be {0:.5f}".format(median))
 
+        data = [(i * 7919) % 1009 for i in range(1001)]
+        self.assertEqual(Enumerable(data).median(), sorted(data)[500], "Median of odd number of elements")
+        self.assertEqual(Enumerable(data[:-1]).median(), (sorted(data[:-1])[499] + sorted(data[:-1])[500]) / 2.0, "Median of even number of elements")
+        self.assertEqual(Enumerable([5, 5, 5, 1]).median(), 5.0, "Median with duplicates")
+
+    def test_percentile_nth_element(self):
+        self.assertRaises(NoElementsError, self.empty.percentile, 50)
+        self.assertRaises(ValueError, self.simple.percentile, 101)
+        self.assertEqual(self.simple.percentile(0), 1)
+        self.assertEqual(self.simple.percentile(100), 3)
+        self.assertEqual(self.simple.percentile(50), 2)
+        self.assertEqual(self.simple.percentile(25), 1.5, "Percentile interpolates between closest ranks")
+        self.assertEqual(self.complex.percentile(75, lambda x: x['value']), 2.5)
+
+        self.assertRaises(NoElementsError, self.simple.nth_element, 3)
+        self.assertRaises(NoElementsError, self.empty.nth_element, 0)
+        data = [(i * 7919) % 1009 for i in range(500)]
+        for n in [0, 1, 250, 499]:
+            self.assertEqual(Enumerable(data).nth_element(n), sorted(data)[n], "nth element {0}".format(n))
+        locations = sorted(_locations, key=lambda x: x[0])
+        for n in range(len(_locations)):
+            self.assertEqual(Enumerable(_locations).nth_element(n, lambda x: x[0]), locations[n], "nth element keeps order of equal keys")
+
+    def test_approx_aggregates(self):
+        self.assertEqual(self.empty.approx_count_distinct(), 0)
+        self.assertEqual(Enumerable(_locations).approx_count_distinct(0), 3, "Small counts are exact")
+        self.assertEqual(self.complex.approx_count_distinct('value'), 3)
+        estimate = Enumerable(range(100000)).select(str).approx_count_distinct()
+        self.assertLess(abs(estimate - 100000), 3000, "Estimate within three standard errors")
+        halves = [HyperLogLog().update(range(start, start + 60000)) for start in (0, 30000)]
+        self.assertLess(abs(halves[0].merge(halves[1]).count() - 90000), 2700, "Merged sketches count the union")
+        self.assertRaises(ValueError, HyperLogLog(0.01).merge, HyperLogLog(0.1))
+
+        self.assertRaises(NoElementsError, self.empty.approx_quantiles, [0.5])
+        self.assertListEqual(self.simple.approx_quantiles([0, 0.25, 0.5, 1]), [1, 1.5, 2, 3], "Small inputs are exact, as percentile")
+        data = [(i * 7919) % 10007 for i in range(10007)]
+        for q, value in zip([0.01, 0.5, 0.99], Enumerable(data).approx_quantiles([0.01, 0.5, 0.99])):
+            self.assertLess(abs(value - q * 10006), 50, "Quantile {0} within 0.5% of the range".format(q))
+        digest = TDigest().update(range(5000)).merge(TDigest().update(range(5000, 10000)))
+        self.assertEqual(digest.count(), 10000)
+        self.assertEqual(digest.quantiles([0, 1]), [0, 9999], "Extremes are exact")
+        self.assertLess(abs(digest.quantile(0.5) - 4999.5), 50)
+
+        words = ['b'] * 50 + ['a'] * 30 + ['c'] * 10 + [str(i) for i in range(200)]
+        self.assertListEqual(Enumerable(words).approx_top_k(2, error=0.001), [('b', 50), ('a', 30)])
+        top = Enumerable(words).approx_top_k(2, error=0.05)
+        self.assertListEqual([key for key, count in top], ['b', 'a'], "Frequent keys survive a small sketch")
+        self.assertTrue(all(0 <= count - expected <= 0.05 * len(words) for (key, count), expected in zip(top, [50, 30])), "Counts are overestimated within the error bound")
+        self.assertListEqual(Enumerable(_locations).approx_top_k(1, (0, 1)), [(('England', 'London'), 3)])
+        merged = SpaceSaving().update(words[:100]).merge(SpaceSaving().update(words[100:]))
+        self.assertListEqual(merged.top(3), [('b', 50), ('a', 30), ('c', 10)])
+        self.assertListEqual(Enumerable([[1], [1], [2]]).approx_top_k(1), [([1], 2)], "Unhashable keys are frozen")
+
+    def test_top_k_bottom_k(self):
+        self.assertListEqual(self.empty.top_k(2).to_list(), [])
+        self.assertListEqual(self.simple.top_k(2).to_list(), [3, 2], "Top 2 of simple enumerable")
+        self.assertListEqual(self.simple.bottom_k(5).to_list(), [1, 2, 3], "Bottom k larger than enumerable")
+        self.assertListEqual(self.complex.top_k(1, lambda x: x['value']).to_list(), [{'value': 3}])
+        self.assertListEqual(Enumerable(_locations).bottom_k(4, lambda x: x[0]).to_list(), sorted(_locations, key=lambda x: x[0])[:4], "Bottom k is stable")
+        self.assertListEqual(Enumerable(_locations).top_k(4, lambda x: x[0]).to_list(), sorted(_locations, key=lambda x: x[0], reverse=True)[:4], "Top k is stable")
+        self.assertEqual(Enumerable(x for x in range(100)).top_k(3).count(), 3)
+
     def test_skip_take(self):
         self.assertListEqual(self.empty.skip(2).to_list(), [], "Skip 2 of empty list should yield empty list")
         self.assertListEqual(self.empty.take(2).to_list(), [], "Take 2 of empty list should yield empty list")
@@ -165,6 +313,42 @@ class TestFunctions(TestCase):
         self.assertListEqual(_simple.select_many().to_list(), [1,2,3,4,5,6,7,8,9], "Select many of enumerable of simple lists should yield simple enumerable with single list")
         self.assertListEqual(_complex.select_many(lambda x: x['values']).to_list(), _simple.select_many().to_list(), "Select many of enumerable of complex list should yield simple enumerable with single list")
 
+    def test_chunk_window(self):
+        numbers = Enumerable(list(range(10)))
+        for make in [lambda: numbers, lambda: Enumerable(range(10)), lambda: Enumerable(tuple(range(10))), lambda: Enumerable((x for x in range(10)), cache='none')]:
+            self.assertListEqual(make().chunk(4).to_list(), [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]], "Chunks equal lists whatever the source")
+            self.assertListEqual(make().window(3, 3).to_list(), [[0, 1, 2], [3, 4, 5], [6, 7, 8]], "Only full windows")
+            self.assertListEqual(make().window(4, 3).to_list(), [[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 9]])
+            self.assertListEqual(make().window(2, 5).to_list(), [[0, 1], [5, 6]])
+            self.assertListEqual(make().pairwise().take(2).to_list(), [(0, 1), (1, 2)])
+        self.assertListEqual(numbers.window(11).to_list(), [])
+        self.assertListEqual(self.empty.pairwise().to_list(), [])
+        self.assertEqual((numbers.chunk(3).count(), numbers.window(3, 2).count(), numbers.pairwise().count()), (4, 4, 9), "Counts of sized sources")
+        self.assertRaises(ValueError, numbers.chunk, 0)
+        self.assertRaises(ValueError, numbers.window, 2, 0)
+
+        chunk = numbers.skip(1).chunk(4).first()
+        self.assertNotIsInstance(chunk, list, "Chunks of sequences are views")
+        self.assertEqual((len(chunk), chunk[0], chunk[-1]), (4, 1, 4))
+        self.assertEqual(chunk, (1, 2, 3, 4), "Views equal tuples of the same elements")
+        self.assertNotEqual(chunk, [1, 2, 3])
+        self.assertTrue(Enumerable([1, 2, 3, 4]).chunk(2).to_list() == [[1, 2], [3, 4]])
+
+    def test_select_batch(self):
+        batches = []
+        def double(batch):
+            batches.append(len(batch))
+            return [x * 2 for x in batch]
+        self.assertListEqual(Enumerable(range(7)).select_batch(double, 3).to_list(), [0, 2, 4, 6, 8, 10, 12])
+        self.assertListEqual(batches, [3, 3, 1], "Function is called once per batch")
+        self.assertEqual(Enumerable(range(7)).select_batch(double).count(), 7)
+        self.assertRaises(ValueError, Enumerable(range(7)).select_batch(lambda batch: [1], 3).to_list)
+        odd = Enumerable(range(10)).select_batch(lambda batch: (x for x in batch if x % 2), 3)
+        self.assertRaises(ValueError, odd.to_list)
+        self.assertListEqual(Enumerable(range(4)).select_batch(lambda batch: (x * 2 for x in batch), 3).to_list(), [0, 2, 4, 6],
+                             "Generator results are checked too")
+        self.assertRaises(NullArgumentError, self.simple.select_batch, None)
+
     def test_concat(self):
         # self.assertRaises(TypeError, self.simple.concat, _empty)
         self.assertRaises(TypeError, self.simple.concat, self.complex)
@@ -172,6 +356,41 @@ class TestFunctions(TestCase):
         self.assertListEqual(self.empty.concat(self.simple).to_list(), _simple, "Concatenation of empty to simple yields simple")
         self.assertListEqual(self.simple.concat(self.empty).to_list(), _simple, "Concatenation of simple to empty yields simple")
 
+    def test_typed_concat(self):
+        numbers = Enumerable([1, 2], element_type=int)
+        self.assertListEqual(numbers.concat([True, 3]).to_list(), [1, 2, True, 3], "Declared type accepts subclasses")
+        self.assertRaises(TypeError, numbers.concat, [4.0])
+        self.assertRaises(TypeError, numbers.add, 'a')
+        self.assertEqual(numbers.add(3).element_type, int, "Declared type is kept by concat")
+        self.assertRaises(TypeError, qlist(['a'], element_type=str).add, 1)
+
+        appended = qlist([1, 2])
+        derived = appended.add(3)
+        chained = Enumerable([0]).concat(appended)
+        derived.concat([4])
+        chained.concat([4])
+        appended.append('x')
+        self.assertRaises(TypeError, derived.concat, [5])
+        self.assertRaises(TypeError, chained.concat, [5])
+        self.assertListEqual(appended.where(lambda x: x != 'x').concat([5]).to_list(), [1, 2, 5], "Types of queries on a qlist are read again")
+
+        added = self.simple
+        for i in range(4, 1000):
+            added = added.add(i)
+        self.assertListEqual(added.to_list(), list(range(1, 1000)), "Chained add")
+        self.assertEqual(len(added.explain().splitlines()), 2, "Chained add builds a single concat")
+        self.assertRaises(TypeError, added.add, 'a')
+
+        default = Enumerable.type_checking
+        try:
+            Enumerable.type_checking = False
+            self.assertListEqual(self.simple.add('a').to_list(), [1, 2, 3, 'a'], "Type checking can be turned off")
+        finally:
+            Enumerable.type_checking = default
+        trusted = Enumerable([1])
+        trusted.type_checking = False
+        self.assertListEqual(trusted.concat(['a']).to_list(), [1, 'a'], "Type checking can be turned off per enumerable")
+
     def test_group_by(self):
         simple_grouped = self.simple.group_by(key_names=['id'])
         self.assertEqual(simple_grouped.count(), 3, "Three grouped elements in simple grouped")
@@ -189,6 +408,68 @@ class TestFunctions(TestCase):
         london = locations_grouped.single(lambda g: g.key.city == 'London' and g.key.country == 'England')
         self.assertEqual(london.sum(lambda g: g[3]), 240000, "Sum of London, England location does not equal")
 
+        self.assertListEqual(locations_grouped.select(lambda g: g.key.city).take(3).to_list(), ['Edinburgh', 'Glasgow', 'Cardiff'], "Groups are yielded in first-seen order")
+        mixed = Enumerable([1, 'a', 1, {'k': 1}, 'a', {'k': 1}]).group_by(key_names=['id'])
+        self.assertListEqual(mixed.select(lambda g: g.count()).to_list(), [2, 2, 2], "Group by does not require orderable keys")
+
+        grouped = Enumerable(x for x in _simple).group_by(key_names=['id'], key=lambda x: x % 2)
+        self.assertListEqual(grouped.select(lambda g: (g.key.id, g.to_list())).to_list(), [(1, [1, 3]), (0, [2])], "Group by generator source")
+
+    def test_group_keys(self):
+        glasgow = Enumerable(_locations).group_by(key_names=['country', 'city'], key=lambda x: (x[0], x[1])).elementAt(1)
+        self.assertIsInstance(glasgow.key, Key, "Compact keys are Keys")
+        self.assertEqual((glasgow.key.country, glasgow.key.city), ('Scotland', 'Glasgow'))
+        self.assertEqual(repr(glasgow.key), repr({'country': 'Scotland', 'city': 'Glasgow'}), "Compact keys print like Keys")
+        self.assertFalse(hasattr(glasgow.key, '__dict__'), "Compact keys have no instance dict")
+        self.assertListEqual(glasgow.select(lambda x: x[2]).to_list(), ['Branch1', 'Branch2'], "Groupings are enumerables")
+
+        spaced = self.simple.group_by(key_names=['my id', 'my id']).first()
+        self.assertEqual(getattr(spaced.key, 'my id'), 1, "Names that are not identifiers fall back to dict keys")
+        self.assertIsInstance(Grouping(Key({"id": 1}), (x for x in _simple)).key, Key)
+        self.assertListEqual(Grouping(Key(id=1), (x for x in _simple)).to_list(), _simple, "Groupings accept any iterable")
+
+    def test_pickle_groupings(self):
+        groups = Enumerable(_locations).group_by(key_names=['country', 'city'], key=lambda x: (x[0], x[1])).to_list()
+        copies = pickle.loads(pickle.dumps(groups))
+        self.assertListEqual([g.key for g in copies], [g.key for g in groups], "Compact keys survive a pickle round trip")
+        self.assertIs(type(copies[0].key), type(groups[0].key), "Unpickled keys share the generated key type")
+        self.assertListEqual([g.to_list() for g in copies], [g.to_list() for g in groups])
+        self.assertEqual(pickle.loads(pickle.dumps(Key(id=1))).id, 1)
+
+    def test_to_lookup_to_dictionary(self):
+        lookup = Enumerable(_locations).to_lookup(lambda x: x[0], lambda x: x[3])
+        self.assertEqual(len(lookup), 3, "Three countries in locations lookup")
+        self.assertEqual(lookup['Wales'].sum(), 29700 + 30000 + 12800, "Lookup indexing yields the values of the key")
+        self.assertEqual(lookup['France'].count(), 0, "Missing lookup key yields empty enumerable")
+        self.assertTrue('Scotland' in lookup)
+        self.assertListEqual(lookup.select(lambda g: g.key.key).to_list(), ['Scotland', 'Wales', 'England'], "Lookup iterates groupings in first-seen order")
+        self.assertListEqual(Enumerable(_locations).to_lookup(0, key_names=['country']).select(lambda g: g.key.country).to_list(),
+                             ['Scotland', 'Wales', 'England'])
+
+        self.assertDictEqual(self.complex.to_dictionary(lambda x: x['value']), {1: {'value': 1}, 2: {'value': 2}, 3: {'value': 3}})
+        self.assertDictEqual(self.simple.to_dictionary(value_func=lambda x: x * 10), {1: 10, 2: 20, 3: 30})
+        self.assertRaises(MoreThanOneMatchingElement, Enumerable(_locations).to_dictionary, lambda x: x[0])
+
+    def test_field_selectors(self):
+        locations = Enumerable(_locations)
+        self.assertListEqual(self.complex.select('value').to_list(), _simple, "String specs pick items")
+        self.assertEqual(locations.sum(3), locations.sum(lambda x: x[3]), "Int specs pick items")
+        self.assertListEqual(locations.order_by(0).then_by_descending(3).select((1, 2)).take(2).to_list(), [('London', 'Branch1'), ('London', 'Branch2')])
+        self.assertListEqual(locations.group_by(key_names=['country', 'city'], key=(0, 1)).select(lambda g: g.key.city).to_list()[:3], ['Edinburgh', 'Glasgow', 'Cardiff'])
+        self.assertListEqual(self.complex.select(('value',)).to_list(), [(1,), (2,), (3,)], "Single field tuples select 1-tuples")
+        self.assertEqual(self.complex.where('value').count(), 3)
+        self.assertDictEqual(locations.to_lookup(0, 3).to_dictionary(lambda g: g.key.key, lambda g: g.sum()), {'Scotland': 44500, 'Wales': 72500, 'England': 390300})
+        self.assertTrue(self.complex.contains({'value': 2}, 'value'))
+
+        keys = Enumerable([Key(id=i) for i in _simple])
+        self.assertEqual(keys.max('.id'), 3, "Leading dot picks an attribute")
+        groups = Enumerable(_locations).group_by(key_names=['country'], key=0)
+        self.assertListEqual(groups.select('key.country').to_list(), ['Scotland', 'Wales', 'England'], "Dotted specs pick attribute paths")
+        self.assertListEqual(groups.select(('key.country', len)).to_list(), [('Scotland', 3), ('Wales', 3), ('England', 7)], "Mixed tuple specs")
+        self.assertRaises(TypeError, self.simple.select, 1.5)
+
+        self.assertEqual(self.simple.select().explain().count('select'), 0, "Identity projections are optimized away")
+
     def test_reverse(self):
         self.assertListEqual(self.empty.reverse().to_list(), [], "Reverse empty enumerable yields empty list")
         self.assertListEqual(self.simple.reverse().to_list(), [3,2,1], "Reverse simple enumerable")
@@ -217,11 +498,25 @@ class TestFunctions(TestCase):
         self.assertEqual(locations.count(), 3, "Three distinct countries in locations enumerable")
         self.assertListEqual(locations.to_list(),
                              [
-                                 ('England', 'London', 'Branch1', 90000),
                                  ('Scotland', 'Edinburgh', 'Branch1', 20000),
-                                 ('Wales', 'Cardiff', 'Branch1', 29700)
+                                 ('Wales', 'Cardiff', 'Branch1', 29700),
+                                 ('England', 'London', 'Branch1', 90000)
                              ],
                              "Distinct locations do not match")
+        self.assertListEqual(Enumerable([3, 1, 3, 2, 1]).distinct().to_list(), [3, 1, 2], "Distinct keeps first-seen order")
+        self.assertListEqual(Enumerable([{'a': 1}, {'a': 2}, {'a': 1}]).distinct().to_list(), [{'a': 1}, {'a': 2}], "Distinct of unhashable dicts")
+        self.assertListEqual(Enumerable([[1, 2], [2, 1], [1, 2]]).distinct().to_list(), [[1, 2], [2, 1]], "Distinct of unhashable lists")
+        self.assertListEqual(Enumerable(x % 3 for x in range(10)).distinct().take(2).to_list(), [0, 1], "Distinct is lazy on generator sources")
+
+        class Point(object):
+            __hash__ = None
+            def __init__(self, x):
+                self.x = x
+            def __eq__(self, other):
+                return self.x == other.x
+        points = Enumerable([Point(1), Point(2), Point(1)])
+        self.assertListEqual(points.distinct().select(lambda p: p.x).to_list(), [1, 2], "Distinct falls back to equality for unhashable objects")
+        self.assertListEqual(points.except_(Enumerable([Point(2)])).select(lambda p: p.x).to_list(), [1, 1], "Except falls back to equality for unhashable objects")
 
     def test_default_if_empty(self):
         self.assertListEqual(self.empty.default_if_empty().to_list(), [None], "Default if empty of empty enumerable should yield None singleton")
@@ -247,6 +542,8 @@ class TestFunctions(TestCase):
         self.assertListEqual(self.simple.intersect(self.complex).to_list(), [], "Intersect of simple and complex enumerable yields empty list")
         self.assertListEqual(self.complex.intersect(self.complex).to_list(), _complex, "Intersect of two complex enumeraable yields complex list")
         self.assertListEqual(self.complex.intersect(Enumerable([{'value': 1}])).to_list(), [{'value': 1}], "Intersect of complex enumerable with {'value': 1} yields {'value': 1}")
+        self.assertListEqual(Enumerable([3, 1, 3, 2]).intersect(Enumerable([2, 3, 5])).to_list(), [3, 2], "Intersect yields once per key in first-seen order")
+        self.assertListEqual(self.complex.intersect(self.simple, key=lambda x: x['value'] if isinstance(x, dict) else x).to_list(), _complex, "Intersect with key selector")
 
     def test_except(self):
         self.assertListEqual(self.empty.except_(self.empty).to_list(), [], "Complement of two empty enumerables yields empty list")
@@ -258,6 +555,7 @@ class TestFunctions(TestCase):
         self.assertListEqual(self.complex.except_(self.simple).to_list(), _complex, "Complement of complex and simple yields complex")
         self.assertListEqual(self.complex.except_(self.complex).to_list(), [], "Complement of complex and complex yields empty")
         self.assertListEqual(self.complex.except_(Enumerable([{'value': 1}])).to_list(), [{'value': 2}, {'value': 3}], "Complement of complex enumerable with {'value': 1} yields [{'value': 2}, 'value': 3]")
+        self.assertListEqual(Enumerable([3, 1, 3, 2]).except_(Enumerable([2])).to_list(), [3, 1, 3], "Complement keeps the original order")
 
     def test_union(self):
         self.assertListEqual(self.empty.union(self.empty).to_list(), [], "Union of two empty enumerables yields empty list")
@@ -275,6 +573,7 @@ class TestFunctions(TestCase):
         keySelector = lambda x: x['value']
         self.assertListEqual(self.complex.union(Enumerable([{'value': 4}, {'value': 5}])).to_list(), complex_extended, "Union of complex and [{'value': 4}, {'value': 5}] yield complex + [{'value': 4}, {'value': 5}]")
         self.assertListEqual(self.complex.union(Enumerable([{'value': 1}, {'value': 4}, {'value': 5}]), keySelector).order_by(keySelector).to_list(), complex_extended, "Union of complex and [{'value': 1}, {'value': 4}, {'value': 5}] yield complex + [{'value': 4}, {'value': 5}]")
+        self.assertListEqual(Enumerable([3, 1]).union(Enumerable([2, 3, 4])).to_list(), [3, 1, 2, 4], "Union keeps first-seen order")
 
     def test_join(self):
         self.assertListEqual(self.empty.join(self.empty).to_list(), [], "Joining 2 empty lists should yield empty list")
@@ -288,6 +587,20 @@ class TestFunctions(TestCase):
 
         self.assertListEqual(self.complex.join(self.complex, result_func=lambda x: (x[0]['value'], x[1]['value'])).order_by(lambda x: (x[0], x[1])).to_list(), [(1,1), (2,2), (3,3)], "Joining complex to complex and projecting result yields [(1,1), (2,2), (3,3)]")
 
+        orders = Enumerable([('o1', 'b'), ('o2', 'a'), ('o3', 'b'), ('o4', 'z')])
+        customers = Enumerable([('a', 1), ('b', 2), ('b', 3)])
+        self.assertListEqual(orders.join(customers, lambda o: o[1], lambda c: c[0], lambda x: (x[0][0], x[1][1])).to_list(),
+                             [('o1', 2), ('o1', 3), ('o2', 1), ('o3', 2), ('o3', 3)],
+                             "Join should be ordered by outer element, then by inner element")
+        self.assertListEqual(customers.join(orders, lambda c: c[0], lambda o: o[1], lambda x: (x[0][1], x[1][0])).to_list(),
+                             [(1, 'o2'), (2, 'o1'), (2, 'o3'), (3, 'o1'), (3, 'o3')],
+                             "Join building on the smaller outer side should keep the same ordering")
+        self.assertListEqual(Enumerable(x for x in range(3)).join(Enumerable(x for x in range(2))).to_list(), [(0, 0), (1, 1)],
+                             "Join of generator sources should stream")
+
+        large = Enumerable(range(100000))
+        self.assertEqual(large.join(Enumerable(range(0, 100000, 2))).count(), 50000, "Hash join of large enumerables")
+
     def test_group_join(self):
         self.assertListEqual(self.empty.group_join(self.empty).to_list(), [], "Group join 2 empty yields empty")
 
@@ -316,3 +629,160 @@ class TestFunctions(TestCase):
             self.assertEqual(e['number'], i + 1, "number property should be {0}".format(i + 1))
             self.assertEqual(e['collection'].count(), 0 if i == 0 else 1, "should have {0} element(s)".format(0 if i == 0 else 1))
             self.assertListEqual(e['collection'].to_list(), [] if i==0 else [i + 1], "Collection should equal {0}".format([] if i==0 else [i + 1]))
+
+        outer = Enumerable([1, 1, 4])
+        gj = outer.group_join(Enumerable([1, 2, 1]), result_func=lambda x: (x[0], x[1].to_list())).to_list()
+        self.assertListEqual(gj, [(1, [1, 1]), (1, [1, 1]), (4, [])], "Group join yields one result per outer element, unmatched ones included")
+
+    def test_sorted_inputs(self):
+        locations = Enumerable(_locations)
+        by_country = locations.order_by(0)
+        grouped = by_country.group_by(key_names=['country'], key=0)
+        self.assertIn('sorted_group_by', grouped.explain(), "Grouping sorted data streams")
+        self.assertListEqual(grouped.select(lambda g: (g.key.country, g.count())).to_list(), [('England', 7), ('Scotland', 3), ('Wales', 3)])
+        self.assertListEqual(by_country.distinct(0).select(0).to_list(), ['England', 'Scotland', 'Wales'])
+        self.assertNotIn('sorted', locations.order_by(1).group_by(key_names=['country'], key=0).explain(), "Other keys use hashing")
+
+        outer = Enumerable([1, 1, 2, 4, 5]).assume_sorted()
+        inner = Enumerable([1, 3, 4, 4, 5, 6]).assume_sorted()
+        self.assertIn('merge_join', outer.join(inner).explain())
+        self.assertListEqual(outer.join(inner).to_list(), [(1, 1), (1, 1), (4, 4), (4, 4), (5, 5)])
+        self.assertListEqual(outer.group_join(inner, result_func=lambda x: (x[0], x[1].to_list())).to_list(),
+                             [(1, [1]), (1, [1]), (2, []), (4, [4, 4]), (5, [5])])
+        self.assertListEqual(outer.intersect(inner).to_list(), [1, 4, 5])
+        self.assertListEqual(outer.except_(inner).to_list(), [2])
+        self.assertListEqual(outer.distinct().to_list(), [1, 2, 4, 5])
+
+        descending = Enumerable([5, 4, 2, 1]).assume_sorted(descending=True)
+        self.assertListEqual(descending.intersect(Enumerable([6, 4, 1]).assume_sorted(descending=True)).to_list(), [4, 1])
+        self.assertNotIn('merge', descending.intersect(inner).explain(), "Different orders are not merged")
+        self.assertListEqual(descending.intersect(inner).to_list(), [5, 4, 1])
+
+        records = Enumerable(_complex).assume_sorted('value')
+        joined = records.join(Enumerable(_complex).order_by('value'), 'value', 'value', lambda x: x[0]['value'])
+        self.assertIn('merge_join', joined.explain(), "Keys compiled from the same field spec match")
+        self.assertListEqual(joined.to_list(), _simple)
+        self.assertEqual(records.order_by('value').explain().count('order_by'), 0, "Sorting sorted data is skipped")
+
+    def test_merge_sorted(self):
+        merged = Enumerable([1, 4, 7]).merge_sorted([2, 5, 8], Enumerable([3, 6, 9]))
+        self.assertListEqual(merged.to_list(), list(range(1, 10)))
+        self.assertEqual(len(merged), 9)
+        self.assertListEqual(Enumerable([]).merge_sorted([]).to_list(), [])
+
+        first = Enumerable([('a', 1), ('b', 1)]).order_by_descending(0)
+        self.assertListEqual(first.merge_sorted([('c', 2), ('a', 2)]).to_list(), [('c', 2), ('b', 1), ('a', 1), ('a', 2)],
+                             "The known order of self is used, ties keep the order of the enumerables")
+        merged = Enumerable(_complex).merge_sorted(_complex, key='value')
+        self.assertListEqual(merged.select('value').to_list(), [1, 1, 2, 2, 3, 3])
+        self.assertIn('sorted_group_by', merged.group_by(key_names=['value'], key='value').explain(), "Merged data is known to be sorted")
+
+    def test_query_plan(self):
+        query = Enumerable(range(100)).order_by(lambda x: -x).where(lambda x: x % 2).take(5)
+        self.assertEqual(query.explain(optimized=False).splitlines(),
+                         ['source: range (length 100)', '-> order_by(<lambda>, False)', '-> where(<lambda>)', '-> take(5)'],
+                         "Unoptimized plan lists operators as written")
+        self.assertEqual(query.explain().splitlines(),
+                         ['source: range (length 100)', '-> where(<lambda>)', '-> top_k(5, <lambda>, False)'],
+                         "Where is pushed below order_by and order_by.take becomes top_k")
+        self.assertListEqual(query.to_list(), [99, 97, 95, 93, 91], "Optimized plan yields the same result")
+
+        merged = self.simple.where(lambda x: x > 1).where(lambda x: x < 3)
+        self.assertEqual(merged.explain().splitlines()[1:], ['-> where(<lambda>, <lambda>)'], "Adjacent where clauses are merged")
+        self.assertListEqual(merged.to_list(), [2])
+
+        locations = Enumerable(_locations)
+        for skip, take in [(0, 3), (2, 4), (10, 10)]:
+            expected = sorted(_locations, key=lambda x: x[0])[skip:skip + take]
+            self.assertListEqual(locations.order_by(lambda x: x[0]).skip(skip).take(take).to_list(), expected, "Top-k is stable")
+            expected = sorted(_locations, key=lambda x: x[3], reverse=True)[skip:skip + take]
+            self.assertListEqual(locations.order_by_descending(lambda x: x[3]).skip(skip).take(take).to_list(), expected, "Descending top-k is stable")
+        self.assertEqual(locations.order_by(lambda x: x[3]).first(), ('Scotland', 'Glasgow', 'Branch2', 12000), "First of order_by")
+
+    def test_query_count(self):
+        calls = []
+        def project(x):
+            calls.append(x)
+            return x
+        sized = Enumerable(list(range(1000)))
+        self.assertEqual(sized.select(project).order_by(lambda x: x).count(), 1000, "Count of projection of sized source")
+        self.assertListEqual(calls, [], "Count of a sized projection should not run the selector")
+        self.assertEqual(sized.skip(10).take(20).count(), 20)
+        self.assertEqual(sized.concat(self.empty).count(), 1000)
+        self.assertEqual(Enumerable(x for x in range(10)).where(lambda x: x % 2).count(), 5, "Count of filtered generator")
+
+        query = self.simple.select(project)
+        self.assertListEqual(query.to_list(), _simple)
+        self.assertListEqual(query.to_list(), _simple, "Queries are executed again on every iteration")
+        self.assertEqual(len(calls), 6)
+
+
+@skipIf(numpy is None, "numpy is not installed")
+class TestArrayEnumerable(TestCase):
+    def setUp(self):
+        self.data = numpy.arange(1, 101)
+        self.array = Enumerable(self.data)
+        self.empty = Enumerable.from_array([])
+
+    def test_select_batch(self):
+        batches = []
+        def scale(batch):
+            batches.append(batch)
+            return batch * 10
+        self.assertListEqual(self.array.select_batch(scale, 40).to_list(), list(range(10, 1001, 10)))
+        self.assertTrue(all(isinstance(batch, numpy.ndarray) and batch.base is self.data for batch in batches), "Batches are array views")
+
+    def test_detection(self):
+        self.assertIsInstance(self.array, ArrayEnumerable, "Numeric numpy arrays are detected")
+        self.assertIs(self.array._data, self.data, "Arrays are not copied")
+        self.assertIsInstance(Enumerable(array('d', [1.0, 2.0])), ArrayEnumerable, "array.array is detected")
+        data = array('i', [1, 2, 3])
+        wrapped = Enumerable(data)
+        data.append(4)
+        self.assertListEqual(wrapped.to_list(), [1, 2, 3], "array.array is copied, so it can still grow")
+        self.assertNotIsInstance(Enumerable(numpy.array(['a', 'b'])), ArrayEnumerable, "Non numeric arrays use the generic path")
+        self.assertIsInstance(Enumerable.from_array(_simple), ArrayEnumerable)
+        self.assertListEqual(Enumerable.from_array(x for x in _simple).to_list(), _simple)
+        for data in [numpy.array([1, 2]), array('i', [1, 2])]:
+            typed = Enumerable(data, element_type=int)
+            self.assertIsInstance(typed, ArrayEnumerable)
+            self.assertIs(typed.element_type, int, "Arrays accept a declared element type")
+            self.assertListEqual(typed.concat([3]).to_list(), [1, 2, 3])
+            self.assertRaises(TypeError, typed.concat, ['x'])
+
+    def test_aggregates(self):
+        self.assertEqual(self.array.count(), 100)
+        self.assertEqual(self.array.sum(), 5050)
+        self.assertEqual(self.array.min(), 1)
+        self.assertEqual(self.array.max(lambda x: x * 2), 200)
+        self.assertEqual(self.array.avg(), 50.5)
+        self.assertEqual(self.array.median(), 50.5)
+        self.assertEqual(Enumerable.from_array([3, 1, 2]).median(), 2)
+        self.assertEqual(self.array.percentile(25), 25.75)
+        self.assertEqual(self.array.sum(lambda x: 1 if x > 50 else 0), 50, "Functions are called per element")
+        self.assertEqual(self.empty.sum(), 0)
+        for name in ['min', 'max', 'avg', 'median']:
+            self.assertRaises(NoElementsError, getattr(self.empty, name))
+
+    def test_select_where(self):
+        filtered = self.array.where_vectorized(lambda x: x > 90)
+        self.assertIsInstance(filtered, ArrayEnumerable, "Vectorized predicates keep the array backend")
+        self.assertListEqual(filtered.to_list(), list(range(91, 101)))
+        self.assertEqual(self.array.where_vectorized(lambda x: x % 2 == 0).select_vectorized(lambda x: x / 2).sum(), 1275)
+        self.assertRaises(ValueError, self.array.where_vectorized, lambda x: x * 2)
+        self.assertRaises(ValueError, self.array.select_vectorized, lambda x: x.sum())
+        generic = self.array.where(lambda x: x > 90 and x % 2 == 0)
+        self.assertNotIsInstance(generic, ArrayEnumerable)
+        self.assertListEqual(generic.to_list(), [92, 94, 96, 98, 100])
+        floats = Enumerable(numpy.array([1., 2., 4.]))
+        self.assertListEqual(floats.select(lambda v: v / v.sum()).to_list(), [1, 1, 1], "select calls its function per element")
+        self.assertListEqual(floats.select_vectorized(lambda v: v / v.sum()).to_list(), [1 / 7., 2 / 7., 4 / 7.])
+        self.assertListEqual(self.array.select(lambda x: {'v': x}).take(1).select(lambda x: int(x['v'])).to_list(), [1])
+        self.assertListEqual(self.array.order_by_descending(lambda x: x).take(2).to_list(), [100, 99], "Other operators use the generic path")
+
+    def test_sketches(self):
+        sketch = HyperLogLog().update(self.data)
+        self.assertEqual(sketch._registers, HyperLogLog().update(_simple + list(range(4, 101)))._registers, "Vectorized hashing matches")
+        self.assertEqual(self.array.approx_count_distinct(), 100)
+        self.assertListEqual(self.array.approx_quantiles([0, 0.5, 1]), [1, 50.5, 100])
+
@@ -0,0 +1,344 @@
+__author__ = 'Viralogic Software'
+
+import itertools
+import threading
+from collections.abc import Sequence
+from unittest import TestCase
+from py_linq import *
+from tests import _simple, _complex, _locations
+
+
+class CountingIterable(object):
+    """
+    Iterable that records how many times it was iterated and how many elements were pulled from it
+    """
+    def __init__(self, data):
+        self.data = list(data)
+        self.iterations = 0
+        self.pulled = 0
+
+    def __iter__(self):
+        self.iterations += 1
+        for element in self.data:
+            self.pulled += 1
+            yield element
+
+
+class CountingSequence(Sequence):
+    """
+    Sequence that records how many elements were read from it
+    """
+    def __init__(self, data):
+        self.data = list(data)
+        self.reads = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        self.reads += 1
+        return self.data[i]
+
+
+class TestIteration(TestCase):
+    def setUp(self):
+        self.simple = CountingIterable(_simple)
+        self.complex = CountingIterable(_complex)
+        self.empty = CountingIterable([])
+
+    def assertSinglePass(self, source, message):
+        self.assertEqual(source.iterations, 1, message + " should iterate the source once")
+        self.assertEqual(source.pulled, len(source.data), message + " should pull every element exactly once")
+
+    def test_aggregates_single_pass(self):
+        self.assertEqual(Enumerable(self.simple).min(), 1)
+        self.assertSinglePass(self.simple, "min")
+
+        self.assertEqual(Enumerable(self.complex).max(lambda x: x['value']), 3)
+        self.assertSinglePass(self.complex, "max")
+
+        source = CountingIterable(_simple)
+        self.assertEqual(Enumerable(source).avg(), 2.0)
+        self.assertSinglePass(source, "avg")
+
+        source = CountingIterable(_simple)
+        self.assertEqual(Enumerable(source).median(), 2)
+        self.assertSinglePass(source, "median")
+
+        source = CountingIterable(_simple)
+        self.assertEqual(Enumerable(source).sum(), 6)
+        self.assertSinglePass(source, "sum")
+
+        source = CountingIterable(_simple)
+        self.assertEqual(Enumerable(source).count(), 3)
+        self.assertSinglePass(source, "count")
+
+    def test_concat_single_pass(self):
+        result = Enumerable(self.simple)
+        for i in range(4, 10):
+            result = result.add(i)
+        self.assertSinglePass(self.simple, "Type checks of chained add")
+        self.assertListEqual(result.to_list(), list(range(1, 10)))
+
+    def test_chained_add_is_linear(self):
+        source = CountingIterable([0])
+        base = Enumerable(source)
+        result = base
+        for i in range(10000):
+            result = result.add(i)
+            if i == 4999:
+                middle = result
+        root, steps = result._plan()
+        self.assertIs(root, base)
+        self.assertEqual([op for op, args in steps], ['concat'], "Chained adds build a single concat")
+        chain = steps[0][1][0]
+        self.assertEqual(len(chain), 10000, "The concat holds one flat chain of the added enumerables")
+        self.assertTrue(all(part._data == [i] for i, part in enumerate(chain)), "Added enumerables are not nested")
+        self.assertIs(middle._data.args[0]._parts, chain._parts, "Adds append to the shared chain instead of copying it")
+        self.assertEqual(len(middle), 5001)
+        self.assertListEqual(result.skip(9998).to_list(), [9997, 9998, 9999])
+        self.assertEqual(source.iterations, 1, "The source is read once, for the type check, and replayed after")
+
+        first = Enumerable([1])
+        second, third = first.add(2), first.add(3)
+        self.assertListEqual(second.add(4).to_list(), [1, 2, 4], "Appending to a shared chain branches off")
+        self.assertListEqual(second.to_list(), [1, 2])
+        self.assertListEqual(third.to_list(), [1, 3])
+
+    def test_concat_keeps_streams(self):
+        stream = CountingIterable(_simple)
+        result = Enumerable(stream, cache='none').concat([4])
+        self.assertEqual(stream.iterations, 0, "Type checks do not read streams")
+        self.assertListEqual(result.to_list(), [1, 2, 3, 4])
+        self.assertListEqual(Enumerable([1]).concat(Enumerable((x for x in [2, 3]), cache='none')).to_list(), [1, 2, 3])
+
+    def test_repr_does_not_run_queries(self):
+        source = CountingIterable(_simple)
+        query = Enumerable(source, cache='none').where(lambda x: x > 1).take(2)
+        self.assertEqual(repr(query).splitlines(), ['source: CountingIterable', '-> where(<lambda>)', '-> take(2)'], "Queries print their plan")
+        self.assertEqual(source.iterations, 0)
+
+    def test_replay_repr_is_bounded(self):
+        endless = Enumerable(itertools.count())
+        self.assertEqual(repr(endless), 'count(0) (0 elements buffered)', "Endless sources are not drained")
+        self.assertListEqual(endless.take(2).to_list(), [0, 1])
+        self.assertEqual(repr(endless), 'count(2) (2 elements buffered)')
+        replayed = Enumerable(x for x in _simple)
+        replayed.to_list()
+        self.assertEqual(repr(replayed), repr(_simple), "Exhausted sources print their elements")
+
+    def test_batches_are_lazy(self):
+        self.assertListEqual(Enumerable(self.simple, cache='none').chunk(2).first(), [1, 2])
+        self.assertEqual(self.simple.pulled, 2, "chunk pulls one chunk at a time")
+        source = CountingIterable(range(100))
+        self.assertListEqual(Enumerable(source, cache='none').window(3).elementAt(1), [1, 2, 3])
+        self.assertEqual(source.pulled, 4, "window buffers a single window")
+
+    def test_sorted_inputs_stream(self):
+        source = CountingIterable(x // 10 for x in range(1000))
+        groups = Enumerable(source, cache='none').assume_sorted().group_by(key_names=['id'])
+        self.assertEqual(groups.first().count(), 10)
+        self.assertEqual(source.pulled, 11, "Sorted group_by holds a single group")
+
+        outer = CountingIterable(range(0, 1000, 2))
+        inner = CountingIterable(range(0, 1000, 3))
+        joined = Enumerable(outer, cache='none').assume_sorted().join(Enumerable(inner, cache='none').assume_sorted())
+        self.assertListEqual(joined.take(2).to_list(), [(0, 0), (6, 6)])
+        self.assertEqual((outer.pulled, inner.pulled), (4, 4), "Merge join pulls both sides in step")
+
+        merged = Enumerable(CountingIterable(range(0, 100, 2)), cache='none').merge_sorted(self.simple)
+        self.assertListEqual(merged.take(3).to_list(), [0, 1, 2])
+        self.assertLessEqual(self.simple.pulled, 3, "merge_sorted is lazy")
+
+    def test_empty_aggregates_single_pass(self):
+        for name in ['min', 'max', 'avg', 'median', 'first', 'last']:
+            source = CountingIterable([])
+            self.assertRaises(NoElementsError, getattr(Enumerable(source), name))
+            self.assertEqual(source.iterations, 1, "{0} on empty source should iterate once".format(name))
+
+    def test_accessors_short_circuit(self):
+        self.assertEqual(Enumerable(self.simple).first(), 1)
+        self.assertEqual(self.simple.pulled, 1, "first should pull a single element")
+
+        self.assertEqual(Enumerable(self.complex).first(lambda x: x['value'] == 2), {'value': 2})
+        self.assertEqual(self.complex.pulled, 2, "first with predicate should stop at the match")
+
+        source = CountingIterable(_simple)
+        self.assertEqual(Enumerable(source).elementAt(1), 2)
+        self.assertEqual(source.pulled, 2, "elementAt(1) should pull two elements")
+
+        source = CountingIterable(_simple)
+        self.assertTrue(Enumerable(source).any(lambda x: x == 1))
+        self.assertEqual(source.pulled, 1, "any should stop at the first match")
+
+        source = CountingIterable(_simple)
+        self.assertRaises(MoreThanOneMatchingElement, Enumerable(source).single, lambda x: x > 1)
+        self.assertEqual(source.pulled, 3, "single should stop after the second match")
+
+        source = CountingIterable(_simple)
+        Enumerable(source).default_if_empty()
+        self.assertEqual(source.pulled, 1, "default_if_empty should only test for a first element")
+
+    def test_last_single_pass(self):
+        self.assertEqual(Enumerable(self.simple).last(), 3)
+        self.assertSinglePass(self.simple, "last")
+
+        self.assertEqual(Enumerable(self.complex).last(lambda x: x['value'] < 3), {'value': 2})
+        self.assertSinglePass(self.complex, "last with predicate")
+
+    def test_partial_iteration_keeps_elements(self):
+        enumerable = Enumerable(x for x in _simple)
+        self.assertEqual(enumerable.first(), 1)
+        self.assertEqual(enumerable.first(), 1, "first should not consume elements from a generator source")
+        self.assertListEqual(enumerable.to_list(), _simple, "Short-circuiting accessors should not lose elements")
+        self.assertEqual(enumerable.last(), 3)
+
+    def test_cache_policies(self):
+        data = list(_simple)
+        for policy in ['none', 'replay', 'materialize']:
+            self.assertIs(Enumerable(data, cache=policy)._data, data, "Lists are never copied ({0})".format(policy))
+
+        streaming = Enumerable((x for x in _simple), cache='none')
+        self.assertListEqual(streaming.to_list(), _simple)
+        self.assertListEqual(streaming.to_list(), [], "Streaming policy does not buffer a generator")
+
+        source = CountingIterable(_simple)
+        materialized = Enumerable(source, cache='materialize')
+        self.assertSinglePass(source, "materialize")
+        self.assertListEqual(materialized.to_list(), _simple)
+        self.assertEqual(source.iterations, 1, "Materialized data is not iterated again")
+
+        source = CountingIterable(_simple)
+        replayed = Enumerable(source)
+        iterator = iter(replayed)
+        self.assertEqual(next(iterator), 1)
+        self.assertListEqual(replayed.to_list(), _simple, "Replay serves a second iterator while the first is suspended")
+        self.assertListEqual(list(iterator), [2, 3], "Suspended iterator continues from the shared buffer")
+        self.assertSinglePass(source, "replay")
+        self.assertEqual(replayed.count(), 3)
+
+        self.assertRaises(ValueError, Enumerable, _simple, 'sometimes')
+
+    def test_default_cache_policy(self):
+        default = Enumerable.default_cache
+        try:
+            Enumerable.default_cache = 'none'
+            streaming = Enumerable(x for x in _simple)
+            streaming.to_list()
+            self.assertListEqual(streaming.to_list(), [], "Default cache policy is configurable")
+        finally:
+            Enumerable.default_cache = default
+
+    def test_concurrent_replay(self):
+        size = 20000
+        enumerable = Enumerable(x for x in range(size))
+        results = []
+        def read():
+            results.append(enumerable.select(lambda x: x * 2).to_list())
+        threads = [threading.Thread(target=read) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = [x * 2 for x in range(size)]
+        self.assertEqual(len(results), 8)
+        for result in results:
+            self.assertListEqual(result, expected, "Concurrent readers all see every element in order")
+
+    def test_profile(self):
+        query = Enumerable(self.simple).where(lambda x: x > 1).select(lambda x: x * 10)
+        profile = query.profile()
+        self.assertListEqual([stage.op for stage in profile], ['source', 'where', 'select'])
+        source, where, select = profile.stages
+        self.assertEqual(source.elements_out, 3)
+        self.assertEqual((where.elements_in, where.elements_out, where.calls), (3, 2, 3))
+        self.assertEqual((select.elements_in, select.elements_out, select.calls), (2, 2, 2))
+        self.assertTrue(all(stage.seconds >= 0 for stage in profile), "Operator times exclude upstream operators")
+
+        report = query.explain(analyze=True).split("\n")
+        self.assertEqual(len(report), 3)
+        self.assertTrue(report[1].startswith("-> where(<lambda>)  [in 3, out 2, calls 3, "))
+
+    def test_profiler_callback(self):
+        self.assertIsNone(Enumerable.profiler, "Profiling is disabled by default")
+        profiles = []
+        try:
+            Enumerable.profiler = profiles.append
+            self.assertListEqual(Enumerable(_simple).select(lambda x: x + 1).to_list(), [2, 3, 4])
+            self.assertEqual(Enumerable(_simple).where(lambda x: x > 1).first(), 2)
+        finally:
+            Enumerable.profiler = None
+        self.assertEqual(len(profiles), 2, "Every executed query is reported once")
+        self.assertEqual(profiles[0].stages[-1].elements_out, 3)
+        self.assertEqual(profiles[1].stages[1].calls, 2, "Short-circuited queries report what they did")
+        Enumerable(_simple).select(lambda x: x).to_list()
+        self.assertEqual(len(profiles), 2, "Nothing is reported once the profiler is reset")
+
+    def test_sequence_fast_paths(self):
+        source = CountingSequence(range(1000))
+        enumerable = Enumerable(source)
+        self.assertEqual(len(enumerable.skip(100).take(500).reverse()), 500, "len of a sized query")
+        self.assertEqual(enumerable.skip(100).take(500).reverse().elementAt(0), 599)
+        self.assertEqual(enumerable.skip(100).reverse().elementAt(10), 989)
+        self.assertEqual(enumerable.take(10).last(), 9)
+        self.assertEqual(source.reads, 3, "elementAt and last read a single element of a sequence")
+
+        self.assertListEqual(enumerable.skip(995).to_list(), [995, 996, 997, 998, 999])
+        self.assertEqual(source.reads, 8, "skip over a sequence does not read the skipped elements")
+        self.assertListEqual(Enumerable(range(10)).reverse().skip(2).take(3).to_list(), [7, 6, 5])
+        self.assertListEqual(Enumerable((1, 2, 3)).skip(1).reverse().to_list(), [3, 2])
+
+        generated = Enumerable(x for x in range(5))
+        self.assertRaises(TypeError, len, generated.where(lambda x: x))
+        self.assertListEqual(Enumerable((x for x in range(5)), cache='none').reverse().to_list(), [4, 3, 2, 1, 0], "Unsized data is buffered")
+        self.assertEqual(generated.skip(1).reverse().elementAt(1), 3)
+        self.assertEqual(generated.last(), 4)
+        self.assertEqual(len(generated), 5, "Fully buffered data is sized")
+        self.assertTrue(Enumerable([]), "Empty enumerables are still true")
+        self.assertRaises(NoElementsError, enumerable.skip(10).take(5).elementAt, 5)
+
+    def test_appendable_qlist(self):
+        numbers = qlist()
+        self.assertListEqual(qlist().to_list(), [], "qlists do not share a default list")
+        observed = []
+        numbers.observe(observed.append)
+        numbers.extend([3, 1])
+        numbers.append(2)
+        self.assertListEqual(observed, [3, 1, 2], "Observers see every appended element")
+        self.assertListEqual(numbers.where(lambda x: x > 1).to_list(), [3, 2], "Queries see appended elements")
+        numbers.unobserve(observed.append)
+        numbers.append(4)
+        self.assertEqual(len(observed), 3)
+
+        generated = qlist(x for x in _simple)
+        generated.append(4)
+        self.assertListEqual(generated.to_list(), [1, 2, 3, 4], "Any data becomes a list on the first append")
+        data = [1]
+        qlist(data).append(2)
+        self.assertListEqual(data, [1], "The data given to the constructor is not modified")
+        self.assertRaises(TypeError, qlist([1], element_type=int).append, 'a')
+
+    def test_materialized_views(self):
+        source = CountingIterable(_complex)
+        rows = qlist(source)
+        totals = rows.aggregate_view(lambda x: x['value'])
+        self.assertEqual((totals.count(), totals.sum(), totals.min(), totals.max(), totals.avg()), (3, 6, 1, 3, 2.0))
+        rows.extend([{'value': 10}, {'value': -2}])
+        self.assertEqual((totals.count(), totals.sum(), totals.min(), totals.max()), (5, 14, -2, 10), "Views follow appends")
+        self.assertSinglePass(source, "Views are computed once")
+
+        empty = qlist().aggregate_view()
+        self.assertEqual((empty.count(), empty.sum()), (0, 0))
+        self.assertRaises(NoElementsError, empty.avg)
+        self.assertRaises(NoElementsError, empty.max)
+
+        branches = qlist(_locations)
+        turnover = branches.group_by_view(lambda x: x[0], lambda x: x[3])
+        branches.append(('Wales', 'Swansea', 'Branch1', 10000))
+        branches.append(('Ireland', 'Dublin', 'Branch1', 50000))
+        self.assertListEqual(list(turnover), ['Scotland', 'Wales', 'England', 'Ireland'], "Keys in first-seen order")
+        self.assertEqual((turnover['Wales'].count(), turnover['Wales'].sum(), turnover['Wales'].min()), (4, 82500, 10000))
+        self.assertEqual(turnover['France'].count(), 0)
+        branches.unobserve(turnover)
+        branches.append(('Ireland', 'Cork', 'Branch1', 1))
+        self.assertEqual(turnover['Ireland'].count(), 1, "Detached views stop updating")
@@ -0,0 +1,159 @@
+__author__ = 'Viralogic Software'
+
+import asyncio
+import itertools
+import threading
+import time
+from unittest import TestCase
+from py_linq import *
+from tests import _empty, _simple
+
+
+def square(x):
+    return x * x
+
+
+def is_even(x):
+    return x % 2 == 0
+
+
+def repeat(x):
+    return [x] * (x % 3)
+
+
+def group_size(group):
+    return (group.key.id, group.count())
+
+
+def fail_on_seven(x):
+    if x == 7:
+        raise ValueError("seven")
+    return x
+
+
+class TestParallel(TestCase):
+    def setUp(self):
+        self.data = list(range(1000))
+
+    def parallel(self, data, **kwargs):
+        options = {'workers': 2, 'chunk_size': 50}
+        options.update(kwargs)
+        return Enumerable(data).as_parallel(**options)
+
+    def test_select_where_select_many(self):
+        self.assertListEqual(self.parallel(self.data).select(square).to_list(), [x * x for x in self.data], "Parallel select keeps order")
+        self.assertListEqual(self.parallel(self.data).where(is_even).to_list(), [x for x in self.data if x % 2 == 0], "Parallel where keeps order")
+        self.assertListEqual(self.parallel(self.data).select_many(repeat).to_list(), [y for x in self.data for y in repeat(x)], "Parallel select many keeps order")
+        self.assertListEqual(self.parallel(self.data).where(is_even).select(square).take(3).to_list(), [0, 4, 16], "Chained parallel operators")
+        self.assertEqual(self.parallel(x for x in self.data).select(square).sum(), sum(x * x for x in self.data), "Parallel select over generator")
+
+    def test_unordered(self):
+        result = self.parallel(self.data, ordered=False).select(square).to_list()
+        self.assertListEqual(sorted(result), [x * x for x in self.data], "Unordered parallel select yields every element")
+
+    def test_serial_fallback(self):
+        self.assertListEqual(self.parallel(_empty).select(square).to_list(), [])
+        self.assertListEqual(self.parallel(_simple).select(lambda x: x + 1).to_list(), [2, 3, 4], "Sources below threshold run serially, lambdas allowed")
+        self.assertListEqual(self.parallel(self.data, workers=1).select(lambda x: x).to_list(), self.data, "Single worker runs serially")
+
+    def test_errors(self):
+        self.assertRaises(TypeError, self.parallel(self.data).select(lambda x: x).to_list)
+        try:
+            self.parallel(self.data).where(lambda x: True).to_list()
+        except TypeError as e:
+            self.assertIn("module level function", str(e), "Unpicklable function error explains the fix")
+        self.assertRaises(ValueError, self.parallel(self.data).select(fail_on_seven).to_list)
+        self.assertRaises(ValueError, Enumerable(self.data).as_parallel, chunk_size=0)
+
+    def test_groupings(self):
+        groups = Enumerable(self.data).group_by(['id'], lambda x: x % 10)
+        self.assertListEqual(groups.as_parallel(workers=2, chunk_size=2, threshold=0).select(group_size).to_list(),
+                             [(i, 100) for i in range(10)], "Groupings can be sent to worker processes")
+
+    def test_unpicklable_elements(self):
+        locks = [threading.Lock()] * 50
+        self.assertRaises(TypeError, self.parallel(locks, chunk_size=10).select(square).to_list)
+        try:
+            self.parallel(locks, chunk_size=10).where(is_even).to_list()
+        except TypeError as e:
+            self.assertIn("as_sequential", str(e), "Unpicklable element error explains the fix")
+
+    def test_sequential_operators(self):
+        parallel = self.parallel(self.data).select(square)
+        self.assertIsInstance(parallel, ParallelEnumerable)
+        self.assertNotIsInstance(parallel.order_by_descending(lambda x: x), ParallelEnumerable, "Other operators are sequential")
+        self.assertEqual(parallel.order_by_descending(lambda x: x).first(), 999 * 999)
+        self.assertListEqual(parallel.as_sequential().select(lambda x: x + 1).take(2).to_list(), [1, 2])
+        self.assertIs(parallel.foreach(square), parallel)
+
+
+class ConcurrencyTracker(object):
+    """
+    Records the maximum number of calls running at the same time
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def enter(self):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def exit(self):
+        with self.lock:
+            self.active -= 1
+
+
+class TestConcurrent(TestCase):
+    def test_select_concurrent(self):
+        tracker = ConcurrencyTracker()
+        def slow_square(x):
+            tracker.enter()
+            time.sleep(0.005)
+            tracker.exit()
+            return x * x
+        data = list(range(40))
+        self.assertListEqual(Enumerable(data).select_concurrent(slow_square, max_workers=4).to_list(), [x * x for x in data], "Concurrent select keeps order")
+        self.assertTrue(1 < tracker.peak <= 4, "Calls overlap up to max_workers")
+        unordered = Enumerable(data).select_concurrent(slow_square, max_workers=4, ordered=False).to_list()
+        self.assertListEqual(sorted(unordered), [x * x for x in data], "Unordered concurrent select yields every element")
+        self.assertEqual(Enumerable(data).select_concurrent(slow_square).count(), 40)
+        self.assertRaises(NullArgumentError, Enumerable(data).select_concurrent, None)
+
+    def test_select_concurrent_bounded(self):
+        pulled = []
+        def source():
+            for i in itertools.count():
+                pulled.append(i)
+                yield i
+        result = Enumerable(source(), cache='none').select_concurrent(lambda x: x + 1, max_workers=2).take(3).to_list()
+        self.assertListEqual(result, [1, 2, 3])
+        self.assertTrue(len(pulled) <= 3 + 2 * 2, "In-flight window bounds how far the source is read ahead")
+
+    def test_async_enumerable(self):
+        tracker = ConcurrencyTracker()
+        async def fetch(x):
+            tracker.enter()
+            await asyncio.sleep(0.001 * (5 - x % 5))
+            tracker.exit()
+            return x * 10
+        async def is_large(x):
+            await asyncio.sleep(0)
+            return x >= 100
+
+        async def run():
+            enumerable = Enumerable(range(30)).as_async(max_concurrency=5)
+            self.assertListEqual(await enumerable.to_list(), list(range(30)))
+            self.assertListEqual(await enumerable.select(fetch).to_list(), [x * 10 for x in range(30)], "Async select keeps order")
+            self.assertListEqual(await enumerable.select(fetch).where(is_large).where(lambda x: x < 150).to_list(), [100, 110, 120, 130, 140], "Async where with plain and async predicates")
+            unordered = await enumerable.select(fetch, max_concurrency=10, ordered=False).to_list()
+            self.assertListEqual(sorted(unordered), [x * 10 for x in range(30)], "Unordered async select yields every element")
+            return [x async for x in AsyncEnumerable(enumerable.select(lambda x: x + 1)).where(lambda x: x % 10 == 0)]
+
+        self.assertListEqual(asyncio.run(run()), [10, 20, 30], "AsyncEnumerable over an async iterable")
+        self.assertTrue(1 < tracker.peak <= 10, "Async calls overlap up to max_concurrency")
+        self.assertRaises(ValueError, AsyncEnumerable, [], 0)
+        self.assertRaises(TypeError, AsyncEnumerable, 1)
+